@@ -0,0 +1,116 @@
+"""CPU benchmark of the bit-serial candidate conv against independent per-candidate convs, on
+the raw convs and through QConv2d as the gated blocks run it (models.BITSERIAL_CANDIDATES)
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from modules.quantize import calculate_qparams, quantize, QConv2d
+from modules.bitserial import bitserial_conv2d, nested_codes, truncate_codes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='bit-serial vs independent per-candidate quantized conv on CPU')
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--channels', default=64, type=int,
+                        help='input and output channels')
+    parser.add_argument('--size', default=32, type=int,
+                        help='input height and width')
+    parser.add_argument('--kernel_size', default=3, type=int)
+    parser.add_argument('--bits', default=[3, 4, 4, 6, 6], type=int, nargs='*',
+                        help='candidate input precisions')
+    parser.add_argument('--weight_bits', default=8, type=int)
+    parser.add_argument('--grad_bits', default=8, type=int,
+                        help='gradient precision of every candidate (QConv2d path)')
+    parser.add_argument('--repeat', default=10, type=int,
+                        help='timed repetitions (after one warm-up run)')
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch intra-op threads (default: 0, torch default)')
+    return parser.parse_args()
+
+
+def independent(input, weight, bits, qparams, padding):
+    """what the gated models do today: quantize and convolve once per candidate"""
+    return [F.conv2d(quantize(input, qparams=qparams._replace(num_bits=b)), weight, padding=padding)
+            for b in bits]
+
+
+def nested_reference(input, weight, bits, qparams, padding):
+    """independent convs on the nested grid bit-serial evaluation uses, for the exactness check"""
+    codes, scale = nested_codes(input, qparams.zero_point, qparams.range, max(bits))
+    return [F.conv2d(truncate_codes(codes, max(bits), b) * scale + qparams.zero_point, weight, padding=padding)
+            for b in bits]
+
+
+def bitserial(input, weight, bits, qparams, padding):
+    outputs = bitserial_conv2d(input, weight, bits, qparams.zero_point, qparams.range, padding=padding)
+    return [outputs[b] for b in bits]
+
+
+def qconv_loop(conv, input, bits, grad_bits):
+    """the dense gated blocks without --bitserial: one QConv2d forward per candidate"""
+    return [conv(input, b, g) for b, g in zip(bits, grad_bits)]
+
+
+def qconv_candidates(conv, input, bits, grad_bits):
+    """the dense gated blocks with --bitserial"""
+    return conv.forward_candidates(input, bits, grad_bits, bitserial=True)
+
+
+def timeit(fn, repeat, *args):
+    fn(*args)
+    start = time.time()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.time() - start) / repeat * 1000
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    input = torch.relu(torch.randn(args.batch_size, args.channels, args.size, args.size))
+    weight = torch.randn(args.channels, args.channels, args.kernel_size, args.kernel_size)
+    weight = quantize(weight, num_bits=args.weight_bits, flatten_dims=(1, -1), reduce_dim=None)
+    qparams = calculate_qparams(input, num_bits=max(args.bits), flatten_dims=(1, -1),
+                                reduce_dim=0, reduce_type='extreme')
+    padding = args.kernel_size // 2
+
+    print('input {}, weight {}, bits {}, {} threads'.format(
+        tuple(input.shape), tuple(weight.shape), args.bits, torch.get_num_threads()))
+
+    with torch.no_grad():
+        ref = nested_reference(input, weight, args.bits, qparams, padding)
+        out = bitserial(input, weight, args.bits, qparams, padding)
+        ind = independent(input, weight, args.bits, qparams, padding)
+        for b, r, o, i in zip(args.bits, ref, out, ind):
+            print('{}-bit: max |bitserial - nested| = {:.3e}, max |bitserial - independent| = {:.3e} (grid difference)'.format(
+                b, (o - r).abs().max().item(), (o - i).abs().max().item()))
+
+        t_ind = timeit(independent, args.repeat, input, weight, args.bits, qparams, padding)
+        t_bs = timeit(bitserial, args.repeat, input, weight, args.bits, qparams, padding)
+
+    print('independent: {:.2f} ms, bit-serial: {:.2f} ms, speedup {:.2f}x'.format(t_ind, t_bs, t_ind / t_bs))
+
+    # the same comparison through QConv2d, with its input range measurement and weight quantization
+    conv = QConv2d(args.channels, args.channels, args.kernel_size, padding=padding, bias=False,
+                   weight_bits=args.weight_bits)
+    grad_bits = [args.grad_bits] * len(args.bits)
+    with torch.no_grad():
+        t_loop = timeit(qconv_loop, args.repeat, conv, input, args.bits, grad_bits)
+        t_cand = timeit(qconv_candidates, args.repeat, conv, input, args.bits, grad_bits)
+
+    print('QConv2d per candidate: {:.2f} ms, QConv2d.forward_candidates: {:.2f} ms, speedup {:.2f}x'.format(
+        t_loop, t_cand, t_loop / t_cand))
+
+
+if __name__ == '__main__':
+    main()
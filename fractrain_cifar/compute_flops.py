@@ -1,219 +1,236 @@
-# Code from https://github.com/simochen/model-tools.
-import numpy as np
-import os
-
-import torch
-import torchvision
-import torch.nn as nn
-from torch.autograd import Variable
-
-from models_base import cifar10_resnet_38, cifar10_resnet_74, cifar100_resnet_38, cifar100_resnet_74
-
-def print_model_param_nums(model=None):
-    if model == None:
-        model = torchvision.models.alexnet()
-    total = sum([param.nelement() if param.requires_grad else 0 for param in model.parameters()])
-    print('  + Number of params: %.4fM' % (total / 1e6))
-
-def count_model_param_flops(model=None, input_res=32, multiply_adds=True):
-
-    prods = {}
-    def save_hook(name):
-        def hook_per(self, input, output):
-            prods[name] = np.prod(input[0].shape)
-        return hook_per
-
-    list_1=[]
-    def simple_hook(self, input, output):
-        list_1.append(np.prod(input[0].shape))
-    list_2={}
-    def simple_hook2(self, input, output):
-        list_2['names'] = np.prod(input[0].shape)
-
-
-    list_conv=[]
-    def conv_hook(self, input, output):
-        batch_size, input_channels, input_height, input_width = input[0].size()
-        output_channels, output_height, output_width = output[0].size()
-
-        kernel_ops = self.kernel_size[0] * self.kernel_size[1] * (self.in_channels / self.groups)
-        bias_ops = 1 if self.bias is not None else 0
-
-        params = output_channels * (kernel_ops + bias_ops)
-        # flops = (kernel_ops * (2 if multiply_adds else 1) + bias_ops) * output_channels * output_height * output_width * batch_size
-
-        num_weight_params = (self.weight.data != 0).float().sum()
-        flops = (num_weight_params * (2 if multiply_adds else 1) + bias_ops * output_channels) * output_height * output_width * batch_size
-
-        list_conv.append(flops)
-
-    list_linear=[]
-    def linear_hook(self, input, output):
-        batch_size = input[0].size(0) if input[0].dim() == 2 else 1
-
-        weight_ops = self.weight.nelement() * (2 if multiply_adds else 1)
-        bias_ops = self.bias.nelement()
-
-        flops = batch_size * (weight_ops + bias_ops)
-        list_linear.append(flops)
-
-    list_bn=[]
-    def bn_hook(self, input, output):
-        list_bn.append(input[0].nelement() * 2)
-
-    list_relu=[]
-    def relu_hook(self, input, output):
-        list_relu.append(input[0].nelement())
+"""Analytic FLOP / BitOp / memory counter for the architectures in models.py.
 
-    list_pooling=[]
-    def pooling_hook(self, input, output):
-        batch_size, input_channels, input_height, input_width = input[0].size()
-        output_channels, output_height, output_width = output[0].size()
+Shapes are propagated from the conv hyper-parameters alone, no forward pass is run, so every
+registered arch is analysed in milliseconds at any input resolution. The gated layers are the
+`group{g}_layer{i}` blocks, in the order the gates see them; inside a block the convs run one
+after the other, except `downsample` / `shortcut` convs, which read the block input.
 
-        kernel_ops = self.kernel_size * self.kernel_size
-        bias_ops = 0
-        params = 0
-        flops = (kernel_ops + bias_ops) * output_channels * output_height * output_width * batch_size
+FLOPs count a multiply-add as 2 (as the previous hook-based counter did), BitOps count one
+multiply-add of an a-bit by a b-bit operand as a * b. Depthwise convs (groups > 1) run at the
+fixed DWS_BITS precision and are reported apart from the gated convs.
 
-        list_pooling.append(flops)
+    python compute_flops.py                           # every arch, 32x32
+    python compute_flops.py --arch cifar10_rnn_gate_38 --resolution 32 40 --report
+"""
 
-    list_upsample=[]
+from __future__ import print_function
 
-    # For bilinear upsample
-    def upsample_hook(self, input, output):
-        batch_size, input_channels, input_height, input_width = input[0].size()
-        output_channels, output_height, output_width = output[0].size()
-
-        flops = output_height * output_width * output_channels * batch_size * 12
-        list_upsample.append(flops)
-
-    def foo(net):
-        childrens = list(net.children())
-        if not childrens:
-            if isinstance(net, torch.nn.Conv2d):
-                net.register_forward_hook(conv_hook)
-            if isinstance(net, torch.nn.Linear):
-                net.register_forward_hook(linear_hook)
-            if isinstance(net, torch.nn.BatchNorm2d):
-                net.register_forward_hook(bn_hook)
-            if isinstance(net, torch.nn.ReLU):
-                net.register_forward_hook(relu_hook)
-            if isinstance(net, torch.nn.MaxPool2d) or isinstance(net, torch.nn.AvgPool2d):
-                net.register_forward_hook(pooling_hook)
-            if isinstance(net, torch.nn.Upsample):
-                net.register_forward_hook(upsample_hook)
-            return
-        for c in childrens:
-            foo(c)
-
-    if model == None:
-        model = torchvision.models.alexnet()
-    foo(model)
-    input = Variable(torch.rand(3,input_res,input_res).unsqueeze(0), requires_grad = True)
-    out = model(input)
-
-
-    total_flops = (sum(list_conv) + sum(list_linear) + sum(list_bn) + sum(list_relu) + sum(list_pooling) + sum(list_upsample))
+import argparse
+import os
 
-    print('  + Number of FLOPs: %.2fG' % (total_flops / 1e9))
+import numpy as np
+import torch.nn as nn
 
-    return total_flops
+import models
+
+
+# candidate (bits, grad_bits) pairs of train_dfq.py / train_frac.py
+BITS = [3, 4, 4, 6, 6]
+GRAD_BITS = [6, 6, 8, 8, 12]
+
+_SIDE_BRANCHES = ('downsample', 'shortcut')
+
+
+def arch_names():
+    return sorted(name for name in models.__dict__
+                  if name.islower() and not name.startswith('__') and name.startswith('cifar')
+                  and callable(models.__dict__[name]))
+
+
+def conv_output_size(conv, size):
+    """(h, w) output of conv for an (h, w) input"""
+    return tuple((s + 2 * conv.padding[d] - conv.dilation[d] * (conv.kernel_size[d] - 1) - 1) // conv.stride[d] + 1
+                 for d, s in enumerate(size))
+
+
+def conv_cost(conv, size):
+    """Cost of one conv on a single (c, h, w) sample of spatial size `size`"""
+    out_size = conv_output_size(conv, size)
+    params = conv.weight.numel()
+    return {
+        'macs': params * out_size[0] * out_size[1],
+        'act': conv.in_channels * size[0] * size[1],
+        'params': params,
+        'out_size': out_size,
+    }
+
+
+def block_convs(block, size):
+    """(conv, input size, output size, side branch) of every conv of a block whose input has
+    spatial size `size`"""
+    chain = size
+    for name, m in block.named_modules():
+        if not isinstance(m, nn.Conv2d):
+            continue
+        side = name.split('.')[0] in _SIDE_BRANCHES
+        in_size = size if side else chain
+        out_size = conv_output_size(m, in_size)
+        if not side:
+            chain = out_size
+        yield m, in_size, out_size, side
+
+
+def block_cost(block, size):
+    """Cost of a gated block for an input of spatial size `size`: gated (groups == 1) and
+    depthwise MACs, saved input activations and weights, and the output size"""
+    cost = {'macs': 0, 'dws_macs': 0, 'act': 0, 'params': 0, 'out_size': size}
+    for m, in_size, out_size, side in block_convs(block, size):
+        c = conv_cost(m, in_size)
+        cost['macs' if m.groups == 1 else 'dws_macs'] += c['macs']
+        cost['act'] += c['act']
+        cost['params'] += c['params']
+        if not side:
+            cost['out_size'] = out_size
+    return cost
+
+
+def gated_blocks(model):
+    """(name, block) of every gated layer, in gate order"""
+    for g in range(len(model.num_layers)):
+        for i in range(model.num_layers[g]):
+            name = 'group{}_layer{}'.format(g + 1, i)
+            yield name, getattr(model, name)
+
+
+def analyze(model, resolution=32):
+    """Per-gated-layer costs of model for a resolution x resolution input, plus the ungated
+    stem, head and classifier"""
+    size = (resolution, resolution)
+    stem = conv_cost(model.conv1, size)
+    size = stem['out_size']
+    if isinstance(getattr(model, 'maxpool', None), nn.MaxPool2d):
+        pool = model.maxpool
+        size = tuple((s + 2 * pool.padding - pool.kernel_size) // pool.stride + 1 for s in size)
+
+    layers = []
+    ungated = {'macs': stem['macs'], 'params': stem['params']}
+    for name, block in gated_blocks(model):
+        cost = block_cost(block, size)
+        cost['name'] = name
+        # full-precision downsample path of the gated ResNets, outside the block
+        ds = getattr(model, name.replace('_layer', '_ds'), None)
+        if ds is not None:
+            ungated['macs'] += conv_cost(ds, size)['macs']
+        layers.append(cost)
+        size = cost['out_size']
+
+    for name, m in model.named_children():
+        if isinstance(m, nn.Conv2d) and name != 'conv1' and not name.startswith('group'):
+            c = conv_cost(m, size)
+            ungated['macs'] += c['macs']
+            ungated['params'] += c['params']
+            size = c['out_size']
+        elif isinstance(m, nn.Linear):
+            ungated['macs'] += m.weight.numel()
+            ungated['params'] += m.weight.numel()
+    return layers, ungated
+
+
+def bitops(layers, bits=BITS, grad_bits=GRAD_BITS, weight_bits=8):
+    """layer x candidate BitOps of the forward (weight x activation), error backward
+    (weight x gradient) and gradient computation (activation x gradient) convs.
+    A 0 precision stands for full precision (32 bits)."""
+    bits = [b or 32 for b in bits]
+    grad_bits = [b or 32 for b in grad_bits]
+    weight_bits = weight_bits or 32
+    macs = np.array([layer['macs'] for layer in layers], dtype=np.float64).reshape(-1, 1)
+    return {
+        'fw': macs * weight_bits * np.array(bits),
+        'eb': macs * weight_bits * np.array(grad_bits),
+        'gc': macs * np.array(bits) * np.array(grad_bits),
+    }
+
+
+def model_info(model, resolution=32):
+    """conv_info / dws FLOPs per gated layer, the format train_dfq.py reads with --conv_info"""
+    layers, _ = analyze(model, resolution)
+    return {
+        'conv': [2 * layer['macs'] for layer in layers],
+        'dws': [2 * layer['dws_macs'] for layer in layers],
+        'act': [layer['act'] for layer in layers],
+        'params': [layer['params'] for layer in layers],
+        'resolution': resolution,
+    }
+
+
+def model_info_path(out_dir, arch, dataset, resolution):
+    return os.path.join(out_dir, 'model_info_{}_{}_{}.npy'.format(dataset, arch, resolution))
+
+
+def save_model_info(path, info):
+    # write-then-rename, so concurrent runs never read a partial cache
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, info)
+    os.replace(tmp, path)
+
+
+def load_model_info(arch, dataset, resolution=32, cache_dir='model_info'):
+    """model_info of arch for a resolution x resolution input, computed on first use and
+    cached in cache_dir per (dataset, arch, resolution)"""
+    path = model_info_path(cache_dir, arch, dataset, resolution)
+    if os.path.isfile(path):
+        return np.load(path, allow_pickle=True).item()
+    info = model_info(build(arch), resolution)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_model_info(path, info)
+    return info
+
+
+def build(arch):
+    # proj_dim only sizes the gate projection, it does not change any conv
+    try:
+        return models.__dict__[arch](proj_dim=len(BITS))
+    except TypeError:
+        return models.__dict__[arch]()
+
+
+def report(arch, model, resolution, weight_bits):
+    layers, ungated = analyze(model, resolution)
+    ops = bitops(layers, weight_bits=weight_bits)
+    print('{} @ {}x{}'.format(arch, resolution, resolution))
+    print('  {:<16}{:>12}{:>12}{:>12}{:>12}  {}'.format(
+        'layer', 'MFLOPs', 'dws MFLOPs', 'act (K)', 'params (K)',
+        'fw GBitOps per (bits, grad_bits) ' + str(list(zip(BITS, GRAD_BITS)))))
+    for k, layer in enumerate(layers):
+        print('  {:<16}{:>12.3f}{:>12.3f}{:>12.1f}{:>12.1f}  {}'.format(
+            layer['name'], 2 * layer['macs'] / 1e6, 2 * layer['dws_macs'] / 1e6,
+            layer['act'] / 1e3, layer['params'] / 1e3,
+            ' '.join('{:.3f}'.format(b / 1e9) for b in ops['fw'][k])))
+    gated = sum(2 * layer['macs'] for layer in layers)
+    dws = sum(2 * layer['dws_macs'] for layer in layers)
+    print('  gated {:.2f} MFLOPs, depthwise {:.2f} MFLOPs, ungated {:.2f} MFLOPs, params {:.3f}M'.format(
+        gated / 1e6, dws / 1e6, 2 * ungated['macs'] / 1e6,
+        (sum(layer['params'] for layer in layers) + ungated['params']) / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='analytic FLOP / BitOp counter, writes the conv_info caches')
+    parser.add_argument('--arch', default=None, type=str, nargs='*',
+                        help='architectures to analyse (default: every arch in models.py)')
+    parser.add_argument('--resolution', default=[32], type=int, nargs='*',
+                        help='input resolutions (default: 32)')
+    parser.add_argument('--weight_bits', default=8, type=int,
+                        help='weight precision for the BitOps report (default: 8)')
+    parser.add_argument('--out_dir', default='model_info', type=str,
+                        help='directory of the model_info_<dataset>_<arch>_<resolution>.npy caches')
+    parser.add_argument('--report', default=False, action='store_true',
+                        help='print the per-layer table')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for arch in args.arch or arch_names():
+        model = build(arch)
+        if not hasattr(model, 'num_layers'):
+            continue
+        for resolution in args.resolution:
+            if args.report:
+                report(arch, model, resolution, args.weight_bits)
+            # the arch names carry their dataset: cifar10_..., cifar100_...
+            path = model_info_path(args.out_dir, arch, arch.split('_')[0], resolution)
+            save_model_info(path, model_info(model, resolution))
+            print('=> wrote {}'.format(path))
 
 
 if __name__ == '__main__':
-    from models import *
-    model = cifar10_mobilenet_v2()
-
-    blocks = []
-
-    for module in model.modules():
-        if isinstance(module, Block):
-            blocks.append(module)
-
-    conv_list = []
-    def conv_hook(self, input, output):
-        batch_size, input_channels, input_height, input_width = input[0].size()
-        output_channels, output_height, output_width = output[0].size()
-
-        kernel_ops = self.kernel_size[0] * self.kernel_size[1] * (self.in_channels / self.groups)
-        bias_ops = 1 if self.bias is not None else 0
-
-        params = output_channels * (kernel_ops + bias_ops)
-        # flops = (kernel_ops * (2 if multiply_adds else 1) + bias_ops) * output_channels * output_height * output_width * batch_size
-
-        num_weight_params = (self.weight.data != 0).float().sum()
-        flops = (num_weight_params * 2 + bias_ops * output_channels) * output_height * output_width * batch_size
-
-        conv_list.append(flops)
-
-    dws_list = []
-    def dws_hook(self, input, output):
-        batch_size, input_channels, input_height, input_width = input[0].size()
-        output_channels, output_height, output_width = output[0].size()
-
-        kernel_ops = self.kernel_size[0] * self.kernel_size[1] * (self.in_channels / self.groups)
-        bias_ops = 1 if self.bias is not None else 0
-
-        params = output_channels * (kernel_ops + bias_ops)
-        # flops = (kernel_ops * (2 if multiply_adds else 1) + bias_ops) * output_channels * output_height * output_width * batch_size
-
-        num_weight_params = (self.weight.data != 0).float().sum()
-        flops = (num_weight_params * 2 + bias_ops * output_channels) * output_height * output_width * batch_size
-
-        dws_list.append(flops)
-
-    block_flops_list = []
-    dws_list = []
-    hook_list = []
-    for block in blocks:
-        for module in block.modules():
-            if isinstance(module, torch.nn.Conv2d):
-                if module.groups == 1:
-                    hook = module.register_forward_hook(conv_hook)
-                    hook_list.append(hook)
-                else:
-                    hook = module.register_forward_hook(dws_hook)
-                    hook_list.append(hook)
-
-        input = Variable(torch.rand(3, 32, 32).unsqueeze(0), requires_grad = True)
-        out = model(input, 0, 0)
-
-        block_flops_list.append(sum(conv_list))
-
-        for hook in hook_list:
-            hook.remove()
-
-        conv_list = []
-
-    print(block_flops_list)
-    print(dws_list)
-
-    model_info = {'conv':block_flops_list, 'dws':dws_list}
-
-    np.save('model_info_mbv2.npy', model_info)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    main()
@@ -8,13 +8,33 @@ import torchvision
 import torchvision.transforms as transforms
 import numpy as np
 
+from util_checkpoint import ResumableSampler
+from util_sampler import RouteBucketSampler
+
 
 crop_size = 32
 padding = 4
 
 
+def train_loader_for(trainset, batch_size, shuffle, num_workers, drop_last, route_layers=0,
+                     route_max_age=1, route_mix=0.25):
+    """DataLoader over trainset, batched by a RouteBucketSampler when route_layers is set"""
+    if route_layers:
+        sampler = RouteBucketSampler(trainset, batch_size, route_layers, shuffle=shuffle, drop_last=drop_last,
+                                     max_age=route_max_age, mix=route_mix)
+        return torch.utils.data.DataLoader(trainset,
+                                           batch_sampler=sampler,
+                                           num_workers=num_workers)
+    return torch.utils.data.DataLoader(trainset,
+                                       batch_size=batch_size,
+                                       sampler=ResumableSampler(trainset, shuffle=shuffle),
+                                       num_workers=num_workers,
+                                       drop_last=drop_last)
+
+
 def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_size=128,
-                       shuffle=True, num_workers=4):
+                       shuffle=True, num_workers=4, drop_last=False, route_layers=0,
+                       route_max_age=1, route_mix=0.25):
 
     if 'cifar' in dataset:
         transform_train = transforms.Compose([
@@ -27,10 +47,8 @@ def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_si
 
         trainset = torchvision.datasets.__dict__[dataset.upper()](
             root=datadir, train=True, download=True, transform=transform_train)
-        train_loader = torch.utils.data.DataLoader(trainset,
-                                                   batch_size=batch_size,
-                                                   shuffle=shuffle,
-                                                   num_workers=num_workers)
+        train_loader = train_loader_for(trainset, batch_size, shuffle, num_workers, drop_last,
+                                        route_layers, route_max_age, route_mix)
     elif 'svhn' in dataset:
         transform_train =transforms.Compose([
                     transforms.ToTensor(),
@@ -60,10 +78,8 @@ def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_si
 
         total_data =  torch.utils.data.ConcatDataset([trainset, extraset])
 
-        train_loader = torch.utils.data.DataLoader(total_data,
-                                                   batch_size=batch_size,
-                                                   shuffle=shuffle,
-                                                   num_workers=num_workers)
+        train_loader = train_loader_for(total_data, batch_size, shuffle, num_workers, drop_last,
+                                        route_layers, route_max_age, route_mix)
     else:
         train_loader = None
     return train_loader
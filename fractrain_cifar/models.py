@@ -20,6 +20,19 @@ MOMENTUM = 0.9
 
 DWS_BITS = 8
 DWS_GRAD_BITS = 16
+
+# send every sample only through its gate-selected precision (see Block / BasicBlock.forward_routed)
+ROUTED_BLOCKS = False
+# pad the routed sub-batches to a multiple of this size, so the convs see a few shapes only (0: off)
+ROUTE_BUCKET = 0
+# evaluate the candidates of a dense gated block together, the convs reading the block input
+# bit-serially (see QConv2d.forward_candidates, experimental)
+BITSERIAL_CANDIDATES = False
+
+# per-candidate capacity of the RNN gate during training, as a multiple of batch / candidates (0: off)
+CAPACITY_FACTOR = 0
+# where the samples over capacity go: 'cheaper' or 'dearer' candidates first
+CAPACITY_POLICY = 'cheaper'
     
 
 def Conv3x3(in_planes, out_planes, stride=1):
@@ -78,6 +91,34 @@ class BasicBlock(nn.Module):
         out = self.relu(out)
         return out
 
+    def forward_routed(self, x, routes, bits, grad_bits):
+        """Every sample only goes through its routed precision: the convs run once per
+        sub-batch, the BN layers once on the whole batch."""
+        residual = x
+
+        out = self.relu(self.bn1(routed(self.conv1, x, routes, bits, grad_bits)))
+        out = self.bn2(routed(self.conv2, out, routes, bits, grad_bits))
+
+        if self.downsample is not None:
+            residual = self.bn3(routed(self.downsample, x, routes, bits, grad_bits))
+
+        return self.relu(out + residual)
+
+    def forward_candidates(self, x, bits, grad_bits):
+        """forward(x, bits[k], grad_bits[k]) for every candidate k: conv1 and the downsample conv
+        see the same input for all candidates and go through QConv2d.forward_candidates."""
+        first = self.conv1.forward_candidates(x, bits, grad_bits, bitserial=BITSERIAL_CANDIDATES)
+        if self.downsample is not None:
+            residual = self.downsample.forward_candidates(x, bits, grad_bits, bitserial=BITSERIAL_CANDIDATES)
+
+        outputs = []
+        for k in range(len(bits)):
+            out = self.relu(self.bn1(first[k]))
+            out = self.bn2(self.conv2(out, bits[k], grad_bits[k]))
+            out = out + (self.bn3(residual[k]) if self.downsample is not None else x)
+            outputs.append(self.relu(out))
+        return outputs
+
 
 ########################################
 # Original ResNet                      #
@@ -317,15 +358,14 @@ class RNNGate(nn.Module):
 
     def init_hidden(self, batch_size):
         # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()),
-                autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()))
+        device = self.proj.weight.device
+        return (torch.zeros(1, batch_size, self.hidden_dim, device=device),
+                torch.zeros(1, batch_size, self.hidden_dim, device=device))
 
     def repackage_hidden(self):
         self.hidden_one = repackage_hidden(self.hidden_one)
         # self.hidden_two = repackage_hidden(self.hidden_two)
-    def forward(self, x):
+    def forward(self, x, allowed=None):
         # Take the convolution output of each step
         batch_size = x.size(0)
         self.rnn_one.flatten_parameters()
@@ -339,6 +379,10 @@ class RNNGate(nn.Module):
         
         x_one = self.proj(out_one.squeeze())
         # x_two = self.proj_two(out_two.squeeze())
+
+        # disabled candidates (see util_candidates) get probability 0 and are never chosen
+        if allowed is not None:
+            x_one = x_one.masked_fill(~allowed.to(x_one.device), float('-inf'))
         
         # proj = self.proj(out.squeeze())
         prob = self.prob_layer(x_one)
@@ -349,17 +393,17 @@ class RNNGate(nn.Module):
         
         # x_two = prob_two.detach().cpu().numpy()
         
-        x_one = prob.detach().cpu().numpy()
-        
-        hard = (x_one == x_one.max(axis=1)[:,None]).astype(int)
-        hard = torch.from_numpy(hard)
-        hard = hard.cuda()
+        # hard decision on device, no host round-trip (keeps the step graph-capturable)
+        prob_detach = prob.detach()
+        if CAPACITY_FACTOR and self.training:
+            hard = capacity_decision(prob_detach, CAPACITY_FACTOR, CAPACITY_POLICY, allowed)
+        else:
+            hard = (prob_detach == prob_detach.max(dim=1, keepdim=True)[0]).float()
         
         # x_two = hard.float().detach() - \
               # prob_two.detach() + prob_two
             
-        x_one = hard.float().detach() - \
-                prob.detach() + prob
+        x_one = hard - prob_detach + prob
              
         # print(x_one)
 
@@ -388,10 +432,9 @@ class SoftRNNGate(nn.Module):
         self.prob = nn.Sigmoid()
 
     def init_hidden(self, batch_size):
-        return (autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()),
-                autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()))
+        device = self.proj.weight.device
+        return (torch.zeros(1, batch_size, self.hidden_dim, device=device),
+                torch.zeros(1, batch_size, self.hidden_dim, device=device))
 
     def repackage_hidden(self):
         self.hidden = repackage_hidden(self.hidden)
@@ -451,6 +494,10 @@ class ResNetRecurrentGateSP(nn.Module):
         self.avgpool = nn.AvgPool2d(8)
         self.fc = nn.Linear(64 * block.expansion, num_classes)
 
+        # per-layer enabled candidates, set by util_candidates.CandidateManager (None: all)
+        self.candidate_sets = None
+        self.candidate_masks = None
+
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -519,10 +566,11 @@ class ResNetRecurrentGateSP(nn.Module):
         masks = []
 
         gate_feature = self.gate_layer1(x)
-        mask = self.control(gate_feature)
+        mask = gate_decision(self, gate_feature, 0)
         #mask_grad = self.control_grad(gate_feature)
         
         prev = x
+        layer = 0
 
         for g in range(3):
             for i in range(self.num_layers[g]):
@@ -530,31 +578,45 @@ class ResNetRecurrentGateSP(nn.Module):
                     prev = getattr(self, 'group{}_ds{}'.format(g+1, i))(prev, 0, 0)
                     prev = getattr(self, 'group{}_bn{}'.format(g+1, i))(prev)
                     
-                output_candidates = []
-                
-                # output_candidates.append(prev)
-                
-                for k in range(len(bits)):
-                    if bits[k] == 0:
-                        output_candidates.append(prev)
-                    else:
-                        out = getattr(self, 'group{}_layer{}'.format(g+1, i))(x, bits[k], grad_bits[k])
-                        output_candidates.append(out)
-                    
                 mask_list = []
                     
                 for j in range(len(bits)):
                     mask_list.append(mask[:,j,:,:,:])
+
+                if ROUTED_BLOCKS:
+                    choice, routes = gate_routes(mask)
+                    out = skip_routed(getattr(self, 'group{}_layer{}'.format(g+1, i)), x, prev, choice, routes, bits, grad_bits)
+                    # straight-through gradient of the chosen candidate to the gate, as in MobileNetV2_RNN
+                    gate = mask.view(mask.size(0), -1).gather(1, choice.view(-1, 1))
+                    prev = x = gate.view(-1, 1, 1, 1).expand_as(out) * out
+                else:
+                    output_candidates = {}
                     
-                
-                prev = x = sum([mask_list[k].expand_as(out) * output_candidates[k] for k in range(len(bits))])
+                    # output_candidates.append(prev)
+                    
+                    candidates = active_candidates(self, layer, len(bits))
+                    if BITSERIAL_CANDIDATES:
+                        run = [k for k in candidates if bits[k] != 0]
+                        if run:
+                            outs = getattr(self, 'group{}_layer{}'.format(g+1, i)).forward_candidates(
+                                x, [bits[k] for k in run], [grad_bits[k] for k in run])
+                            output_candidates.update(zip(run, outs))
+                    for k in candidates:
+                        if bits[k] == 0:
+                            output_candidates[k] = prev
+                        elif k not in output_candidates:
+                            out = getattr(self, 'group{}_layer{}'.format(g+1, i))(x, bits[k], grad_bits[k])
+                            output_candidates[k] = out
+                    
+                    prev = x = sum([mask_list[k].expand_as(output_candidates[k]) * output_candidates[k] for k in candidates])
                 
                 mask_list = [mask.squeeze() for mask in mask_list]
                 
                 masks.append(mask_list)
+                layer += 1
                     
                 gate_feature = getattr(self, 'group{}_gate{}'.format(g+1, i))(x)
-                mask = self.control(gate_feature)
+                mask = gate_decision(self, gate_feature, layer)
                 # mask_grad = self.control_grad(gate_feature)
 
 
@@ -626,6 +688,132 @@ def cifar100_rnn_gate_152(pretrained=False, **kwargs):
     return model
 
 
+def gate_routes(mask):
+    """Per-sample candidate chosen by the hard decision of an RNNGate mask (batch, len(bits), 1, 1, 1).
+    Returns (choice, routes), routes[k] holding the indices of the samples routed to candidate k."""
+    choice = mask.detach().view(mask.size(0), -1).argmax(dim=1)
+    routes = [(choice == k).nonzero().view(-1) for k in range(mask.size(1))]
+    return choice, routes
+
+
+def gate_decision(model, gate_feature, layer):
+    """RNNGate decision for gated layer `layer` (the last gate call, after the final block, has
+    no layer), its softmax restricted to the candidates enabled in model.candidate_masks"""
+    allowed = model.candidate_masks
+    if allowed is None or layer >= len(allowed):
+        return model.control(gate_feature)
+    return model.control(gate_feature, allowed=allowed[layer])
+
+
+def active_candidates(model, layer, num_candidates):
+    """Candidates gated layer `layer` has to run: the ones a disabled candidate would be
+    blended in with a zero mask, so skipping them leaves the output unchanged"""
+    if model.candidate_sets is None:
+        return range(num_candidates)
+    return model.candidate_sets[layer]
+
+
+_PREFERENCES = {}
+
+
+def capacity_preferences(num_candidates, policy, device):
+    """(candidate, candidate) table: row k lists the candidates a sample choosing k falls back to,
+    k itself first. Candidates are ordered from the cheapest to the dearest precision."""
+    key = (num_candidates, policy, str(device))
+    if key not in _PREFERENCES:
+        if policy == 'cheaper':
+            order = lambda k, j: (j > k, abs(j - k))
+        elif policy == 'dearer':
+            order = lambda k, j: (j < k, abs(j - k))
+        else:
+            raise ValueError('unknown capacity policy {}'.format(policy))
+        table = [sorted(range(num_candidates), key=lambda j: order(k, j)) for k in range(num_candidates)]
+        _PREFERENCES[key] = torch.tensor(table, dtype=torch.long, device=device)
+    return _PREFERENCES[key]
+
+
+def capacity_decision(prob, capacity_factor, policy='cheaper', allowed=None):
+    """One-hot (batch, candidates) decisions with at most ceil(capacity_factor * batch / candidates)
+    samples per (enabled) candidate, as in capacity-bounded MoE routing.
+
+    Samples are placed in order of decreasing gate confidence. A sample whose choice is full goes
+    to the next candidate of its preference row (see capacity_preferences) with room left. The
+    C rounds are fixed-shape device ops, no host sync. A sample only keeps an over-capacity
+    choice when every candidate is full, which capacity_factor >= 1 rules out."""
+    batch_size, num_candidates = prob.shape
+    confidence, choice = prob.max(dim=1)
+    order = confidence.argsort(descending=True)
+    preferences = capacity_preferences(num_candidates, policy, prob.device)[choice.index_select(0, order)]
+
+    if allowed is None:
+        capacity = int(math.ceil(capacity_factor * batch_size / num_candidates))
+        remaining = torch.full((num_candidates,), capacity, dtype=torch.long, device=prob.device)
+    else:
+        allowed = allowed.to(prob.device).long()
+        remaining = torch.ceil(capacity_factor * batch_size / allowed.sum().float()).long() * allowed
+
+    assigned = torch.full_like(choice, -1)
+    for r in range(num_candidates):
+        want = preferences[:, r]
+        free = assigned < 0
+        onehot = F.one_hot(want, num_candidates) * free.long().unsqueeze(1)
+        position = onehot.cumsum(0).gather(1, want.view(-1, 1)).view(-1)
+        take = free & (position <= remaining.index_select(0, want))
+        assigned = torch.where(take, want, assigned)
+        remaining = remaining - (onehot * take.long().unsqueeze(1)).sum(0)
+    assigned = torch.where(assigned < 0, preferences[:, 0], assigned)
+
+    decision = torch.empty_like(assigned).scatter_(0, order, assigned)
+    return F.one_hot(decision, num_candidates).to(prob.dtype)
+
+
+def bucket_size(n, bucket, limit):
+    """n rounded up to a multiple of bucket, at most limit"""
+    if not bucket:
+        return n
+    return min(-(-n // bucket) * bucket, limit)
+
+
+def routed(conv, x, routes, bits, grad_bits):
+    """Run conv(x_k, bits[k], grad_bits[k]) on the sub-batch routed to each candidate only and
+    gather the results back into one full-batch tensor. With ROUTE_BUCKET, a sub-batch is padded
+    with copies of its first sample to a bucket size, and the padding rows are dropped."""
+    out = None
+    for k, idx in enumerate(routes):
+        n = idx.numel()
+        if n == 0:
+            continue
+        size = bucket_size(n, ROUTE_BUCKET, x.size(0))
+        if size > n:
+            idx_run = torch.cat([idx, idx[:1].expand(size - n)])
+            out_k = conv(x.index_select(0, idx_run), bits[k], grad_bits[k])[:n]
+        else:
+            out_k = conv(x.index_select(0, idx), bits[k], grad_bits[k])
+        if out is None:
+            out = out_k.new_zeros((x.size(0),) + out_k.shape[1:])
+        out = out.index_copy(0, idx, out_k)
+    return out
+
+
+def skip_routed(block, x, prev, choice, routes, bits, grad_bits):
+    """block.forward_routed for the SkipNet candidates of ResNetRecurrentGateSP: samples routed to
+    a 0-bit candidate skip the block and take `prev`, the block (and its BN) sees the others only"""
+    skip = [k for k in range(len(bits)) if bits[k] == 0]
+    if not skip:
+        return block.forward_routed(x, routes, bits, grad_bits)
+
+    keep = torch.ones_like(choice, dtype=torch.bool)
+    for k in skip:
+        keep = keep & (choice != k)
+    keep = keep.nonzero().view(-1)
+    if keep.numel() == 0:
+        return prev
+    sub_choice = choice.index_select(0, keep)
+    sub_routes = [(sub_choice == k).nonzero().view(-1) for k in range(len(bits))]
+    out = block.forward_routed(x.index_select(0, keep), sub_routes, bits, grad_bits)
+    return prev.index_copy(0, keep, out)
+
+
 class Block(nn.Module):
     '''expand + depthwise + pointwise'''
     def __init__(self, in_planes, out_planes, expansion, stride):
@@ -658,6 +846,38 @@ class Block(nn.Module):
                 out = out + x
         return out
 
+    def forward_routed(self, x, routes, bits, grad_bits):
+        """Every sample only goes through its routed precision: the precision-dependent 1x1 convs
+        run once per sub-batch, while the fixed-precision depthwise conv and the BN layers run
+        once on the whole batch instead of once per candidate."""
+        out = F.relu(self.bn1(routed(self.conv1, x, routes, bits, grad_bits)))
+        out = F.relu(self.bn2(self.conv2(out, DWS_BITS, DWS_GRAD_BITS)))
+        out = self.bn3(routed(self.conv3, out, routes, bits, grad_bits))
+
+        if self.stride == 1:
+            if self.shortcut:
+                out = out + self.bn4(routed(self.shortcut, x, routes, bits, grad_bits))
+            else:
+                out = out + x
+        return out
+
+    def forward_candidates(self, x, bits, grad_bits):
+        """forward(x, bits[k], grad_bits[k]) for every candidate k: conv1 and the shortcut conv
+        see the same input for all candidates and go through QConv2d.forward_candidates."""
+        first = self.conv1.forward_candidates(x, bits, grad_bits, bitserial=BITSERIAL_CANDIDATES)
+        if self.stride == 1 and self.shortcut:
+            shortcut = self.shortcut.forward_candidates(x, bits, grad_bits, bitserial=BITSERIAL_CANDIDATES)
+
+        outputs = []
+        for k in range(len(bits)):
+            out = F.relu(self.bn1(first[k]))
+            out = F.relu(self.bn2(self.conv2(out, DWS_BITS, DWS_GRAD_BITS)))
+            out = self.bn3(self.conv3(out, bits[k], grad_bits[k]))
+            if self.stride == 1:
+                out = out + (self.bn4(shortcut[k]) if self.shortcut else x)
+            outputs.append(out)
+        return outputs
+
 
 class MobileNetV2(nn.Module):
     # (expansion, out_planes, num_blocks, stride)
@@ -746,6 +966,10 @@ class MobileNetV2_RNN(nn.Module):
         self.bn2 = nn.BatchNorm2d(1280)
         self.linear = nn.Linear(1280, num_classes)
 
+        # per-layer enabled candidates, set by util_candidates.CandidateManager (None: all)
+        self.candidate_sets = None
+        self.candidate_masks = None
+
         self.control = RNNGate(embed_dim, hidden_dim, proj_dim, rnn_type='lstm')
 
         self.gate_layer1 = nn.Sequential(nn.AvgPool2d(32),
@@ -787,29 +1011,45 @@ class MobileNetV2_RNN(nn.Module):
         masks = []
 
         gate_feature = self.gate_layer1(x)
-        mask = self.control(gate_feature)
+        mask = gate_decision(self, gate_feature, 0)
+        layer = 0
 
         for g in range(7):
             for i in range(self.num_layers[g]):                    
-                output_candidates = []
-                
-                for k in range(len(bits)):
-                    out = getattr(self, 'group{}_layer{}'.format(g+1, i))(x, bits[k], grad_bits[k])
-                    output_candidates.append(out)
-                    
+                block = getattr(self, 'group{}_layer{}'.format(g+1, i))
+
                 mask_list = []
                     
                 for j in range(len(bits)):
                     mask_list.append(mask[:,j,:,:,:])
-                    
-                x = sum([mask_list[k].expand_as(out) * output_candidates[k] for k in range(len(bits))])
+
+                if ROUTED_BLOCKS:
+                    choice, routes = gate_routes(mask)
+                    out = block.forward_routed(x, routes, bits, grad_bits)
+                    # the selected gate output is 1 in the forward pass, and passes the
+                    # straight-through gradient of the chosen candidate to the gate
+                    gate = mask.view(mask.size(0), -1).gather(1, choice.view(-1, 1))
+                    x = gate.view(-1, 1, 1, 1).expand_as(out) * out
+                else:
+                    output_candidates = {}
+
+                    candidates = active_candidates(self, layer, len(bits))
+                    if BITSERIAL_CANDIDATES:
+                        outs = block.forward_candidates(x, [bits[k] for k in candidates], [grad_bits[k] for k in candidates])
+                        output_candidates.update(zip(candidates, outs))
+                    else:
+                        for k in candidates:
+                            output_candidates[k] = block(x, bits[k], grad_bits[k])
+
+                    x = sum([mask_list[k].expand_as(output_candidates[k]) * output_candidates[k] for k in candidates])
                 
                 mask_list = [mask.squeeze() for mask in mask_list]
                 
                 masks.append(mask_list)
+                layer += 1
                     
                 gate_feature = getattr(self, 'group{}_gate{}'.format(g+1, i))(x)
-                mask = self.control(gate_feature)
+                mask = gate_decision(self, gate_feature, layer)
 
         x = F.relu(self.bn2(self.conv2(x, 0, 0)))
 
@@ -0,0 +1,66 @@
+"""Bit-serial evaluation of one conv at several nested input precisions.
+
+The input is quantized once, on the grid of the widest candidate (max_bits) over the shared
+range [zero_point, zero_point + range]. A num_bits candidate keeps the top num_bits bit planes
+of those codes, i.e. it lives on the same grid with a step 2^(max_bits - num_bits) times
+coarser. Since the conv is linear, the output of a wider candidate is the output of the next
+narrower one plus the conv of the extra bit planes:
+
+    conv(x_6) = conv(x_4) + conv(x_6 - x_4)
+
+so the narrowest conv runs once and every further distinct width costs one refinement conv,
+duplicate widths (bits = [3, 4, 4, 6, 6]) cost nothing. The refinement inputs are small
+integers times the shared scale, which is what makes them candidates for low-precision kernels.
+
+Experimental: the nested grid differs slightly from quantizing each candidate independently
+over the same range (step range / (2^b - 1)).
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def nested_codes(input, zero_point, range, max_bits):
+    """Integer codes of input on the max_bits grid and the grid step"""
+    scale = (range / (2. ** max_bits - 1)).clamp(min=1e-8)
+    with torch.no_grad():
+        codes = ((input - zero_point) / scale).round_().clamp_(0, 2. ** max_bits - 1)
+    return codes, scale
+
+
+def truncate_codes(codes, max_bits, num_bits):
+    """Round max_bits codes to their top num_bits bit planes, expressed on the max_bits grid"""
+    step = 2. ** (max_bits - num_bits)
+    with torch.no_grad():
+        return (codes / step).round_().clamp_(0, 2. ** num_bits - 1).mul_(step)
+
+
+def bitserial_conv2d(input, weight, bits, zero_point, range, bias=None, stride=1, padding=0,
+                     dilation=1, groups=1):
+    """F.conv2d of input quantized to every width in bits on the nested grid.
+
+    Returns {num_bits: output} for the distinct entries of bits. A 0 entry is the unquantized
+    conv. Input gradients pass straight through the quantization, as in UniformQuantize.
+    """
+    outputs = {}
+    if 0 in bits:
+        outputs[0] = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
+    widths = sorted(set(b for b in bits if b))
+    if not widths:
+        return outputs
+
+    codes, scale = nested_codes(input, zero_point, range, widths[-1])
+    out, prev_codes = None, None
+    for num_bits in widths:
+        codes_b = truncate_codes(codes, widths[-1], num_bits)
+        if out is None:
+            qinput = codes_b * scale + zero_point
+            # straight-through estimator for the input gradient
+            qinput = input + (qinput - input).detach()
+            out = F.conv2d(qinput, weight, bias, stride, padding, dilation, groups)
+        else:
+            # the extra bit planes only; zero point and bias are already in out
+            out = out + F.conv2d((codes_b - prev_codes) * scale, weight, None, stride, padding, dilation, groups)
+        outputs[num_bits] = out
+        prev_codes = codes_b
+    return outputs
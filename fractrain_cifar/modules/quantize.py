@@ -1,30 +1,69 @@
 from collections import namedtuple
+import contextlib
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd.function import InplaceFunction, Function
+from torch.nn.modules.utils import _pair
+
+from .bitserial import bitserial_conv2d
 
 QParams = namedtuple('QParams', ['range', 'zero_point', 'num_bits'])
 
 _DEFAULT_FLATTEN = (1, -1)
 _DEFAULT_FLATTEN_GRAD = (0, -1)
 
+# activations/gradients in these dtypes are quantized through an fp32 copy
+_LOW_PRECISION = tuple(getattr(torch, name) for name in ('float16', 'bfloat16') if hasattr(torch, name))
+
+
+def autocast(enabled=True, dtype=None):
+    """bf16 autocast for the full-precision regions (stem, fc, num_bits == 0 convs) and the
+    dequantized conv math. Quantization qparams stay fp32. Falls back to a no-op context when
+    the running torch or device has no bf16 autocast."""
+    dtype = dtype or getattr(torch, 'bfloat16', None)
+    if enabled and dtype is not None and hasattr(torch, 'autocast'):
+        device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if device_type == 'cpu' or not hasattr(torch.cuda, 'is_bf16_supported') or torch.cuda.is_bf16_supported():
+            return torch.autocast(device_type, dtype=dtype)
+    return contextlib.ExitStack()
+
 
 def _deflatten_as(x, x_full):
     shape = list(x.shape) + [1] * (x_full.dim() - x.dim())
     return x.view(*shape)
 
 
+def _aminmax(x, dim=None):
+    """single-pass min/max reduction, two passes on torch builds without aminmax"""
+    if dim is None:
+        x, dim = x.reshape(-1), 0
+    if hasattr(torch, 'aminmax'):
+        return torch.aminmax(x, dim=dim)
+    return x.min(dim)[0], x.max(dim)[0]
+
+
 def calculate_qparams(x, num_bits, flatten_dims=_DEFAULT_FLATTEN, reduce_dim=0,  reduce_type='mean', keepdim=False, true_zero=False):
     with torch.no_grad():
+        if x.dtype in _LOW_PRECISION:
+            x = x.float()
+        if reduce_dim == 0 and reduce_type != 'mean':
+            # the extreme of the per-sample extremes is the global one: a single fused pass
+            min_values, max_values = _aminmax(x)
+            shape = [1] * (x.dim() if keepdim else x.dim() - 1)
+            return QParams(range=(max_values - min_values).view(shape), zero_point=min_values.view(shape),
+                           num_bits=num_bits)
+
         x_flat = x.flatten(*flatten_dims)
         if x_flat.dim() == 1:
-            min_values = _deflatten_as(x_flat.min(), x)
-            max_values = _deflatten_as(x_flat.max(), x)
+            min_values, max_values = _aminmax(x_flat)
+            min_values = _deflatten_as(min_values, x)
+            max_values = _deflatten_as(max_values, x)
         else:
-            min_values = _deflatten_as(x_flat.min(-1)[0], x)
-            max_values = _deflatten_as(x_flat.max(-1)[0], x)
+            min_values, max_values = _aminmax(x_flat, dim=-1)
+            min_values = _deflatten_as(min_values, x)
+            max_values = _deflatten_as(max_values, x)
             
         if reduce_dim is not None:
             if reduce_type == 'mean':
@@ -39,6 +78,54 @@ def calculate_qparams(x, num_bits, flatten_dims=_DEFAULT_FLATTEN, reduce_dim=0,
                        num_bits=num_bits)
 
 
+# one flat scratch buffer per (dtype, device), grown to the largest request and viewed to the
+# shape asked for: sub-batches, scatter splits and input resolutions all vary the shapes, a
+# buffer per shape would keep growing
+_workspace = {}
+
+
+def _scratch(like):
+    key = (like.dtype, like.device)
+    buf = _workspace.get(key)
+    if buf is None or buf.numel() < like.numel():
+        _workspace.pop(key, None)
+        buf = _workspace[key] = torch.empty(like.numel(), dtype=like.dtype, device=like.device)
+    return buf[:like.numel()].view(like.shape)
+
+
+def clear_workspace():
+    """Release the pooled quantization scratch buffers"""
+    _workspace.clear()
+
+
+def _uniform_quantize_(output, qparams, signed=False, stochastic=False, dequantize=True):
+    """Quantize output in place. Scale / zero-point math runs in fp32 and the result is
+    written back in the input dtype. Stochastic rounding noise lives in a pooled buffer."""
+    work = output.float() if output.dtype in _LOW_PRECISION else output
+
+    zero_point = qparams.zero_point
+    num_bits = qparams.num_bits
+    qmin = -(2.**(num_bits - 1)) if signed else 0.
+    qmax = qmin + 2.**num_bits - 1.
+    scale = qparams.range / (qmax - qmin)
+
+    scale = scale.clamp(min=1e-8)
+
+    with torch.no_grad():
+        work.add_(qmin * scale - zero_point).div_(scale)
+        if stochastic:
+            work.add_(_scratch(work).uniform_(-0.5, 0.5))
+        # quantize
+        work.clamp_(qmin, qmax).round_()
+
+        if dequantize:
+            work.mul_(scale).add_(
+                zero_point - qmin * scale)  # dequantize
+        if work is not output:
+            output.copy_(work)
+    return output
+
+
 class UniformQuantize(InplaceFunction):
 
     @staticmethod
@@ -58,26 +145,7 @@ class UniformQuantize(InplaceFunction):
             qparams = calculate_qparams(
                 input, num_bits=num_bits, flatten_dims=flatten_dims, reduce_dim=reduce_dim)
 
-        zero_point = qparams.zero_point
-        num_bits = qparams.num_bits
-        qmin = -(2.**(num_bits - 1)) if signed else 0.
-        qmax = qmin + 2.**num_bits - 1.
-        scale = qparams.range / (qmax - qmin)
-
-        min_scale = torch.tensor(1e-8).expand_as(scale).cuda()
-        scale = torch.max(scale, min_scale)
-        
-        with torch.no_grad():
-            output.add_(qmin * scale - zero_point).div_(scale)
-            if stochastic:
-                noise = output.new(output.shape).uniform_(-0.5, 0.5)
-                output.add_(noise)
-            # quantize
-            output.clamp_(qmin, qmax).round_()
-
-            if dequantize:
-                output.mul_(scale).add_(
-                    zero_point - qmin * scale)  # dequantize
+        _uniform_quantize_(output, qparams, signed=signed, stochastic=stochastic, dequantize=dequantize)
         return output
 
     @staticmethod
@@ -91,7 +159,7 @@ class UniformQuantizeGrad(InplaceFunction):
 
     @staticmethod
     def forward(ctx, input, num_bits=None, qparams=None, flatten_dims=_DEFAULT_FLATTEN_GRAD,
-                reduce_dim=0, dequantize=True, signed=False, stochastic=True):
+                reduce_dim=0, dequantize=True, signed=False, stochastic=True, inplace=False):
         ctx.num_bits = num_bits
         ctx.qparams = qparams
         ctx.flatten_dims = flatten_dims
@@ -99,7 +167,7 @@ class UniformQuantizeGrad(InplaceFunction):
         ctx.signed = signed
         ctx.dequantize = dequantize
         ctx.reduce_dim = reduce_dim
-        ctx.inplace = False
+        ctx.inplace = inplace
         return input
 
     @staticmethod
@@ -111,27 +179,138 @@ class UniformQuantizeGrad(InplaceFunction):
                 qparams = calculate_qparams(
                     grad_output, num_bits=ctx.num_bits, flatten_dims=ctx.flatten_dims, reduce_dim=ctx.reduce_dim, reduce_type='extreme')
 
-            grad_input = quantize(grad_output, num_bits=None,
-                                  qparams=qparams, flatten_dims=ctx.flatten_dims, reduce_dim=ctx.reduce_dim,
-                                  dequantize=True, signed=ctx.signed, stochastic=ctx.stochastic, inplace=False)
-        return grad_input, None, None, None, None, None, None, None
+            if qparams.num_bits:
+                # inplace: the caller guarantees grad_output is not shared with another branch
+                inplace = ctx.inplace and grad_output.is_contiguous()
+                grad_input = grad_output if inplace else grad_output.clone()
+                _uniform_quantize_(grad_input, qparams, signed=ctx.signed, stochastic=ctx.stochastic,
+                                   dequantize=ctx.dequantize)
+            else:
+                grad_input = grad_output
+        return grad_input, None, None, None, None, None, None, None, None
+
+
+def _aten_op(name):
+    """torch.ops.aten.<name> if the running torch has it, else None"""
+    try:
+        return getattr(torch.ops.aten, name)
+    except (AttributeError, RuntimeError):
+        return None
+
+
+# one entry point for both conv gradients (torch >= 1.11); older versions use torch.nn.grad
+_convolution_backward = _aten_op('convolution_backward')
+
+
+def _conv2d_grad_input(input, weight, grad_output, stride, padding, dilation, groups):
+    if _convolution_backward is not None:
+        return _convolution_backward(grad_output, input, weight, None, stride, padding, dilation,
+                                     False, [0, 0], groups, [True, False, False])[0]
+    return torch.nn.grad.conv2d_input(input.shape, weight, grad_output, stride, padding, dilation, groups)
+
+
+def _conv2d_grad_weight(input, weight, grad_output, stride, padding, dilation, groups):
+    if _convolution_backward is not None:
+        return _convolution_backward(grad_output, input, weight, None, stride, padding, dilation,
+                                     False, [0, 0], groups, [False, True, False])[1]
+    return torch.nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
+
+
+def _quantize_grad_tensor(grad_output, num_bits, flatten_dims):
+    """What quantize_grad does to the gradient reaching it, applied directly and out of place"""
+    if not num_bits:
+        return grad_output
+    with torch.no_grad():
+        qparams = calculate_qparams(grad_output, num_bits=num_bits, flatten_dims=flatten_dims,
+                                    reduce_dim=0, reduce_type='extreme')
+        grad = grad_output.clone()
+        _uniform_quantize_(grad, qparams, stochastic=True)
+    return grad
+
+
+class Conv2dQuantAct(Function):
+    """conv2d(input_fw, weight, bias) with one forward conv and separately quantized gradients.
+
+    The input gradient is computed from the incoming gradient quantized to error_bits, the
+    weight and bias gradients from the incoming gradient quantized to gc_bits and the
+    activation input_bw, which receives no gradient itself. Only input_bw and weight are saved.
+    """
+
+    @staticmethod
+    def forward(ctx, input_fw, input_bw, weight, bias, stride, padding, dilation, groups,
+                error_bits, gc_bits, error_flatten_dims, gc_flatten_dims):
+        output = F.conv2d(input_fw, weight, bias, stride, padding, dilation, groups)
+        ctx.conf = (_pair(stride), _pair(padding), _pair(dilation), groups)
+        ctx.grad_bits = (error_bits, gc_bits, error_flatten_dims, gc_flatten_dims)
+        ctx.dtypes = (input_fw.dtype, weight.dtype, bias.dtype if bias is not None else None)
+        # backward runs in the precision the conv ran in (bf16 under autocast)
+        ctx.save_for_backward(input_bw.to(output.dtype), weight.to(output.dtype))
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input_bw, weight = ctx.saved_tensors
+        stride, padding, dilation, groups = ctx.conf
+        error_bits, gc_bits, error_flatten_dims, gc_flatten_dims = ctx.grad_bits
+        input_dtype, weight_dtype, bias_dtype = ctx.dtypes
+        grad_output = grad_output.to(weight.dtype)
+
+        grad_input = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_error = _quantize_grad_tensor(grad_output, error_bits, error_flatten_dims)
+            grad_input = _conv2d_grad_input(input_bw, weight, grad_error,
+                                            stride, padding, dilation, groups).to(input_dtype)
+        if ctx.needs_input_grad[2] or ctx.needs_input_grad[3]:
+            grad_gc = _quantize_grad_tensor(grad_output, gc_bits, gc_flatten_dims)
+            if ctx.needs_input_grad[2]:
+                grad_weight = _conv2d_grad_weight(input_bw, weight, grad_gc,
+                                                  stride, padding, dilation, groups).to(weight_dtype)
+            if ctx.needs_input_grad[3]:
+                grad_bias = grad_gc.sum((0, 2, 3)).to(bias_dtype)
+        return grad_input, None, grad_weight, grad_bias, None, None, None, None, None, None, None, None
+
+
+class LinearQuantAct(Function):
+    """linear(input_fw, weight, bias) with separately quantized gradients, see Conv2dQuantAct"""
+
+    @staticmethod
+    def forward(ctx, input_fw, input_bw, weight, bias, error_bits, gc_bits, error_flatten_dims, gc_flatten_dims):
+        output = F.linear(input_fw, weight, bias)
+        ctx.grad_bits = (error_bits, gc_bits, error_flatten_dims, gc_flatten_dims)
+        ctx.dtypes = (input_fw.dtype, weight.dtype, bias.dtype if bias is not None else None)
+        ctx.save_for_backward(input_bw.to(output.dtype), weight.to(output.dtype))
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input_bw, weight = ctx.saved_tensors
+        error_bits, gc_bits, error_flatten_dims, gc_flatten_dims = ctx.grad_bits
+        input_dtype, weight_dtype, bias_dtype = ctx.dtypes
+        grad_output = grad_output.to(weight.dtype)
+
+        grad_input = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_error = _quantize_grad_tensor(grad_output, error_bits, error_flatten_dims)
+            grad_input = grad_error.matmul(weight).to(input_dtype)
+        if ctx.needs_input_grad[2] or ctx.needs_input_grad[3]:
+            grad_gc = _quantize_grad_tensor(grad_output, gc_bits, gc_flatten_dims)
+            grad_gc = grad_gc.reshape(-1, grad_gc.size(-1))
+            if ctx.needs_input_grad[2]:
+                grad_weight = grad_gc.t().mm(input_bw.reshape(-1, input_bw.size(-1))).to(weight_dtype)
+            if ctx.needs_input_grad[3]:
+                grad_bias = grad_gc.sum(0).to(bias_dtype)
+        return grad_input, None, grad_weight, grad_bias, None, None, None, None
 
 
 def conv2d_biprec(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, num_bits_grad=None):
-    out1 = F.conv2d(input.detach(), weight, bias,
-                    stride, padding, dilation, groups)
-    out2 = F.conv2d(input, weight.detach(), bias.detach() if bias is not None else None,
-                    stride, padding, dilation, groups)
-    out2 = quantize_grad(out2, num_bits=num_bits_grad, flatten_dims=(1, -1))
-    return out1 + out2 - out1.detach()
+    # quantized gradient for the input, full-precision one for weight and bias
+    return Conv2dQuantAct.apply(input, input, weight, bias, stride, padding, dilation, groups,
+                                num_bits_grad, None, (1, -1), _DEFAULT_FLATTEN_GRAD)
 
 
 def linear_biprec(input, weight, bias=None, num_bits_grad=None):
-    out1 = F.linear(input.detach(), weight, bias)
-    out2 = F.linear(input, weight.detach(), bias.detach()
-                    if bias is not None else None)
-    out2 = quantize_grad(out2, num_bits=num_bits_grad)
-    return out1 + out2 - out1.detach()
+    return LinearQuantAct.apply(input, input, weight, bias,
+                                num_bits_grad, None, _DEFAULT_FLATTEN_GRAD, _DEFAULT_FLATTEN_GRAD)
 
 
 def quantize(x, num_bits=None, qparams=None, flatten_dims=_DEFAULT_FLATTEN, reduce_dim=0, dequantize=True, signed=False, stochastic=False, inplace=False):
@@ -144,12 +323,12 @@ def quantize(x, num_bits=None, qparams=None, flatten_dims=_DEFAULT_FLATTEN, redu
     return x
 
 
-def quantize_grad(x, num_bits=None, qparams=None, flatten_dims=_DEFAULT_FLATTEN_GRAD, reduce_dim=0, dequantize=True, signed=False, stochastic=True):
+def quantize_grad(x, num_bits=None, qparams=None, flatten_dims=_DEFAULT_FLATTEN_GRAD, reduce_dim=0, dequantize=True, signed=False, stochastic=True, inplace=False):
     if qparams:
         if qparams.num_bits:
-            return UniformQuantizeGrad().apply(x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic)
+            return UniformQuantizeGrad().apply(x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic, inplace)
     elif num_bits:
-        return UniformQuantizeGrad().apply(x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic)
+        return UniformQuantizeGrad().apply(x, num_bits, qparams, flatten_dims, reduce_dim, dequantize, signed, stochastic, inplace)
     
     return x
 
@@ -170,10 +349,14 @@ class QuantMeasure(nn.Module):
         self.dequantize = dequantize
         self.stochastic = stochastic
         self.inplace = inplace
-
-    def forward(self, input, num_bits, qparams=None):
-
-        if self.training or self.measure:
+        # when False, training steps quantize with the running statistics instead of re-measuring
+        self.update_running = True
+        # list collecting per-batch input (min, max) during a calibration pass, see calibrate()
+        self.calibration = None
+
+    def measure_qparams(self, input, num_bits, qparams=None):
+        """The qparams forward() quantizes input with, updating the running statistics"""
+        if self.measure or (self.training and self.update_running):
             if qparams is None:
                 qparams = calculate_qparams(
                     input, num_bits=num_bits, flatten_dims=self.flatten_dims, reduce_dim=0, reduce_type='extreme')
@@ -187,9 +370,18 @@ class QuantMeasure(nn.Module):
                     qparams.zero_point * (1 - momentum))
                 self.running_range.mul_(momentum).add_(
                     qparams.range * (1 - momentum))
-        else:
+        elif qparams is None:
             qparams = QParams(range=self.running_range,
                               zero_point=self.running_zero_point, num_bits=num_bits)
+        return qparams
+
+    def forward(self, input, num_bits, qparams=None):
+        if self.calibration is not None:
+            with torch.no_grad():
+                self.calibration.append(torch.stack(_aminmax(input.float())))
+            return input
+
+        qparams = self.measure_qparams(input, num_bits, qparams)
         if self.measure:
             return input
         else:
@@ -198,6 +390,14 @@ class QuantMeasure(nn.Module):
             return q_input
 
 
+def _register_cache(module, name, tensor):
+    # a cache is not model state: kept out of the state_dict where torch supports it (1.6+)
+    try:
+        module.register_buffer(name, tensor, persistent=False)
+    except TypeError:
+        module.register_buffer(name, tensor)
+
+
 class QConv2d(nn.Conv2d):
     """docstring for QConv2d."""
 
@@ -215,10 +415,30 @@ class QConv2d(nn.Conv2d):
         self.weight_bits = weight_bits
         self.fix_prec = fix_prec
         self.stride = stride
+        self.update_running = True
+        # the cached channel ranges live in buffers updated in place: under nn.DataParallel the
+        # module attributes set in forward land on a throw-away replica, while replica 0 shares
+        # its buffers with the wrapped module (as the BN running statistics do)
+        _register_cache(self, 'cached_weight_range', torch.zeros(out_channels, 1, 1, 1))
+        _register_cache(self, 'cached_weight_zero_point', torch.zeros(out_channels, 1, 1, 1))
+        # set by set_running_stats_update on the wrapped module, False until a step measured them
+        self.weight_qparams_cached = False
+
+    def weight_qparams(self, num_bits):
+        """Per-output-channel weight qparams. During training they are only re-measured on steps
+        with update_running set, otherwise the cached channel ranges are reused."""
+        if not self.training or self.update_running:
+            qparams = calculate_qparams(self.weight, num_bits=num_bits, flatten_dims=(1, -1), reduce_dim=None)
+            if self.training:
+                self.cached_weight_range.copy_(qparams.range.view_as(self.cached_weight_range))
+                self.cached_weight_zero_point.copy_(qparams.zero_point.view_as(self.cached_weight_zero_point))
+            return qparams
+        return QParams(range=self.cached_weight_range, zero_point=self.cached_weight_zero_point, num_bits=num_bits)
 
 
     def forward(self, input, num_bits, num_grad_bits):
         if num_bits == 0:
+            # full-precision fallback, runs in bf16 under autocast()
             output = F.conv2d(input, self.weight, self.bias, self.stride,self.padding, self.dilation, self.groups)
             return output
 
@@ -231,7 +451,7 @@ class QConv2d(nn.Conv2d):
 
         if self.fix_prec:
             if self.quant_act_forward or self.quant_act_backward or self.quant_grad_act_error or self.quant_grad_act_gc or self.weight_bits:
-                weight_qparams = calculate_qparams(self.weight, num_bits=self.weight_bits, flatten_dims=(1, -1), reduce_dim=None)
+                weight_qparams = self.weight_qparams(self.weight_bits)
                 qweight = quantize(self.weight, qparams=weight_qparams)
 
                 qinput_fw = self.quantize_input_fw(input, self.quant_act_forward)
@@ -243,19 +463,20 @@ class QConv2d(nn.Conv2d):
 
             else:
                 qinput = self.quantize_input_fw(input, num_bits)
-                weight_qparams = calculate_qparams(self.weight, num_bits=num_bits, flatten_dims=(1, -1), reduce_dim=None)
+                weight_qparams = self.weight_qparams(num_bits)
                 qweight = quantize(self.weight, qparams=weight_qparams)
                 output = F.conv2d(qinput, qweight, qbias, self.stride, self.padding, self.dilation, self.groups)
-                output = quantize_grad(output, num_bits=num_grad_bits, flatten_dims=(1, -1))
+                output = quantize_grad(output, num_bits=num_grad_bits, flatten_dims=(1, -1), inplace=True)
                 
             return output
 
-        weight_qparams = calculate_qparams(self.weight, num_bits=self.weight_bits, flatten_dims=(1, -1), reduce_dim=None)
+        weight_qparams = self.weight_qparams(self.weight_bits)
         qweight = quantize(self.weight, qparams=weight_qparams)
 
         qinput = self.quantize_input_fw(input, num_bits)
         output = F.conv2d(qinput, qweight, qbias, self.stride, self.padding, self.dilation, self.groups)
-        output = quantize_grad(output, num_bits=num_grad_bits, flatten_dims=(1, -1))
+        # the conv output only feeds a BN layer, so its incoming gradient can be quantized in place
+        output = quantize_grad(output, num_bits=num_grad_bits, flatten_dims=(1, -1), inplace=True)
 
         # if self.quant_act_forward == -1:
         #     qinput_fw = self.quantize_input_fw(input, num_bits)
@@ -282,14 +503,121 @@ class QConv2d(nn.Conv2d):
         return output
 
 
+    def forward_candidates(self, input, bits, grad_bits, bitserial=False):
+        """Outputs for every (bits[k], grad_bits[k]) candidate on a shared input.
+
+        By default one independent forward per candidate. With bitserial=True (experimental)
+        the input is quantized once on the grid of the widest candidate, the narrowest conv
+        runs once and each wider distinct width refines it by its extra bit planes, see
+        modules/bitserial.py. Only the plain quantized path without bias and without a
+        full-precision (0-bit) candidate supports it. models.BITSERIAL_CANDIDATES selects it
+        for the gated blocks.
+        """
+        if not bitserial or self.fix_prec or self.bias is not None or 0 in bits:
+            return [self.forward(input, bits[k], grad_bits[k]) for k in range(len(bits))]
+
+        qparams = self.quantize_input_fw.measure_qparams(input, max(bits))
+        qweight = quantize(self.weight, qparams=self.weight_qparams(self.weight_bits))
+        outputs = bitserial_conv2d(input, qweight, bits, qparams.zero_point, qparams.range,
+                                   stride=self.stride, padding=self.padding, dilation=self.dilation,
+                                   groups=self.groups)
+        # candidates sharing a width share the forward result but keep their own gradient precision
+        return [quantize_grad(outputs[bits[k]], num_bits=grad_bits[k], flatten_dims=(1, -1)) for k in range(len(bits))]
+
+
     def conv2d_quant_act(self, input_fw, input_bw, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, error_bits=0, gc_bits=0):
-        out1 = F.conv2d(input_fw, weight.detach(), bias.detach() if bias is not None else None,
-                        stride, padding, dilation, groups)
-        out2 = F.conv2d(input_bw.detach(), weight, bias,
-                        stride, padding, dilation, groups)
-        out1 = quantize_grad(out1, num_bits=error_bits)
-        out2 = quantize_grad(out2, num_bits=gc_bits)
-        return out1 + out2 - out2.detach()
+        # forward on input_fw; input gradient from the error_bits gradient, weight gradient
+        # from input_bw and the gc_bits gradient
+        return Conv2dQuantAct.apply(input_fw, input_bw, weight, bias, stride, padding, dilation, groups,
+                                    error_bits, gc_bits, _DEFAULT_FLATTEN_GRAD, _DEFAULT_FLATTEN_GRAD)
+
+
+def set_running_stats_update(model, update):
+    """Choose whether the quantizers re-measure activation/weight ranges on the coming step
+    (update=True) or reuse their running statistics (update=False). Call it on the wrapped
+    model before the forward: the first step after a start or restart always measures the
+    weight ranges, the cache is not part of the checkpoint."""
+    for m in model.modules():
+        if isinstance(m, QuantMeasure):
+            m.update_running = update
+        elif isinstance(m, QConv2d):
+            m.update_running = update or not m.weight_qparams_cached
+            m.weight_qparams_cached = True
+
+
+def set_weight_bits(model, num_bits):
+    """Set the weight precision of every QConv2d, e.g. on a weight_bits schedule phase switch"""
+    for m in model.modules():
+        if isinstance(m, QConv2d):
+            m.weight_bits = num_bits
+
+
+def _module_name(name):
+    # calibration artifacts are keyed without the DataParallel / DistributedDataParallel prefix
+    return name[len('module.'):] if name.startswith('module.') else name
+
+
+def calibrate(model, loader, *model_args, num_batches=200):
+    """Stream num_batches batches of loader through model(input, *model_args) and
+    collect the per-batch min/max of every QuantMeasure input in one forward per batch.
+    Activations stay in full precision during the pass and the model state is left untouched.
+
+    model_args must select a quantized path (nonzero precision), otherwise QConv2d skips its
+    QuantMeasures. Returns the calibration artifact
+    {QuantMeasure name: {'min': tensor(num_observations), 'max': tensor(num_observations)}},
+    which can be saved with torch.save and applied with load_calibration.
+
+    A DataParallel / DistributedDataParallel model is calibrated through its wrapped module:
+    replicas share the module's calibration lists and would append per-shard statistics from
+    every device, and the DDP forward would wait for ranks that do not calibrate.
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module
+    measures = [(_module_name(name), m) for name, m in model.named_modules() if isinstance(m, QuantMeasure)]
+    for _, m in measures:
+        m.calibration = []
+    # BN / RangeBN running statistics move in train mode, restore them afterwards
+    buffers = [(b, b.clone()) for b in model.buffers()]
+    training = model.training
+    model.train()
+
+    try:
+        with torch.no_grad():
+            for i, (input, _) in enumerate(loader):
+                if i == num_batches:
+                    break
+                model(input.cuda(non_blocking=True), *model_args)
+    finally:
+        model.train(training)
+        for b, saved in buffers:
+            b.copy_(saved)
+        artifact = {}
+        for name, m in measures:
+            if m.calibration:
+                observed = torch.stack(m.calibration).cpu()
+                artifact[name] = {'min': observed[:, 0], 'max': observed[:, 1]}
+            m.calibration = None
+    return artifact
+
+
+def load_calibration(model, artifact, reduce_type='mean'):
+    """Initialize the running range / zero point of every QuantMeasure from a calibration
+    artifact: the mean of the per-batch extremes (what the running average converges to during
+    training), or with reduce_type='extreme' the global min/max of the calibration set.
+    Returns the number of initialized QuantMeasures."""
+    count = 0
+    for name, m in model.named_modules():
+        stats = artifact.get(_module_name(name)) if isinstance(m, QuantMeasure) else None
+        if stats is None:
+            continue
+        if reduce_type == 'mean':
+            min_value, max_value = stats['min'].mean(), stats['max'].mean()
+        else:
+            min_value, max_value = stats['min'].min(), stats['max'].max()
+        m.running_zero_point.fill_(float(min_value))
+        m.running_range.fill_(float(max_value - min_value))
+        count += 1
+    return count
 
 
 class QLinear(nn.Linear):
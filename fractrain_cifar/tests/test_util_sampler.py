@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util_sampler import RouteBucketSampler
+
+
+def make_sampler(epoch, route_epoch, drop_last=False):
+    # 9 routes of 10 samples and 1 route of 5: with mix = 0 every route fills whole batches,
+    # and the 5 samples of the largest route make the short last batch
+    keys = np.repeat(np.arange(10), [10] * 9 + [5])
+    sampler = RouteBucketSampler(list(range(len(keys))), 10, num_layers=2, seed=0, drop_last=drop_last, mix=0)
+    sampler.routes[:, 0] = keys
+    sampler.routes[:, 1] = 0
+    sampler.route_epoch[:] = route_epoch
+    sampler.set_epoch(epoch)
+    return sampler, keys
+
+
+def test_every_batch_has_a_single_route():
+    for epoch in range(1, 6):
+        # routes recorded in the previous pass are fresh
+        sampler, keys = make_sampler(epoch, epoch - 1)
+        batches = list(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(keys)))
+        for batch in batches:
+            assert len(set(keys[batch])) == 1
+        assert len(batches[-1]) == 5
+
+
+def test_drop_last_drops_the_short_batch():
+    sampler, keys = make_sampler(1, 0, drop_last=True)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 9
+    for batch in batches:
+        assert len(batch) == 10
+        assert len(set(keys[batch])) == 1
+
+
+def test_stale_routes_are_spread_randomly():
+    # routes older than max_age are ignored: every sample gets a random position
+    sampler, keys = make_sampler(5, 0)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(keys)))
+    mixed = sum(len(set(keys[batch])) > 1 for batch in batches)
+    assert mixed >= len(batches) // 2
@@ -13,6 +13,9 @@ import time
 import logging
 
 import models
+from util_optim import trainable_parameters, make_sgd
+from util_schedule import ScheduleEngine
+from modules.quantize import autocast, set_running_stats_update
 from data import *
 
 import util_swa
@@ -64,6 +67,8 @@ def parse_args():
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=[32000, 48000], type=int, nargs='*',
+                        help='iterations at which the piecewise learning rate decays by step_ratio')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
@@ -94,9 +99,17 @@ def parse_args():
                         help='precision of weight')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
     parser.add_argument('--swa_start', type=float, default=None, help='SWA start step number')
     parser.add_argument('--swa_freq', type=float, default=1170,
                         help='SWA model collection frequency')
+    parser.add_argument('--swa_bn_batches', type=int, default=20,
+                        help='recalibrate SWA BN statistics on this many cached training batches, '
+                             'with a full pass over the training set only at the end (0: always full pass)')
     args = parser.parse_args()
     return args
 
@@ -156,6 +169,8 @@ def run_training(args):
 
     # best_full_prec = 0
 
+    schedule = make_schedule(args)
+
     if args.resume:
         if os.path.isfile(args.resume):
             logging.info('=> loading checkpoint `{}`'.format(args.resume))
@@ -163,6 +178,8 @@ def run_training(args):
             args.start_iter = checkpoint['iter']
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
 
             if args.swa_start is not None:
                 swa_state_dict = checkpoint['swa_state_dict']
@@ -197,15 +214,17 @@ def run_training(args):
         swa_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir,
                                       batch_size=args.batch_size,
-                                      shuffle=False,
+                                      shuffle=True,
                                       num_workers=args.workers)
+        swa_bn_batches = util_swa.cache_bn_batches(swa_loader, args.swa_bn_batches) if args.swa_bn_batches else swa_loader
 
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params, args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
 
     # optimizer = torch.optim.Adam(model.parameters(), args.lr,
     #                             weight_decay=args.weight_decay)
@@ -225,8 +244,12 @@ def run_training(args):
             data_time.update(time.time() - end)
 
             model.train()
-            adjust_learning_rate(args, optimizer, i)
-            adjust_precision(args, i)
+            set_running_stats_update(model, i % args.qparams_every == 0)
+            lr, phase_changed = schedule.apply(i, args, optimizer)
+            if i % args.eval_every == 0:
+                logging.info('Iter [{}] learning rate = {}'.format(i, lr))
+            if phase_changed:
+                logging.info('Iter [{}] num_bits = {} num_grad_bits = {}'.format(i, args.num_bits, args.num_grad_bits))
 
             i += 1
 
@@ -240,7 +263,9 @@ def run_training(args):
             target_var = Variable(target).cuda()
 
             # compute output
-            output = model(input_var, args.num_bits, args.num_grad_bits)
+            with autocast(args.bf16):
+                output = model(input_var, args.num_bits, args.num_grad_bits)
+            output = output.float()
             loss = criterion(output, target_var)
 
             # measure accuracy and record loss
@@ -273,10 +298,14 @@ def run_training(args):
                 )
 
 
-            if args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0:
+            swa_collect = args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0
+            swa_final = args.swa_start is not None and i == args.iters and (swa_n > 0 or swa_collect)
+            if swa_collect:
                 util_swa.moving_average(swa_model, model, 1.0 / (swa_n + 1))
                 swa_n += 1
-                util_swa.bn_update(swa_loader, swa_model, args.num_bits, args.num_grad_bits)
+            if swa_collect or swa_final:
+                # cheap BN recalibration on the cached batches, one full pass over the training set at the end
+                util_swa.bn_update(swa_loader if swa_final else swa_bn_batches, swa_model, args.num_bits, args.num_grad_bits)
                 prec1 = validate(args, test_loader, swa_model, criterion, i, swa=True)
 
                 if prec1 > best_swa_prec:
@@ -307,6 +336,7 @@ def run_training(args):
                     'arch': args.arch,
                     'state_dict': model.state_dict(),
                     'best_prec1': best_prec1,
+                    'schedule': schedule.state_dict(),
                     'swa_state_dict' : swa_model.state_dict() if args.swa_start is not None else None,
                     'swa_n' : swa_n if args.swa_start is not None else None,
                     'best_swa_prec' : best_swa_prec if args.swa_start is not None else None,
@@ -451,62 +481,14 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-schedule_cnt = 0
-def adjust_precision(args, _iter):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.num_bits_schedule) == len(args.schedule) + 1
-        assert len(args.num_grad_bits_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.num_bits = args.num_bits_schedule[0] 
-            args.num_grad_bits = args.num_grad_bits_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _iter == step:
-                args.num_bits = args.num_bits_schedule[schedule_cnt]
-                args.num_grad_bits = args.num_grad_bits_schedule[schedule_cnt] 
-                schedule_cnt += 1
-
-        if _iter % args.eval_every == 0:
-            logging.info('Iter [{}] num_bits = {} num_grad_bits = {}'.format(_iter, args.num_bits, args.num_grad_bits))
-
-
-def adjust_learning_rate(args, optimizer, _iter):
-    if args.lr_schedule == 'piecewise':
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif 32000 <= _iter < 48000:
-            lr = args.lr * (args.step_ratio ** 1)
-        elif _iter >= 48000:
-            lr = args.lr * (args.step_ratio ** 2)
-        else:
-            lr = args.lr
-
-    elif args.lr_schedule == 'linear':
-        t = _iter / args.iters
-        lr_ratio = 0.01
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif t < 0.5:
-            lr = args.lr
-        elif t < 0.9:
-            lr = args.lr * (1 - (1-lr_ratio)*(t-0.5)/0.4)
-        else:
-            lr = args.lr * lr_ratio
-
-    elif args.lr_schedule == 'anneal_cosine':
-        lr_min = args.lr * (args.step_ratio ** 2)
-        lr_max = args.lr
-        lr = lr_min + 1/2 * (lr_max - lr_min) * (1 + np.cos(_iter/args.iters * 3.141592653))
-
-    if _iter % args.eval_every == 0:
-        logging.info('Iter [{}] learning rate = {}'.format(_iter, lr))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+def make_schedule(args):
+    # --warm_up never applied to the cosine schedule, keep its lr curve unchanged
+    warm_up = 400 if args.warm_up and args.lr_schedule != 'anneal_cosine' else 0
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps, step_ratio=args.step_ratio,
+                          total=args.iters, warm_up=warm_up, linear_range=(0.5, 0.9),
+                          phases={'num_bits': args.num_bits_schedule,
+                                  'num_grad_bits': args.num_grad_bits_schedule} if args.schedule else None,
+                          phase_by='step', phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -6,7 +6,6 @@ import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
 
 import os
-import shutil
 import argparse
 import time
 import logging
@@ -14,12 +13,18 @@ import numpy as np
 import json
 
 import models
+from compute_flops import load_model_info
+from util_cost import proxy_cost_tables, load_cost_table
+from util_optim import trainable_parameters, make_sgd, unscale_grads_
+from util_schedule import ScheduleEngine
+from util_checkpoint import get_rng_state, set_rng_state, resume_data_position, data_sampler, AsyncCheckpointWriter
+from util_telemetry import DecisionTelemetry
+from util_candidates import CandidateManager
+from modules.quantize import autocast, set_running_stats_update, set_weight_bits
 from data import *
 
 import util_swa
 
-from functools import reduce
-
 
 model_names = sorted(name for name in models.__dict__
                      if name.islower() and not name.startswith('__')
@@ -70,12 +75,18 @@ def parse_args():
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=[32000, 48000], type=int, nargs='*',
+                        help='iterations at which the piecewise learning rate decays by step_ratio')
+    parser.add_argument('--phase_by', default='step', type=str, choices=['step', 'turning_point'],
+                        help='switch precision / target ratio phases at --schedule steps or at loss turning points')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
     parser.add_argument('--save_folder', default='save_checkpoints',
                         type=str,
                         help='folder to save the checkpoints')
+    parser.add_argument('--keep_last', default=3, type=int,
+                        help='number of per-eval checkpoints to keep, 0 keeps all (default: 3)')
     parser.add_argument('--eval_every', default=390, type=int,
                         help='evaluate model every (default: 1000) iterations')
     parser.add_argument('--verbose', action="store_true",
@@ -112,6 +123,11 @@ def parse_args():
                         help='schedule for weight precision')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')   
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
     parser.add_argument('--relax', default=0, type=float,
                         help='relax parameter for target ratio') 
     parser.add_argument('--loss_sf', default=None, type=float,
@@ -119,14 +135,63 @@ def parse_args():
     parser.add_argument('--finetune_step', default=0, type=int,
                     help='num steps to finetune with full precision')
     parser.add_argument('--conv_info', default='', type=str,
-                    help='load the layerwise flops information')
+                    help='load the layerwise flops information (default: computed for the arch and cached in --model_info_dir)')
+    parser.add_argument('--model_info_dir', default='model_info', type=str,
+                    help='cache of the per-arch layerwise flops information')
+    parser.add_argument('--cost_model', default='proxy', type=str,
+                    help='relative cost of the candidate precisions: proxy (bit-width scaling), measured '
+                         '(per-layer QConv2d timings on this machine, benchmarked once and cached in '
+                         '--model_info_dir) or the path of a cost table written by util_cost.py')
     parser.add_argument('--dws_bits', default=8, type=int,
                     help='precision for dws conv weight and activation')
     parser.add_argument('--dws_grad_bits', default=16, type=int,
                     help='precision for dws conv error and gradient')
+    parser.add_argument('--routed', default=False, action='store_true',
+                        help='run each sample only through its gate-selected precision, with the BN layers '
+                             '(and the depthwise conv of MobileNetV2_RNN) computed once per block')
+    parser.add_argument('--route_bucket', default=0, type=int,
+                        help='with --routed, pad every per-precision sub-batch to a multiple of this size '
+                             'so the convs only see a few shapes (0: off)')
+    parser.add_argument('--bitserial', default=False, action='store_true',
+                        help='without --routed, evaluate the candidates of a gated block together and run '
+                             'its input convs bit-serially, one conv plus one refinement per extra width '
+                             '(experimental, see modules/bitserial.py)')
+    parser.add_argument('--route_batches', default=False, action='store_true',
+                        help='batch training samples with similar cached per-layer precision routes, '
+                             'for large homogeneous sub-batches with --routed')
+    parser.add_argument('--route_max_age', default=1, type=int,
+                        help='with --route_batches, ignore cached routes older than this many epochs')
+    parser.add_argument('--route_mix', default=0.25, type=float,
+                        help='with --route_batches, fraction of the samples placed at random positions '
+                             'regardless of their route')
+    parser.add_argument('--capacity_factor', default=0, type=float,
+                        help='cap the samples per precision candidate at capacity_factor * batch / candidates '
+                             'during training, rerouting the rest (>= 1; 0: off)')
+    parser.add_argument('--capacity_policy', default='cheaper', type=str, choices=['cheaper', 'dearer'],
+                        help='candidates the samples over capacity are rerouted to first: the next cheaper '
+                             'or the next dearer precision (candidates are ordered by cost)')
     parser.add_argument('--swa_start', type=float, default=None, help='SWA start step number')
     parser.add_argument('--swa_freq', type=float, default=1170,
                         help='SWA model collection frequency')
+    parser.add_argument('--swa_bn_batches', type=int, default=20,
+                        help='recalibrate SWA BN statistics on this many cached training batches, '
+                             'with a full pass over the training set only at the end (0: always full pass)')
+    parser.add_argument('--compile', default=False, action='store_true',
+                        help='compile forward, loss, backward and optimizer step with static shapes')
+    parser.add_argument('--telemetry_every', default=0, type=int,
+                        help='append the per-layer and per-class gate decision counts to decisions_train.bin every '
+                             'this many iterations, and those of each validation to decisions_val.bin (0: off)')
+    parser.add_argument('--candidate_threshold', default=0, type=float,
+                        help='stop running the candidates a layer picks less often than this fraction of '
+                             'its samples (EMA of the decisions, RNN gates only; 0: off)')
+    parser.add_argument('--candidate_ema', default=0.99, type=float,
+                        help='EMA momentum of the per-layer candidate selection frequencies')
+    parser.add_argument('--candidate_check_every', default=100, type=int,
+                        help='update the enabled candidates every this many iterations')
+    parser.add_argument('--candidate_explore_every', default=2000, type=int,
+                        help='re-enable every candidate for exploration every this many iterations (0: never)')
+    parser.add_argument('--candidate_explore_steps', default=100, type=int,
+                        help='length of an exploration window, in iterations')
     args = parser.parse_args()
     return args
 
@@ -142,6 +207,11 @@ def main():
 
     models.DWS_BITS = args.dws_bits
     models.DWS_GRAD_BITS = args.dws_grad_bits
+    models.ROUTED_BLOCKS = args.routed
+    models.ROUTE_BUCKET = args.route_bucket
+    models.BITSERIAL_CANDIDATES = args.bitserial
+    models.CAPACITY_FACTOR = args.capacity_factor
+    models.CAPACITY_POLICY = args.capacity_policy
     
     save_path = args.save_path = os.path.join(args.save_folder, args.arch)
     os.makedirs(save_path, exist_ok=True)
@@ -182,36 +252,54 @@ bits = [3, 4, 4, 6, 6]
 grad_bits = [6, 6, 8, 8, 12]
 
 
-if args.conv_info or 'mobilenet' in args.arch:
-    conv_info = np.load(args.conv_info, allow_pickle=True).item()['conv']
+if args.conv_info:
+    model_info = np.load(args.conv_info, allow_pickle=True).item()
+else:
+    # per-gated-layer flops of the arch at the CIFAR input size, cached on disk
+    model_info = load_model_info(args.arch, args.dataset, resolution=32, cache_dir=args.model_info_dir)
 
-    dws_info = np.load(args.conv_info, allow_pickle=True).item()['dws']
-    dws_flops_fw = sum(dws_info) * args.dws_bits * args.dws_bits /32 /32
-    dws_flops_gc = dws_flops_eb = sum(dws_info) * args.dws_bits * args.dws_grad_bits /32 /32 
-    dws_flops_total = dws_flops_fw + dws_flops_eb + dws_flops_gc
+conv_info = model_info['conv']
 
-else:
-    conv_info = None
-    dws_flops_total = dws_flops_fw = dws_flops_gc = dws_flops_eb = 0
+dws_info = model_info['dws']
+dws_flops_fw = sum(dws_info) * args.dws_bits * args.dws_bits /32 /32
+dws_flops_gc = dws_flops_eb = sum(dws_info) * args.dws_bits * args.dws_grad_bits /32 /32 
+dws_flops_total = dws_flops_fw + dws_flops_eb + dws_flops_gc
 
 
-def run_training(args):
-    global conv_info
+def computation_cost_tables(args):
+    """Relative fw/eb/gc cost of each candidate precision as device tensors: (candidate,) for the
+    bit-width proxy, (layer, candidate) for a measured cost table"""
+    if args.cost_model == 'proxy':
+        tables = proxy_cost_tables(bits, grad_bits, args.weight_bits)
+    elif args.cost_model == 'measured':
+        tables = load_cost_table(args.arch, args.dataset, bits, grad_bits, resolution=32,
+                                 cache_dir=args.model_info_dir, batch_size=args.batch_size)
+    else:
+        tables = np.load(args.cost_model, allow_pickle=True).item()
+
+    return [torch.tensor(tables[key], dtype=torch.float32).cuda() for key in ('fw', 'eb', 'gc')]
 
-    cost_fw = []
-    for bit in bits:
-        cost_fw.append(bit/32)
-    cost_fw = np.array(cost_fw) * args.weight_bits/32
 
-    cost_eb = []
-    for bit in grad_bits:
-        cost_eb.append(bit/32)
-    cost_eb = np.array(cost_eb) * args.weight_bits/32
+def computation_costs(masks, cost_fw, cost_eb, cost_gc, conv_info):
+    """Per-layer decision counts (layer x candidate) and the fw/eb/gc cost of one batch.
+    Everything stays on device, so no host sync is needed inside the step."""
+    counts = torch.stack([torch.stack(mask_list, dim=-1).sum(0) for mask_list in masks])
+    weighted = counts * conv_info.view(-1, 1)
+    return counts, (weighted * cost_fw).sum(), (weighted * cost_eb).sum(), (weighted * cost_gc).sum()
+
+
+def computation_reg(cp_ratio, target_ratio, relax):
+    """Sign of the computation loss: +-1 outside the relax band, +-0.1 inside it"""
+    ones = torch.ones_like(cp_ratio)
+    return torch.where(cp_ratio < target_ratio - relax, -ones,
+                       torch.where(cp_ratio >= target_ratio + relax, ones,
+                                   torch.where(cp_ratio >= target_ratio, 0.1 * ones, -0.1 * ones)))
+
+
+def run_training(args):
+    global conv_info
 
-    cost_gc = []
-    for i in range(len(bits)):
-        cost_gc.append(bits[i] * grad_bits[i]/32/32)
-    cost_gc = np.array(cost_gc)
+    cost_fw, cost_eb, cost_gc = computation_cost_tables(args)
 
     # create model
     model = models.__dict__[args.arch](args.pretrained, proj_dim=len(bits))
@@ -232,6 +320,10 @@ def run_training(args):
     best_swa_prec = 0
     best_swa_iter = 0
 
+    checkpoint_writer = AsyncCheckpointWriter(args.save_path, keep_last=args.keep_last)
+    schedule = make_schedule(args)
+    resume_state = None
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
@@ -239,10 +331,13 @@ def run_training(args):
             checkpoint = torch.load(args.resume)
             if args.proceed == 'True':
                 args.start_iter = checkpoint['iter']
+                resume_state = checkpoint
             else:
                 args.start_iter = 0
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'],strict=True)
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
             logging.info('=> loaded checkpoint `{}` (iter: {})'.format(
                 args.resume, checkpoint['iter']
             ))
@@ -263,11 +358,17 @@ def run_training(args):
 
     cudnn.benchmark = True
 
+    # static batch shapes when compiling, so the last partial batch does not trigger a recompile
     train_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir,
                                       batch_size=args.batch_size,
                                       shuffle=True,
-                                      num_workers=args.workers)
+                                      num_workers=args.workers,
+                                      drop_last=args.compile,
+                                      route_layers=sum(model.module.num_layers) if args.route_batches else 0,
+                                      route_max_age=args.route_max_age,
+                                      route_mix=args.route_mix)
+    route_sampler = train_loader.batch_sampler if args.route_batches else None
     test_loader = prepare_test_data(dataset=args.dataset,
                                     datadir=args.datadir,
                                     batch_size=args.batch_size,
@@ -278,8 +379,9 @@ def run_training(args):
         swa_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir,
                                       batch_size=args.batch_size,
-                                      shuffle=False,
+                                      shuffle=True,
                                       num_workers=args.workers)
+        swa_bn_batches = util_swa.cache_bn_batches(swa_loader, args.swa_bn_batches) if args.swa_bn_batches else swa_loader
 
     if args.rnn_initial:
         for param in model.parameters():
@@ -300,10 +402,21 @@ def run_training(args):
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(),
-                                args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params,
+                         args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
+
+    if resume_state is not None:
+        # continue exactly where the interrupted run stopped
+        if resume_state.get('optimizer') is not None:
+            optimizer.load_state_dict(resume_state['optimizer'])
+        if route_sampler is not None:
+            route_sampler.load_state_dict(resume_state.get('routes'))
+        resume_data_position(train_loader, args.start_iter, args.batch_size, resume_state.get('data_seed', 0))
+        if resume_state.get('rng') is not None:
+            set_rng_state(resume_state['rng'])
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -317,19 +430,105 @@ def run_training(args):
     
     network_depth = sum(model.module.num_layers)
 
-    if conv_info is None:
-        conv_info = [1 for _ in range(network_depth)]
+    conv_info_t = torch.tensor(conv_info, dtype=torch.float32).cuda()
+    conv_sum = float(sum(conv_info))
+    conv_mean = float(np.mean(conv_info))
+
+    # layer x candidate decision ratios, kept as one device tensor
+    layerwise_decision_statistics = AverageMeter()
+
+    candidates = None
+    if args.candidate_threshold and isinstance(model.module.control, models.RNNGate):
+        candidates = CandidateManager(network_depth, len(bits), threshold=args.candidate_threshold,
+                                      ema=args.candidate_ema, check_every=args.candidate_check_every,
+                                      explore_every=args.candidate_explore_every,
+                                      explore_steps=args.candidate_explore_steps)
+        if resume_state is not None:
+            candidates.load_state_dict(resume_state.get('candidates'), device='cuda')
+            candidates.apply(model.module)
+
+    telemetry = None
+    if args.telemetry_every:
+        telemetry = DecisionTelemetry(os.path.join(args.save_path, 'decisions_train.bin'),
+                                      network_depth, len(bits), 100 if args.dataset == 'cifar100' else 10,
+                                      interval=args.telemetry_every)
+
+    def train_step(input_var, target_var, target_ratio, finetune):
+        if finetune:
+            with autocast(args.bf16):
+                output, _ = model(input_var, np.zeros(len(bits)), np.zeros(len(grad_bits)))
+            output = output.float()
+            loss_cls = criterion(output, target_var)
+            loss = loss_cls
+            counts = masks = None
+            cp_ratio = cp_ratio_fw = cp_ratio_eb = cp_ratio_gc = loss_cls.new_ones(())
 
-    layerwise_decision_statistics = []
-    
-    for k in range(network_depth):
-        layerwise_decision_statistics.append([])
-        for j in range(len(cost_fw)):
-            ratio = AverageMeter()
-            layerwise_decision_statistics[k].append(ratio)
+        else:
+            with autocast(args.bf16):
+                output, masks = model(input_var, bits, grad_bits)
+            output = output.float()
+            batch_size = input_var.size(0)
+
+            counts, computation_cost_fw, computation_cost_eb, computation_cost_gc = \
+                computation_costs(masks, cost_fw, cost_eb, cost_gc, conv_info_t)
+
+            computation_cost_fw = computation_cost_fw + dws_flops_fw * batch_size
+            computation_cost_eb = computation_cost_eb + dws_flops_eb * batch_size
+            computation_cost_gc = computation_cost_gc + dws_flops_gc * batch_size
+
+            computation_cost = computation_cost_fw + computation_cost_eb + computation_cost_gc
+
+            cp_ratio_fw = computation_cost_fw.detach() / batch_size / (conv_sum + dws_flops_fw) * 100
+            cp_ratio_eb = computation_cost_eb.detach() / batch_size / (conv_sum + dws_flops_eb) * 100
+            cp_ratio_gc = computation_cost_gc.detach() / batch_size / (conv_sum + dws_flops_gc) * 100
+
+            cp_ratio = computation_cost.detach() / batch_size / (conv_sum*3 + dws_flops_total) * 100
+
+            computation_loss = computation_cost / conv_mean * args.beta
+
+            reg = computation_reg(cp_ratio, target_ratio, args.relax)
+
+            loss_cls = criterion(output, target_var)
+
+            if args.ada_beta:
+                ada_scale = torch.where(computation_loss > loss_cls / 10,
+                                        loss_cls.detach() / 10 / computation_loss.detach(),
+                                        torch.ones_like(computation_loss))
+                computation_loss = computation_loss * ada_scale
+
+            if args.computation_loss:
+                loss = loss_cls + computation_loss * reg
+            else:
+                loss = loss_cls
+
+        optimizer.zero_grad()
+
+        if args.loss_sf:
+            (loss * args.loss_sf).backward()
+            unscale_grads_(params, args.loss_sf)
+        else:
+            loss.backward()
+
+        optimizer.step()
+
+        return output.detach(), loss.detach(), counts, masks, cp_ratio, cp_ratio_fw, cp_ratio_eb, cp_ratio_gc
+
+    step_fn = train_step
+    if args.compile:
+        if hasattr(torch, 'compile'):
+            step_fn = torch.compile(train_step, dynamic=False)
+        else:
+            logging.info('torch.compile is not available in torch {}, running eagerly'.format(torch.__version__))
 
     end = time.time()
 
+    # a resumed run restores the phase with the schedule state, so its first apply() reports no
+    # switch: start the QConv2d weight precision and the cost tables at the current phase
+    if 'weight_bits' in schedule.phases:
+        args.weight_bits = schedule.values(args.start_iter, 0)['weight_bits']
+        set_weight_bits(model, args.weight_bits)
+        cost_fw, cost_eb, cost_gc = computation_cost_tables(args)
+
     i = args.start_iter
     while i < args.iters + args.finetune_step:
         for input, target in train_loader:
@@ -337,103 +536,48 @@ def run_training(args):
             data_time.update(time.time() - end)
 
             model.train()
-            # adjust_learning_rate(args, optimizer1, optimizer2, i)
-            adjust_learning_rate(args, optimizer, i)
-            adjust_target_ratio(args, i)
+            set_running_stats_update(model, i % args.qparams_every == 0)
+            lr, phase_changed = schedule.apply(i, args, optimizer, turning_point_count=0)
+            if i % args.eval_every == 0:
+                logging.info('Iter [{}] learning rate = {}'.format(i, lr))
+            if phase_changed:
+                if 'weight_bits' in schedule.phases:
+                    set_weight_bits(model, args.weight_bits)
+                    # the proxy cost of a candidate depends on the weight precision
+                    cost_fw, cost_eb, cost_gc = computation_cost_tables(args)
+                logging.info('Iter [{}] target_ratio = {}'.format(i, args.target_ratio))
             i += 1
 
             target = target.cuda()
             input_var = Variable(input).cuda()
             target_var = Variable(target).cuda()
-           
-            if i > args.iters:
-                output, _ = model(input_var, np.zeros(len(bits)), np.zeros(len(grad_bits)))
-                computation_cost = 0
-                cp_ratio = 1
-                cp_ratio_fw = 1
-                cp_ratio_eb = 1
-                cp_ratio_gc = 1
 
-            else:
-                output, masks = model(input_var, bits, grad_bits)
-                
-                computation_cost_fw = 0
-                computation_cost_eb = 0
-                computation_cost_gc = 0
-                
-                for layer in range(network_depth):
-                    
-                    full_layer = reduce((lambda x, y: x * y), masks[layer][0].shape)
-                    
-                    for k in range(len(cost_fw)):
-                        
-                        dynamic_choice = masks[layer][k].sum()
-                        
-                        ratio = dynamic_choice / full_layer
-
-                        layerwise_decision_statistics[layer][k].update(ratio.data, 1)
-                        
-                        computation_cost_fw += masks[layer][k].sum() * cost_fw[k] * conv_info[layer]
-                        computation_cost_eb += masks[layer][k].sum() * cost_eb[k] * conv_info[layer]
-                        computation_cost_gc += masks[layer][k].sum() * cost_gc[k] * conv_info[layer]
-                
-                computation_cost_fw += dws_flops_fw * args.batch_size
-                computation_cost_eb += dws_flops_eb * args.batch_size
-                computation_cost_gc += dws_flops_gc * args.batch_size
+            output, loss, counts, masks, cp_ratio, cp_ratio_fw, cp_ratio_eb, cp_ratio_gc = step_fn(
+                input_var, target_var, args.target_ratio, i > args.iters)
 
-                computation_cost = computation_cost_fw + computation_cost_eb + computation_cost_gc
+            if route_sampler is not None:
+                route_sampler.update(masks)
 
-                cp_ratio_fw = float(computation_cost_fw) / args.batch_size / (sum(conv_info) + dws_flops_fw) * 100
-                cp_ratio_eb = float(computation_cost_eb) / args.batch_size / (sum(conv_info) + dws_flops_eb) * 100
-                cp_ratio_gc = float(computation_cost_gc) / args.batch_size / (sum(conv_info) + dws_flops_gc) * 100
+            # measure accuracy and record loss, as device tensors: the host only syncs when logging
+            prec1, = accuracy(output, target, topk=(1,))
+            losses.update(loss, input.size(0))
+            top1.update(prec1, input.size(0))
 
-                cp_ratio = float(computation_cost) / args.batch_size / (sum(conv_info)*3 + dws_flops_total) * 100
-                    
-                computation_loss = computation_cost / np.mean(conv_info) * args.beta
-            
-            if cp_ratio < args.target_ratio - args.relax:
-                reg = -1
-            elif cp_ratio >= args.target_ratio + args.relax:
-                reg = 1
-            elif cp_ratio >=args.target_ratio:
-                reg = 0.1
-            else:
-                reg = -0.1
-            
-            loss_cls = criterion(output, target_var)
+            if counts is not None:
+                layerwise_decision_statistics.update(counts / input.size(0), 1)
+                if telemetry is not None:
+                    telemetry.update(i, masks, target)
+                if candidates is not None and candidates.update(i, counts, input.size(0)):
+                    candidates.apply(model.module)
+                    logging.info('Iter {}: {} of {} layer candidates disabled'.format(
+                        i, candidates.num_disabled(), network_depth * len(bits)))
 
-            if computation_loss > loss_cls/10 and args.ada_beta: 
-                computation_loss *= loss_cls.detach()/10/computation_loss.detach()
-
-            if args.computation_loss:
-                loss = loss_cls + computation_loss * reg
-            else:
-                loss = loss_cls
-
-            # measure accuracy and record loss
-            prec1, = accuracy(output.data, target, topk=(1,))
-            losses.update(loss.item(), input.size(0))
-            top1.update(prec1.item(), input.size(0))
             # skip_ratios.update(skips, input.size(0))
             cp_record.update(cp_ratio,1)
             cp_record_fw.update(cp_ratio_fw,1)
             cp_record_eb.update(cp_ratio_eb,1)
             cp_record_gc.update(cp_ratio_gc,1)
 
-            optimizer.zero_grad()
-
-            if args.loss_sf:
-                loss *= args.loss_sf
-
-            loss.backward()
-
-            if args.loss_sf:
-                for param in model.parameters():
-                    if param.requires_grad and param.grad is not None:
-                        param.grad.data /= args.loss_sf
-
-            optimizer.step()
-
             # repackage hidden units for RNN Gate
             if args.gate_type == 'rnn':
                 model.module.control.repackage_hidden()
@@ -464,10 +608,14 @@ def run_training(args):
                                 cp_record_gc=cp_record_gc)
                 )
             
-            if args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0:
+            swa_collect = args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0
+            swa_final = args.swa_start is not None and i == args.iters and (swa_n > 0 or swa_collect)
+            if swa_collect:
                 util_swa.moving_average(swa_model, model, 1.0 / (swa_n + 1))
                 swa_n += 1
-                util_swa.bn_update(swa_loader, swa_model, bits, grad_bits)
+            if swa_collect or swa_final:
+                # cheap BN recalibration on the cached batches, one full pass over the training set at the end
+                util_swa.bn_update(swa_loader if swa_final else swa_bn_batches, swa_model, bits, grad_bits)
 
                 with torch.no_grad():
                     prec1 = validate(args, test_loader, swa_model, criterion, i, swa=True)
@@ -496,41 +644,34 @@ def run_training(args):
                 print("Current Best Iteration: ", best_iter)
 
                 checkpoint_path = os.path.join(args.save_path, 'checkpoint_{:05d}_{:.2f}.pth.tar'.format(i, prec1))
-                save_checkpoint({
+                checkpoint_writer.save({
                     'iter': i,
                     'arch': args.arch,
                     'state_dict': model.state_dict(),
                     'best_prec1': best_prec1,
+                    'optimizer': optimizer.state_dict(),
+                    'rng': get_rng_state(),
+                    'data_seed': data_sampler(train_loader).seed,
+                    'routes': route_sampler.state_dict() if route_sampler is not None else None,
+                    'candidates': candidates.state_dict() if candidates is not None else None,
+                    'schedule': schedule.state_dict(),
                     'swa_state_dict' : swa_model.state_dict() if args.swa_start is not None else None,
                     'swa_n' : swa_n if args.swa_start is not None else None,
                     'best_swa_prec' : best_swa_prec if args.swa_start is not None else None,
-                },
-                    is_best = is_best, filename=checkpoint_path)
-                shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
-                                                              'checkpoint_latest'
-                                                              '.pth.tar'))
+                }, filename=checkpoint_path, is_best=is_best)
 
             if i >= args.iters + args.finetune_step:
                 break
 
+    if telemetry is not None:
+        telemetry.close(i)
+    checkpoint_writer.close()
+
 
 def validate(args, test_loader, model, criterion, step, swa=False):
     global conv_info
 
-    cost_fw = []
-    for bit in bits:
-        cost_fw.append(bit/32)
-    cost_fw = np.array(cost_fw) * args.weight_bits/32
-
-    cost_eb = []
-    for bit in grad_bits:
-        cost_eb.append(bit/32)
-    cost_eb = np.array(cost_eb) * args.weight_bits/32
-
-    cost_gc = []
-    for i in range(len(bits)):
-        cost_gc.append(bits[i] * grad_bits[i]/32/32)
-    cost_gc = np.array(cost_gc)
+    cost_fw, cost_eb, cost_gc = computation_cost_tables(args)
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -544,13 +685,17 @@ def validate(args, test_loader, model, criterion, step, swa=False):
     
     network_depth = sum(model.module.num_layers)
 
-    layerwise_decision_statistics = []
-    
-    for k in range(network_depth):
-        layerwise_decision_statistics.append([])
-        for j in range(len(cost_fw)):
-            ratio = AverageMeter()
-            layerwise_decision_statistics[k].append(ratio)
+    conv_info_t = torch.tensor(conv_info, dtype=torch.float32).cuda()
+    conv_sum = float(sum(conv_info))
+
+    layerwise_decision_statistics = AverageMeter()
+
+    # one record per validation, written when it ends
+    telemetry = None
+    if args.telemetry_every:
+        telemetry = DecisionTelemetry(os.path.join(args.save_path, 'decisions_swa_val.bin' if swa else 'decisions_val.bin'),
+                                      network_depth, len(bits), 100 if args.dataset == 'cifar100' else 10,
+                                      interval=0)
 
     model.eval()
     end = time.time()
@@ -562,46 +707,33 @@ def validate(args, test_loader, model, criterion, step, swa=False):
         target_var = Variable(target).cuda()
        
         output, masks = model(input_var, bits, grad_bits)
-        
-        computation_cost_fw = 0
-        computation_cost_eb = 0
-        computation_cost_gc = 0
-        computation_all = 0
-            
-        for layer in range(network_depth):
-            
-            full_layer = reduce((lambda x, y: x * y), masks[layer][0].shape)
-            
-            for k in range(len(cost_fw)):
-                
-                dynamic_choice = masks[layer][k].sum()
-                
-                ratio = dynamic_choice / full_layer
+        batch_size = input_var.size(0)
 
-                layerwise_decision_statistics[layer][k].update(ratio.data, 1)
-                
-                computation_cost_fw += masks[layer][k].sum() * cost_fw[k] * conv_info[layer]
-                computation_cost_eb += masks[layer][k].sum() * cost_eb[k] * conv_info[layer]
-                computation_cost_gc += masks[layer][k].sum() * cost_gc[k] * conv_info[layer]
-        
-        computation_cost_fw += dws_flops_fw * args.batch_size
-        computation_cost_eb += dws_flops_eb * args.batch_size
-        computation_cost_gc += dws_flops_gc * args.batch_size
+        counts, computation_cost_fw, computation_cost_eb, computation_cost_gc = \
+            computation_costs(masks, cost_fw, cost_eb, cost_gc, conv_info_t)
+
+        layerwise_decision_statistics.update(counts / batch_size, 1)
+        if telemetry is not None:
+            telemetry.update(step, masks, target)
+
+        computation_cost_fw = computation_cost_fw + dws_flops_fw * batch_size
+        computation_cost_eb = computation_cost_eb + dws_flops_eb * batch_size
+        computation_cost_gc = computation_cost_gc + dws_flops_gc * batch_size
 
         computation_cost = computation_cost_fw + computation_cost_eb + computation_cost_gc
 
-        cp_ratio_fw = float(computation_cost_fw) / args.batch_size / (sum(conv_info) + dws_flops_fw) * 100
-        cp_ratio_eb = float(computation_cost_eb) / args.batch_size / (sum(conv_info) + dws_flops_eb) * 100
-        cp_ratio_gc = float(computation_cost_gc) / args.batch_size / (sum(conv_info) + dws_flops_gc) * 100
+        cp_ratio_fw = computation_cost_fw / batch_size / (conv_sum + dws_flops_fw) * 100
+        cp_ratio_eb = computation_cost_eb / batch_size / (conv_sum + dws_flops_eb) * 100
+        cp_ratio_gc = computation_cost_gc / batch_size / (conv_sum + dws_flops_gc) * 100
 
-        cp_ratio = float(computation_cost) / args.batch_size / (sum(conv_info)*3 + dws_flops_total) * 100         
+        cp_ratio = computation_cost / batch_size / (conv_sum*3 + dws_flops_total) * 100
             
         loss = criterion(output, target_var)
 
         # measure accuracy and record loss
         prec1, = accuracy(output.data, target, topk=(1,))
-        losses.update(loss.item(), input.size(0))
-        top1.update(prec1.item(), input.size(0))
+        losses.update(loss, input.size(0))
+        top1.update(prec1, input.size(0))
         # skip_ratios.update(skips, input.size(0))
         cp_record.update(cp_ratio,1)
         cp_record_fw.update(cp_ratio_fw,1)
@@ -643,12 +775,16 @@ def validate(args, test_loader, model, criterion, step, swa=False):
     else:
         logging.info('Step {} * SWA Prec@1 {top1.avg:.3f}'.format(step, top1=top1))
     
+    if telemetry is not None:
+        telemetry.close(step)
+
+    decision_ratio = layerwise_decision_statistics.avg.tolist()
     for layer in range(network_depth):
         print('layer{}_decision'.format(layer + 2))
-        for g in range(len(cost_fw)):
-            print('{}_ratio{}'.format(g,layerwise_decision_statistics[layer][g].avg))
+        for g in range(len(bits)):
+            print('{}_ratio{}'.format(g,decision_ratio[layer][g]))
 
-    return top1.avg
+    return float(top1.avg)
 
 
 def validate_full_prec(args, test_loader, model, criterion, step):
@@ -709,9 +845,6 @@ def test_model(args):
 
     network_depth = sum(model.module.num_layers)
 
-    if conv_info is None:
-        conv_info = [1 for _ in range(network_depth)]
-
     cudnn.benchmark = False
     test_loader = prepare_test_data(dataset=args.dataset,
                                     batch_size=args.batch_size,
@@ -724,14 +857,6 @@ def test_model(args):
         # validate_full_prec(args, test_loader, model, criterion, args.start_iter)
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        save_path = os.path.dirname(filename)
-        shutil.copyfile(filename, os.path.join(save_path,
-                                               'model_best.pth.tar'))
-
-
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -777,63 +902,14 @@ class ListAverageMeter(object):
             self.avg[i] = self.sum[i] / self.count
 
 
-schedule_cnt = 0
-def adjust_target_ratio(args, _iter):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.target_ratio_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.target_ratio = args.target_ratio_schedule[0]
-            # if args.weight_bits_schedule is not None:
-            #     args.weight_bits = args.weight_bits_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _iter == step:
-                args.target_ratio = args.target_ratio_schedule[schedule_cnt]
-                # if args.weight_bits_schedule is not None:
-                #     args.weight_bits = args.weight_bits_schedule[schedule_cnt]
-                schedule_cnt += 1
-
-        if _iter % args.eval_every == 0:
-            logging.info('Iter [{}] target_ratio = {}'.format(_iter, args.target_ratio))
-
-
-def adjust_learning_rate(args, optimizer, _iter):
-    if args.lr_schedule == 'piecewise':
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif 32000 <= _iter < 48000:
-            lr = args.lr * (args.step_ratio ** 1)
-        elif _iter >= 48000:
-            lr = args.lr * (args.step_ratio ** 2)
-        else:
-            lr = args.lr
-
-    elif args.lr_schedule == 'linear':
-        t = _iter / args.iters
-        lr_ratio = 0.01
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif t < 0.25:
-            lr = args.lr
-        elif t < 0.75:
-            lr = args.lr * (1 - (1-lr_ratio)*(t-0.25)/0.5)
-        else:
-            lr = args.lr * lr_ratio
-
-    elif args.lr_schedule == 'anneal_cosine':
-        lr_min = args.lr * (args.step_ratio ** 2)
-        lr_max = args.lr
-        lr = lr_min + 1/2 * (lr_max - lr_min) * (1 + np.cos(_iter/args.iters * 3.141592653))
-
-    if _iter % args.eval_every == 0:
-        logging.info('Iter [{}] learning rate = {}'.format(_iter, lr))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+def make_schedule(args):
+    # --warm_up never applied to the cosine schedule, keep its lr curve unchanged
+    warm_up = 400 if args.warm_up and args.lr_schedule != 'anneal_cosine' else 0
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps, step_ratio=args.step_ratio,
+                          total=args.iters, warm_up=warm_up, linear_range=(0.25, 0.75),
+                          phases={'target_ratio': args.target_ratio_schedule,
+                                  'weight_bits': [int(b) for b in args.weight_bits_schedule] if args.weight_bits_schedule else None},
+                          phase_by=args.phase_by, phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -7,12 +7,16 @@ from torch.autograd import Variable
 import numpy as np
 
 import os
-import shutil
 import argparse
 import time
 import logging
 
 import models
+from util_optim import trainable_parameters, make_sgd
+from util_schedule import ScheduleEngine
+from util_checkpoint import get_rng_state, set_rng_state, resume_data_position, data_sampler, AsyncCheckpointWriter
+from util_indicator import LossDiffIndicator
+from modules.quantize import autocast, set_running_stats_update, calibrate, load_calibration
 from data import *
 
 import util_swa
@@ -64,12 +68,18 @@ def parse_args():
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=[32000, 48000], type=int, nargs='*',
+                        help='iterations at which the piecewise learning rate decays by step_ratio')
+    parser.add_argument('--phase_by', default='turning_point', type=str, choices=['step', 'turning_point'],
+                        help='switch precision / target ratio phases at --schedule steps or at loss turning points')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
     parser.add_argument('--save_folder', default='save_checkpoints',
                         type=str,
                         help='folder to save the checkpoints')
+    parser.add_argument('--keep_last', default=3, type=int,
+                        help='number of per-eval checkpoints to keep, 0 keeps all (default: 3)')
     parser.add_argument('--eval_every', default=400, type=int,
                         help='evaluate model every (default: 1000) iterations')
     parser.add_argument('--num_bits',default=0,type=int,
@@ -94,66 +104,72 @@ def parse_args():
                         help='precision of weight')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
+    parser.add_argument('--calibrate', default=0, type=int,
+                        help='initialize the activation quantizers from a calibration pass over N training batches '
+                             '(default: 0, start from zero ranges)')
+    parser.add_argument('--calibration_file', default=None, type=str,
+                        help='calibration artifact to reuse if it exists, written after the calibration pass otherwise')
     parser.add_argument('--swa_start', type=float, default=None, help='SWA start step number')
     parser.add_argument('--swa_freq', type=float, default=1170,
                         help='SWA model collection frequency')
+    parser.add_argument('--swa_bn_batches', type=int, default=20,
+                        help='recalibrate SWA BN statistics on this many cached training batches, '
+                             'with a full pass over the training set only at the end (0: always full pass)')
+    parser.add_argument('--compile', default=False, action='store_true',
+                        help='compile forward, loss, backward and optimizer step with static shapes')
 
     parser.add_argument('--num_turning_point', type=int, default=3)
     parser.add_argument('--initial_threshold', type=float, default=0.15)
     parser.add_argument('--decay', type=float, default=0.4)
+    parser.add_argument('--indicator_every', type=int, default=0,
+                        help='feed the turning point indicator the mean training loss of every N steps '
+                             '(0: once per evaluation, from the epoch loss)')
+    parser.add_argument('--indicator_ema', type=float, default=0.,
+                        help='EMA smoothing of the indicator loss observations')
     args = parser.parse_args()
     return args
 
-# indicator
-class loss_diff_indicator():
-    def __init__(self, threshold, decay, epoch_keep=5):
-        self.threshold = threshold
-        self.decay = decay
-        self.epoch_keep = epoch_keep
-        self.loss = []
-        self.scale_loss = 1
-        self.loss_diff = [1 for i in range(1, self.epoch_keep)]
+def apply_indicator(args, loss, where):
+    """Feed one training loss observation to the turning point indicator"""
+    global turning_point_count
+    if turning_point_count >= args.num_turning_point:
+        return
+    flag = my_loss_diff_indicator.update(loss)
+    logging.info('indicator at {}: scale_loss {:.4f}, max loss diff {}'.format(
+        where, my_loss_diff_indicator.scale_loss, my_loss_diff_indicator.max_diff))
+    if flag:
+        turning_point_count += 1
+        logging.info('find {}-th turning point at {}'.format(turning_point_count, where))
+        my_loss_diff_indicator.adaptive_threshold(turning_point_count=turning_point_count)
+        my_loss_diff_indicator.reset()
+
+
+def init_quantizers(args, model, train_loader):
+    """Start the activation quantizers of a fresh run from calibrated ranges instead of zero"""
+    if args.calibration_file and os.path.isfile(args.calibration_file):
+        artifact = torch.load(args.calibration_file)
+    else:
+        # any nonzero precision routes the activations through the QuantMeasures
+        artifact = calibrate(model, train_loader, 8, 8, num_batches=args.calibrate)
+        # the pass advanced the sampler, training still starts with the first epoch's order
+        train_loader.sampler.set_epoch(0)
+        if args.calibration_file:
+            torch.save(artifact, args.calibration_file)
+    count = load_calibration(model, artifact)
+    logging.info('=> initialized {} activation quantizers from calibration'.format(count))
+
+
+def load_indicator_state(checkpoint):
+    global turning_point_count
+    if checkpoint.get('indicator') is not None:
+        my_loss_diff_indicator.load_state_dict(checkpoint['indicator'])
+        turning_point_count = checkpoint['turning_point_count']
 
-    def reset(self):
-        self.loss = []
-        self.loss_diff = [1 for i in range(1, self.epoch_keep)]
-
-    def adaptive_threshold(self, turning_point_count):
-        decay_1 = self.decay
-        decay_2 = self.decay
-        if turning_point_count == 1:
-            self.threshold *= decay_1
-        if turning_point_count == 2:
-            self.threshold *= decay_2
-        print('threshold decay to {}'.format(self.threshold))
-
-    def get_loss(self, current_epoch_loss):
-        if len(self.loss) < self.epoch_keep:
-            self.loss.append(current_epoch_loss)
-        else:
-            self.loss.pop(0)
-            self.loss.append(current_epoch_loss)
-
-    def cal_loss_diff(self):
-        if len(self.loss) == self.epoch_keep:
-            for i in range(len(self.loss)-1):
-                loss_now = self.loss[-1]
-                loss_pre = self.loss[i]
-                self.loss_diff[i] = np.abs(loss_pre - loss_now) / self.scale_loss
-            return True
-        else:
-            return False
-
-    def turning_point_emerge(self):
-        flag = self.cal_loss_diff()
-        if flag == True:
-            print(self.loss_diff)
-            for i in range(len(self.loss_diff)):
-                if self.loss_diff[i] > self.threshold:
-                    return False
-            return True
-        else:
-            return False
 
 def main():
     args = parse_args()
@@ -187,11 +203,10 @@ def main():
 
     # initialize indicator
     # initial_threshold=0.15
-    global scale_loss
-    scale_loss = 0
     global my_loss_diff_indicator
-    my_loss_diff_indicator = loss_diff_indicator(threshold=args.initial_threshold,
-                                                 decay=args.decay)
+    my_loss_diff_indicator = LossDiffIndicator(threshold=args.initial_threshold,
+                                               decay=args.decay,
+                                               ema=args.indicator_ema)
 
     global turning_point_count
     turning_point_count = 0
@@ -206,11 +221,11 @@ def main():
         test_model(args)
 
 
-
 def run_training(args):
     # create model
     training_loss = 0
     training_acc = 0
+    indicator_loss = 0
 
     model = models.__dict__[args.arch](args.pretrained)
     model = torch.nn.DataParallel(model).cuda()
@@ -231,13 +246,21 @@ def run_training(args):
 
     # best_full_prec = 0
 
+    checkpoint_writer = AsyncCheckpointWriter(args.save_path, keep_last=args.keep_last)
+    schedule = make_schedule(args)
+    resume_state = None
+
     if args.resume:
         if os.path.isfile(args.resume):
             logging.info('=> loading checkpoint `{}`'.format(args.resume))
             checkpoint = torch.load(args.resume)
             args.start_iter = checkpoint['iter']
+            resume_state = checkpoint
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
+            load_indicator_state(checkpoint)
 
             if args.swa_start is not None:
                 swa_state_dict = checkpoint['swa_state_dict']
@@ -258,11 +281,13 @@ def run_training(args):
 
     cudnn.benchmark = False
 
+    # static batch shapes when compiling, so the last partial batch does not trigger a recompile
     train_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir,
                                       batch_size=args.batch_size,
                                       shuffle=True,
-                                      num_workers=args.workers)
+                                      num_workers=args.workers,
+                                      drop_last=args.compile)
     test_loader = prepare_test_data(dataset=args.dataset,
                                     datadir=args.datadir,
                                     batch_size=args.batch_size,
@@ -272,15 +297,28 @@ def run_training(args):
         swa_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir,
                                       batch_size=args.batch_size,
-                                      shuffle=False,
+                                      shuffle=True,
                                       num_workers=args.workers)
+        swa_bn_batches = util_swa.cache_bn_batches(swa_loader, args.swa_bn_batches) if args.swa_bn_batches else swa_loader
 
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params, args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
+
+    if resume_state is not None:
+        # continue exactly where the interrupted run stopped
+        if resume_state.get('optimizer') is not None:
+            optimizer.load_state_dict(resume_state['optimizer'])
+        indicator_loss = resume_state.get('indicator_loss', 0)
+        resume_data_position(train_loader, args.start_iter, args.batch_size, resume_state.get('data_seed', 0))
+        if resume_state.get('rng') is not None:
+            set_rng_state(resume_state['rng'])
+    elif args.calibrate:
+        init_quantizers(args, model, train_loader)
 
     # optimizer = torch.optim.Adam(model.parameters(), args.lr,
     #                             weight_decay=args.weight_decay)
@@ -291,9 +329,28 @@ def run_training(args):
     top1 = AverageMeter()
     cr = AverageMeter()
 
+    def train_step(input_var, target_var, num_bits, num_grad_bits):
+        with autocast(args.bf16):
+            output = model(input_var, num_bits, num_grad_bits)
+        output = output.float()
+        loss = criterion(output, target_var)
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        return output.detach(), loss.detach()
+
+    # precisions only change at turning points, so the compiled step is re-specialized a few times at most
+    step_fn = train_step
+    if args.compile:
+        if hasattr(torch, 'compile'):
+            step_fn = torch.compile(train_step, dynamic=False)
+        else:
+            logging.info('torch.compile is not available in torch {}, running eagerly'.format(torch.__version__))
+
     end = time.time()
 
-    global scale_loss
     global turning_point_count
     global my_loss_diff_indicator
 
@@ -304,9 +361,12 @@ def run_training(args):
             data_time.update(time.time() - end)
 
             model.train()
-            adjust_learning_rate(args, optimizer, i)
-            # adjust_precision(args, i)
-            adaptive_adjust_precision(args, turning_point_count)
+            set_running_stats_update(model, i % args.qparams_every == 0)
+            lr, phase_changed = schedule.apply(i, args, optimizer, turning_point_count)
+            if i % args.eval_every == 0:
+                logging.info('Iter [{}] learning rate = {}'.format(i, lr))
+            if phase_changed:
+                logging.info('Iter [{}] num_bits = {} num_grad_bits = {}'.format(i, args.num_bits, args.num_grad_bits))
 
             i += 1
 
@@ -319,21 +379,21 @@ def run_training(args):
             input_var = Variable(input).cuda()
             target_var = Variable(target).cuda()
 
-            # compute output
-            output = model(input_var, args.num_bits, args.num_grad_bits)
-            loss = criterion(output, target_var)
-            training_loss += loss.item()
+            # compute output, gradient and do SGD step
+            output, loss = step_fn(input_var, target_var, args.num_bits, args.num_grad_bits)
+            training_loss += loss
 
-            # measure accuracy and record loss
-            prec1, = accuracy(output.data, target, topk=(1,))
-            losses.update(loss.item(), input.size(0))
-            top1.update(prec1.item(), input.size(0))
-            training_acc += prec1.item()
+            # measure accuracy and record loss, as device tensors: the host only syncs when logging
+            prec1, = accuracy(output, target, topk=(1,))
+            losses.update(loss, input.size(0))
+            top1.update(prec1, input.size(0))
+            training_acc += prec1
 
-            # compute gradient and do SGD step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            if args.indicator_every:
+                indicator_loss += loss
+                if i % args.indicator_every == 0:
+                    apply_indicator(args, float(indicator_loss) / args.indicator_every, 'iter {}'.format(i))
+                    indicator_loss = 0
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -355,10 +415,14 @@ def run_training(args):
                 )
 
 
-            if args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0:
+            swa_collect = args.swa_start is not None and i >= args.swa_start and i % args.swa_freq == 0
+            swa_final = args.swa_start is not None and i == args.iters and (swa_n > 0 or swa_collect)
+            if swa_collect:
                 util_swa.moving_average(swa_model, model, 1.0 / (swa_n + 1))
                 swa_n += 1
-                util_swa.bn_update(swa_loader, swa_model, args.num_bits, args.num_grad_bits)
+            if swa_collect or swa_final:
+                # cheap BN recalibration on the cached batches, one full pass over the training set at the end
+                util_swa.bn_update(swa_loader if swa_final else swa_bn_batches, swa_model, args.num_bits, args.num_grad_bits)
                 prec1 = validate(args, test_loader, swa_model, criterion, i, swa=True)
 
                 if prec1 > best_swa_prec:
@@ -372,12 +436,12 @@ def run_training(args):
                 # record training loss and test accuracy
                 global history_score
                 epoch = i // args.eval_every
-                epoch_loss = training_loss / len(train_loader)
+                epoch_loss = float(training_loss) / len(train_loader)
                 with torch.no_grad():
                     prec1 = validate(args, test_loader, model, criterion, i)
                     # prec_full = validate_full_prec(args, test_loader, model, criterion, i)
                 history_score[epoch-1][0] = epoch_loss
-                history_score[epoch-1][1] = np.round(training_acc / len(train_loader), 2)
+                history_score[epoch-1][1] = np.round(float(training_acc) / len(train_loader), 2)
                 history_score[epoch-1][2] = prec1
                 training_loss = 0
                 training_acc = 0
@@ -385,22 +449,8 @@ def run_training(args):
                 np.savetxt(os.path.join(save_path, 'record.txt'), history_score, fmt = '%10.5f', delimiter=',')
 
                 # apply indicator
-                # if epoch == 1:
-                #     logging.info('initial loss value: {}'.format(epoch_loss))
-                #     my_loss_diff_indicator.scale_loss = epoch_loss
-                if epoch <= 10:
-                    scale_loss += epoch_loss
-                    logging.info('scale_loss at epoch {}: {}'.format(epoch, scale_loss / epoch))
-                    my_loss_diff_indicator.scale_loss = scale_loss / epoch
-                if turning_point_count < args.num_turning_point:
-                    my_loss_diff_indicator.get_loss(epoch_loss)
-                    flag = my_loss_diff_indicator.turning_point_emerge()
-                    if flag == True:
-                        turning_point_count += 1
-                        logging.info('find {}-th turning point at {}-th epoch'.format(turning_point_count, epoch))
-                        # print('find {}-th turning point at {}-th epoch'.format(turning_point_count, epoch))
-                        my_loss_diff_indicator.adaptive_threshold(turning_point_count=turning_point_count)
-                        my_loss_diff_indicator.reset()
+                if not args.indicator_every:
+                    apply_indicator(args, epoch_loss, '{}-th epoch'.format(epoch))
 
                 logging.info('Epoch [{}] num_bits = {} num_grad_bits = {}'.format(epoch, args.num_bits, args.num_grad_bits))
 
@@ -419,19 +469,22 @@ def run_training(args):
 
                 # checkpoint_path = os.path.join(args.save_path, 'checkpoint_{:05d}_{:.2f}.pth.tar'.format(i, prec1))
                 checkpoint_path = os.path.join(args.save_path, 'ckpt.pth.tar')
-                save_checkpoint({
+                checkpoint_writer.save({
                     'iter': i,
                     'arch': args.arch,
                     'state_dict': model.state_dict(),
                     'best_prec1': best_prec1,
+                    'optimizer': optimizer.state_dict(),
+                    'rng': get_rng_state(),
+                    'data_seed': data_sampler(train_loader).seed,
+                    'indicator_loss': float(indicator_loss),
+                    'schedule': schedule.state_dict(),
+                    'indicator': my_loss_diff_indicator.state_dict(),
+                    'turning_point_count': turning_point_count,
                     'swa_state_dict' : swa_model.state_dict() if args.swa_start is not None else None,
                     'swa_n' : swa_n if args.swa_start is not None else None,
                     'best_swa_prec' : best_swa_prec if args.swa_start is not None else None,
-                },
-                    is_best, filename=checkpoint_path)
-                # shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
-                                                              # 'checkpoint_latest'
-                                                              # '.pth.tar'))
+                }, filename=checkpoint_path, is_best=is_best)
 
                 if i == args.iters:
                     print("Best accuracy: "+str(best_prec1))
@@ -439,6 +492,8 @@ def run_training(args):
                     np.savetxt(os.path.join(save_path, 'record.txt'), history_score, fmt = '%10.5f', delimiter=',')
                     break
 
+    checkpoint_writer.close()
+
 
 def validate(args, test_loader, model, criterion, step, swa=False):
     batch_time = AverageMeter()
@@ -544,14 +599,6 @@ def test_model(args):
         prec_full = validate_full_prec(args, test_loader, model, criterion, args.start_iter)
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        save_path = os.path.dirname(filename)
-        shutil.copyfile(filename, os.path.join(save_path,
-                                               'model_best.pth.tar'))
-
-
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -571,66 +618,14 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-schedule_cnt = 0
-def adjust_precision(args, _iter):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.num_bits_schedule) == len(args.schedule) + 1
-        assert len(args.num_grad_bits_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.num_bits = args.num_bits_schedule[0]
-            args.num_grad_bits = args.num_grad_bits_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _iter == step:
-                args.num_bits = args.num_bits_schedule[schedule_cnt]
-                args.num_grad_bits = args.num_grad_bits_schedule[schedule_cnt]
-                schedule_cnt += 1
-
-        if _iter % args.eval_every == 0:
-            logging.info('Iter [{}] num_bits = {} num_grad_bits = {}'.format(_iter, args.num_bits, args.num_grad_bits))
-
-def adaptive_adjust_precision(args, turning_point_count):
-    args.num_bits = args.num_bits_schedule[turning_point_count]
-    args.num_grad_bits = args.num_grad_bits_schedule[turning_point_count]
-
-
-def adjust_learning_rate(args, optimizer, _iter):
-    if args.lr_schedule == 'piecewise':
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif 32000 <= _iter < 48000:
-            lr = args.lr * (args.step_ratio ** 1)
-        elif _iter >= 48000:
-            lr = args.lr * (args.step_ratio ** 2)
-        else:
-            lr = args.lr
-
-    elif args.lr_schedule == 'linear':
-        t = _iter / args.iters
-        lr_ratio = 0.01
-        if args.warm_up and (_iter < 400):
-            lr = 0.01
-        elif t < 0.5:
-            lr = args.lr
-        elif t < 0.9:
-            lr = args.lr * (1 - (1-lr_ratio)*(t-0.5)/0.4)
-        else:
-            lr = args.lr * lr_ratio
-
-    elif args.lr_schedule == 'anneal_cosine':
-        lr_min = args.lr * (args.step_ratio ** 2)
-        lr_max = args.lr
-        lr = lr_min + 1/2 * (lr_max - lr_min) * (1 + np.cos(_iter/args.iters * 3.141592653))
-
-    if _iter % args.eval_every == 0:
-        logging.info('Iter [{}] learning rate = {}'.format(_iter, lr))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+def make_schedule(args):
+    # --warm_up never applied to the cosine schedule, keep its lr curve unchanged
+    warm_up = 400 if args.warm_up and args.lr_schedule != 'anneal_cosine' else 0
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps, step_ratio=args.step_ratio,
+                          total=args.iters, warm_up=warm_up, linear_range=(0.5, 0.9),
+                          phases={'num_bits': args.num_bits_schedule,
+                                  'num_grad_bits': args.num_grad_bits_schedule},
+                          phase_by=args.phase_by, phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -0,0 +1,85 @@
+"""adaptive precision-candidate sets: stop running the candidates a layer's gate never picks
+"""
+
+import numpy as np
+import torch
+
+
+class CandidateManager(object):
+    """Tracks how often every gated layer picks each candidate and disables the rare ones.
+
+    The dense blend runs a block at every candidate and multiplies all but the chosen one by 0,
+    so a candidate a layer picks 0% of the time costs a full block forward and backward for
+    nothing. update() keeps an EMA of the per-layer selection frequencies (the layer x candidate
+    decision counts of the step) on the device; every `check_every` steps it syncs once and
+    disables the candidates whose frequency fell below `threshold`. The most frequent candidate
+    of a layer is never disabled.
+
+    apply() hands the enabled sets to the model: the gate softmax is masked so disabled
+    candidates get probability 0, and the blocks skip them. Skipping is exact, their blend
+    weight was 0. Every `explore_every` steps all candidates are enabled again for exactly
+    `explore_steps` steps, so the gate can move back to a precision it dropped earlier.
+    """
+
+    def __init__(self, num_layers, num_candidates, threshold=0.01, ema=0.99, check_every=100,
+                 explore_every=2000, explore_steps=100):
+        self.num_layers = num_layers
+        self.num_candidates = num_candidates
+        self.threshold = threshold
+        self.ema = ema
+        self.check_every = check_every
+        self.explore_every = explore_every
+        self.explore_steps = explore_steps
+        self.freq = None
+        self.enabled = [[True] * num_candidates for _ in range(num_layers)]
+
+    def update(self, step, counts, batch_size):
+        """Add the layer x candidate decision counts of one step; returns True when the enabled
+        sets changed and have to be applied to the model again"""
+        ratio = counts.detach().float() / batch_size
+        if self.freq is None:
+            self.freq = torch.full_like(ratio, 1.0 / self.num_candidates)
+        self.freq.mul_(self.ema).add_(ratio * (1 - self.ema))
+
+        # the exploration window is a host-side counter, checked on every step; the pruning syncs,
+        # so it only runs every check_every steps and on the step right after a window
+        window_end = self.explore_every and step % self.explore_every == self.explore_steps
+        if self.explore_every and step % self.explore_every < self.explore_steps:
+            enabled = [[True] * self.num_candidates for _ in range(self.num_layers)]
+        elif step % self.check_every == 0 or window_end:
+            freq = self.freq.cpu().numpy()
+            best = freq.argmax(axis=1)
+            enabled = [[bool(freq[l, k] >= self.threshold or k == best[l]) for k in range(self.num_candidates)]
+                       for l in range(self.num_layers)]
+        else:
+            return False
+
+        changed = enabled != self.enabled
+        self.enabled = enabled
+        return changed
+
+    def num_disabled(self):
+        return int(sum(len(e) - sum(e) for e in self.enabled))
+
+    def apply(self, model):
+        """Set model.candidate_sets / candidate_masks, None for both when everything is enabled"""
+        if self.num_disabled() == 0:
+            model.candidate_sets = None
+            model.candidate_masks = None
+            return
+        device = self.freq.device if self.freq is not None else None
+        model.candidate_sets = [[k for k in range(self.num_candidates) if e[k]] for e in self.enabled]
+        model.candidate_masks = [torch.tensor(e, dtype=torch.bool, device=device) for e in self.enabled]
+
+    def state_dict(self):
+        return {
+            'freq': self.freq.cpu().numpy() if self.freq is not None else None,
+            'enabled': self.enabled,
+        }
+
+    def load_state_dict(self, state, device=None):
+        if state is None:
+            return
+        if state['freq'] is not None:
+            self.freq = torch.tensor(np.asarray(state['freq']), device=device)
+        self.enabled = [list(e) for e in state['enabled']]
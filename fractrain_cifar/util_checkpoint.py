@@ -0,0 +1,212 @@
+"""full training-state checkpoints: RNG state, a resumable data order and a background writer
+"""
+
+import math
+import os
+import random
+import shutil
+import threading
+import queue
+from collections import deque
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def get_rng_state():
+    """RNG state of python, numpy, torch and every visible GPU"""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def random_seed():
+    """A data-order seed that differs from run to run: torch's initial seed, random unless the
+    run seeds torch itself. Trainers save the sampler seed in their checkpoints."""
+    return torch.initial_seed() % 2 ** 31
+
+
+class ResumableSampler(Sampler):
+    """Shuffling sampler whose order is a function of (seed, epoch) only, so a resumed run
+    sees the same samples in the same order as the interrupted one.
+
+    Like DistributedSampler, the order is padded to a multiple of num_replicas and every
+    replica reads its own shard. set_epoch(epoch, start) selects the pass and skips the first
+    `start` samples of this replica's shard; after each pass the sampler moves on to the next
+    epoch by itself, so it also works with loops that iterate the loader without set_epoch.
+    The seed defaults to random_seed(); replicas of a distributed run must share it.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = random_seed() if seed is None else seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(data_source) / float(num_replicas)))
+        self.total_size = self.num_samples * num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=g).tolist()
+        else:
+            indices = list(range(n))
+        indices += indices[:self.total_size - n]
+        indices = indices[self.rank:self.total_size:self.num_replicas][self.start:]
+
+        self.epoch += 1
+        self.start = 0
+        return iter(indices)
+
+    def __len__(self):
+        # the full shard, so len(train_loader) does not change for a resumed pass
+        return self.num_samples
+
+
+def data_sampler(train_loader):
+    """The sampler carrying the data order (and its seed) of train_loader"""
+    # a batch sampler with set_epoch (util_sampler.RouteBucketSampler) carries the data order itself
+    return train_loader.batch_sampler if hasattr(train_loader.batch_sampler, 'set_epoch') else train_loader.sampler
+
+
+def resume_data_position(train_loader, step, batch_size, seed=0):
+    """Point a ResumableSampler-backed loader at global step `step` of a run that iterates
+    the loader back to back, with the data-order seed of that run (checkpoints without one
+    used 0). Returns the epoch the step falls in."""
+    epoch, offset = divmod(step, len(train_loader))
+    sampler = data_sampler(train_loader)
+    sampler.seed = seed
+    sampler.set_epoch(epoch, offset * batch_size)
+    return epoch
+
+
+def _snapshot(obj):
+    """Copy of a nested checkpoint state with every tensor copied to the CPU, so training can
+    keep updating the originals while the copy is written"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*[_snapshot(v) for v in obj])
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def _replace_with_link(src, dst):
+    """Atomically point dst at the content of src: a hardlink where the filesystem allows it,
+    a copy otherwise"""
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    save() snapshots the state to CPU memory and returns right away. The thread writes the
+    snapshot once, to a temporary file that is renamed into place, so an interrupted write
+    never leaves a truncated checkpoint behind. checkpoint_latest and, for the best
+    accuracy so far, model_best are hardlinks to that file rather than extra copies.
+
+    With keep_last > 0 only the keep_last most recent named checkpoints are kept. Since
+    latest and best are links of their own, removing an old name never breaks them.
+
+    At most one snapshot waits while another is written; a third save() blocks until the
+    writer catches up. Errors of the writer thread are raised by the next save() / close().
+    """
+
+    def __init__(self, save_path, keep_last=0, latest='checkpoint_latest.pth.tar',
+                 best='model_best.pth.tar'):
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.latest = os.path.join(save_path, latest)
+        self.best = os.path.join(save_path, best)
+
+        self.written = deque()
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, state, filename=None, is_best=False):
+        """Queue a checkpoint. filename=None only refreshes checkpoint_latest."""
+        self._check()
+        self.queue.put((_snapshot(state), filename, is_best))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, filename, is_best):
+        path = filename if filename is not None else self.latest
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        if path != self.latest:
+            _replace_with_link(path, self.latest)
+        if is_best:
+            _replace_with_link(path, self.best)
+
+        if filename is None or not self.keep_last:
+            return
+        if path in self.written:
+            self.written.remove(path)
+        self.written.append(path)
+        while len(self.written) > self.keep_last:
+            os.remove(self.written.popleft())
@@ -0,0 +1,135 @@
+"""cost models for the computation loss: the bit-width proxy and a measured per-layer table
+
+Both give the fw / eb / gc cost of every candidate (bits, grad_bits) relative to the full-precision
+conv. The proxy assumes cost scales with the bit-widths and is the same for every layer, shape
+(candidate,). The measured table times the QConv2d of every gated layer at every candidate on
+this machine, so it also sees the fixed quantization overhead and the steps real kernels take
+at 8 and 16 bits, shape (layer, candidate). Both broadcast against the layer x candidate
+decision counts in computation_costs.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from compute_flops import build, block_convs, conv_output_size, gated_blocks, save_model_info
+
+
+def proxy_cost_tables(bits, grad_bits, weight_bits):
+    """fw: weight x activation, eb: weight x gradient, gc: activation x gradient bit-widths over 32 x 32"""
+    return {
+        'fw': np.array([bit / 32 for bit in bits]) * weight_bits / 32,
+        'eb': np.array([bit / 32 for bit in grad_bits]) * weight_bits / 32,
+        'gc': np.array([bits[i] * grad_bits[i] / 32 / 32 for i in range(len(bits))]),
+    }
+
+
+def _timeit(fn, repeat):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat
+
+
+def time_conv(conv, input, num_bits, num_grad_bits, repeat=10):
+    """(fw, eb, gc) seconds of one QConv2d call: the forward, the input-gradient backward and
+    the weight-gradient backward"""
+    weight = conv.weight
+
+    def forward():
+        with torch.no_grad():
+            conv(input, num_bits, num_grad_bits)
+
+    def backward(input_grad):
+        x = input.detach().requires_grad_(input_grad)
+        weight.requires_grad_(not input_grad)
+        conv(x, num_bits, num_grad_bits).sum().backward()
+        weight.grad = None
+
+    fw = _timeit(forward, repeat)
+    eb = _timeit(lambda: backward(True), repeat) - fw
+    gc = _timeit(lambda: backward(False), repeat) - fw
+    weight.requires_grad_(True)
+    return fw, max(eb, 1e-9), max(gc, 1e-9)
+
+
+def measure_cost_table(model, bits, grad_bits, resolution=32, batch_size=128, repeat=10):
+    """fw / eb / gc time of every gated layer (layer x candidate) relative to its full-precision
+    time. Depthwise convs run at a fixed precision and are left out, as in conv_info."""
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = model.to(device).train()
+
+    size = conv_output_size(model.conv1, (resolution, resolution))
+    tables = {key: [] for key in ('fw', 'eb', 'gc')}
+    for name, block in gated_blocks(model):
+        times = np.zeros((len(bits) + 1, 3))
+        for conv, in_size, out_size, side in block_convs(block, size):
+            if not side:
+                size = out_size
+            if conv.groups != 1:
+                continue
+            input = torch.randn(batch_size, conv.in_channels, in_size[0], in_size[1], device=device)
+            # row 0: the full-precision reference
+            for k, (b, g) in enumerate([(0, 0)] + list(zip(bits, grad_bits))):
+                times[k] += time_conv(conv, input, b, g, repeat)
+        for j, key in enumerate(('fw', 'eb', 'gc')):
+            tables[key].append(times[1:, j] / times[0, j])
+    return {key: np.array(value) for key, value in tables.items()}
+
+
+def cost_table_path(cache_dir, arch, dataset, resolution):
+    return os.path.join(cache_dir, 'cost_table_{}_{}_{}.npy'.format(dataset, arch, resolution))
+
+
+def load_cost_table(arch, dataset, bits, grad_bits, resolution=32, cache_dir='model_info',
+                    batch_size=128, repeat=10):
+    """Measured cost table of arch, benchmarked on first use and cached in cache_dir per
+    (dataset, arch, resolution); re-measured if the cached candidates differ"""
+    path = cost_table_path(cache_dir, arch, dataset, resolution)
+    if os.path.isfile(path):
+        table = np.load(path, allow_pickle=True).item()
+        if list(table['bits']) == list(bits) and list(table['grad_bits']) == list(grad_bits):
+            return table
+
+    table = measure_cost_table(build(arch), bits, grad_bits, resolution, batch_size, repeat)
+    table['bits'] = list(bits)
+    table['grad_bits'] = list(grad_bits)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_model_info(path, table)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the per-layer QConv2d cost table of an arch')
+    parser.add_argument('--arch', required=True, type=str)
+    parser.add_argument('--bits', default=[3, 4, 4, 6, 6], type=int, nargs='*')
+    parser.add_argument('--grad_bits', default=[6, 6, 8, 8, 12], type=int, nargs='*')
+    parser.add_argument('--resolution', default=32, type=int)
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--out_dir', default='model_info', type=str)
+    args = parser.parse_args()
+
+    path = cost_table_path(args.out_dir, args.arch, args.arch.split('_')[0], args.resolution)
+    if os.path.isfile(path):
+        os.remove(path)
+    table = load_cost_table(args.arch, args.arch.split('_')[0], args.bits, args.grad_bits,
+                            args.resolution, args.out_dir, args.batch_size, args.repeat)
+    for key in ('fw', 'eb', 'gc'):
+        print('{} (layer x candidate, relative to full precision):'.format(key))
+        print(np.array2string(table[key], precision=3))
+    print('=> wrote {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
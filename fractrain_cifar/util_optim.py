@@ -0,0 +1,68 @@
+"""optimizer helpers: SGD over the trainable parameters on the multi-tensor path
+"""
+
+import contextlib
+import inspect
+
+import torch
+
+
+def trainable_parameters(model):
+    """Parameters that receive gradients; frozen ones (e.g. the gates after fix_rnn, or
+    everything but the gates with rnn_initial) cost nothing per step if left out"""
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+def make_sgd(params, lr, momentum=0, weight_decay=0):
+    """torch.optim.SGD on the fastest implementation this torch provides: fused (one kernel
+    for all parameters), then foreach (multi-tensor ops), then the per-parameter loop"""
+    params = list(params)
+    kwargs = dict(momentum=momentum, weight_decay=weight_decay)
+    signature = inspect.signature(torch.optim.SGD.__init__).parameters
+
+    if 'fused' in signature and all(p.is_cuda for p in params):
+        return torch.optim.SGD(params, lr, fused=True, **kwargs)
+    if 'foreach' in signature:
+        return torch.optim.SGD(params, lr, foreach=True, **kwargs)
+    # torch 1.7 - 1.11 ship the multi-tensor optimizers as a separate module
+    multi_tensor = getattr(torch.optim, '_multi_tensor', None)
+    if multi_tensor is not None:
+        return multi_tensor.SGD(params, lr, **kwargs)
+    return torch.optim.SGD(params, lr, **kwargs)
+
+
+def unscale_grads_(params, loss_sf):
+    """Divide the gradients of params by the loss scale factor in place"""
+    grads = [p.grad for p in params if p.grad is not None]
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(grads, 1.0 / loss_sf)
+    else:
+        for grad in grads:
+            grad.div_(loss_sf)
+
+
+def scale_lr(lr, batch_size, base_batch_size):
+    """Linear scaling rule: lr tuned for base_batch_size, used at batch_size"""
+    return lr * batch_size / base_batch_size
+
+
+def set_lr(optimizer, lr):
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+
+
+def accumulation_group(i, num_batches, accum_steps):
+    """(size, last) of the gradient accumulation group of loader batch i: the number of
+    micro-batches it accumulates (fewer for the last group of an epoch) and whether batch i
+    closes it, i.e. runs the optimizer step"""
+    start = i - i % accum_steps
+    size = min(accum_steps, num_batches - start)
+    return size, i + 1 == start + size
+
+
+def sync_gradients(model, sync):
+    """Context for the backward of a micro-batch: skips the DistributedDataParallel all-reduce
+    unless the micro-batch closes its accumulation group (sync)"""
+    if sync or not hasattr(model, 'no_sync'):
+        return contextlib.ExitStack()
+    return model.no_sync()
@@ -0,0 +1,151 @@
+"""route-bucketed batches: group training samples by the precision routes the gates gave them
+"""
+
+from collections import deque
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from util_checkpoint import random_seed
+
+
+class RouteBucketSampler(Sampler):
+    """Batch sampler that puts samples with similar cached precision routes into the same batch.
+
+    A sample's route is the candidate its gate chose at every gated layer, the last time it was
+    trained on. Gate decisions of a sample change little from one epoch to the next, so batches
+    of samples with similar routes give the routed blocks a few large homogeneous sub-batches
+    instead of many small ones.
+
+    Every pass draws a (seed, epoch) permutation as ResumableSampler does, with the same default
+    seed. Samples with a route younger than `max_age` epochs are sorted by route (stable, so ties
+    keep the random order); a random `mix` fraction of them and every sample without a fresh route are spread over
+    random positions of that order, then the order is cut into batches and the batch order is
+    shuffled. Routes are recorded by update(), called once per training step: the sampler
+    remembers the batches it handed to the DataLoader, which consumes them in order.
+    """
+
+    def __init__(self, data_source, batch_size, num_layers, shuffle=True, seed=None, drop_last=False,
+                 max_age=1, mix=0.25):
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.num_layers = num_layers
+        self.shuffle = shuffle
+        self.seed = random_seed() if seed is None else seed
+        self.drop_last = drop_last
+        self.max_age = max_age
+        self.mix = mix
+
+        n = len(data_source)
+        self.routes = np.full((n, num_layers), -1, dtype=np.int8)
+        self.route_epoch = np.full(n, -1, dtype=np.int64)
+        self.epoch = 0
+        self.start = 0
+        self.plan = None
+        self.plan_epoch = -1
+        self.issued = deque()
+        self.pending = None
+
+    def set_epoch(self, epoch, start=0):
+        """Select the pass and skip its first `start` samples (whole batches)"""
+        self.epoch = epoch
+        self.start = start
+
+    def _make_plan(self):
+        n = len(self.data_source)
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if not self.shuffle:
+            return np.arange(n)
+        perm = torch.randperm(n, generator=g).numpy()
+        rand = torch.rand(n, generator=g).numpy()
+
+        fresh = (self.route_epoch[perm] >= 0) & (self.epoch - self.route_epoch[perm] <= self.max_age)
+        fresh &= rand >= self.mix
+        bucketed = perm[fresh]
+        # lexsort takes its primary key last: sort on layer 0 first, then layer 1, ...
+        bucketed = bucketed[np.lexsort(self.routes[bucketed].T[::-1])]
+
+        # the bucketed samples sit at evenly spaced keys, the others at uniformly random ones
+        keys = np.empty(n)
+        keys[:len(bucketed)] = (np.arange(len(bucketed)) + 0.5) / max(len(bucketed), 1)
+        keys[len(bucketed):] = torch.rand(n - len(bucketed), generator=g).numpy()
+        order = np.concatenate([bucketed, perm[~fresh]])[np.argsort(keys, kind='stable')]
+
+        # only the full batches are shuffled: a short batch stays last (or is dropped), so
+        # __iter__ cuts the plan at the planned batch boundaries
+        batches = [order[b:b + self.batch_size] for b in range(0, n, self.batch_size)]
+        partial = []
+        if len(batches[-1]) < self.batch_size:
+            partial = [] if self.drop_last else [batches[-1]]
+            batches = batches[:-1]
+        batch_order = torch.randperm(len(batches), generator=g).numpy()
+        planned = [batches[b] for b in batch_order] + partial
+        return np.concatenate(planned) if planned else order[:0]
+
+    def __iter__(self):
+        self._commit()
+        self.issued.clear()
+        # a resumed pass reuses the order the interrupted run had planned for it
+        if self.plan is None or self.plan_epoch != self.epoch:
+            self.plan = self._make_plan()
+            self.plan_epoch = self.epoch
+        plan, start = self.plan, self.start
+        self.epoch += 1
+        self.start = 0
+
+        for b in range(start - start % self.batch_size, len(plan), self.batch_size):
+            batch = plan[b:b + self.batch_size].tolist()
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            self.issued.append(batch)
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.data_source) // self.batch_size
+        return (len(self.data_source) + self.batch_size - 1) // self.batch_size
+
+    def update(self, masks):
+        """Record the routes of the oldest batch handed out; masks is the gated model output
+        (masks[layer][k] the (batch,) decision of candidate k), or None for an ungated step"""
+        if not self.issued:
+            return
+        indices = self.issued.popleft()
+        self._commit()
+        if masks is None:
+            return
+        choice = torch.stack([torch.stack([m.detach().reshape(-1) for m in mask_list], dim=-1)
+                              for mask_list in masks]).argmax(dim=-1).t().to(torch.int8)
+        # copied to the host now, read on the next update: no wait on the current step
+        host = torch.empty(choice.shape, dtype=choice.dtype, pin_memory=choice.is_cuda)
+        host.copy_(choice, non_blocking=choice.is_cuda)
+        event = None
+        if choice.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = (indices, host, event, self.plan_epoch)
+
+    def _commit(self):
+        if self.pending is None:
+            return
+        indices, host, event, epoch = self.pending
+        if event is not None:
+            event.synchronize()
+        self.routes[indices] = host.numpy()
+        self.route_epoch[indices] = epoch
+        self.pending = None
+
+    def state_dict(self):
+        self._commit()
+        return {'routes': self.routes, 'route_epoch': self.route_epoch,
+                'plan': self.plan, 'plan_epoch': self.plan_epoch}
+
+    def load_state_dict(self, state):
+        if state is None:
+            return
+        self.routes = np.asarray(state['routes'], dtype=np.int8)
+        self.route_epoch = np.asarray(state['route_epoch'], dtype=np.int64)
+        self.plan = state['plan']
+        self.plan_epoch = state['plan_epoch']
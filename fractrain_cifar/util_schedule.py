@@ -0,0 +1,106 @@
+"""schedule engine: learning rate, precision and target ratio from one declarative spec
+"""
+
+from bisect import bisect_right
+import math
+
+
+class ScheduleEngine(object):
+    """Co-schedules the learning rate and the per-phase knobs of a run.
+
+    lr_schedule is one of
+        'piecewise'      lr * step_ratio ** (number of lr_steps passed)
+        'linear'         constant, then linear decay to lr * lr_floor over linear_range
+                         (fractions of total), then constant
+        'anneal_cosine'  cosine from lr to lr * step_ratio ** 2 over total
+    with an optional warm-up of warm_up steps (0: none, the default for every schedule),
+    constant at warm_up_lr (warm_up_mode='constant') or linear from warm_up_lr to the lr of
+    step warm_up (warm_up_mode='linear', the gradual warm-up of large-batch training). Steps may be fractional, e.g. epoch + batch / batches.
+
+    phases maps a knob name (num_bits, num_grad_bits, target_ratio, weight_bits, ...) to its
+    value in each phase. The phase is either the number of phase_steps boundaries passed
+    (phase_by='step') or the number of turning points found so far (phase_by='turning_point').
+
+    Both are pure functions of (step, turning points), so a resumed run lands in the right
+    phase directly. The only state is the last applied phase, which is used to report phase
+    switches.
+    """
+
+    def __init__(self, lr, lr_schedule='piecewise', lr_steps=(), step_ratio=0.1, total=None,
+                 warm_up=0, warm_up_lr=0.01, linear_range=(0.5, 0.9), lr_floor=0.01,
+                 phases=None, phase_by='turning_point', phase_steps=(), warm_up_mode='constant'):
+        assert lr_schedule in ('piecewise', 'linear', 'anneal_cosine'), lr_schedule
+        assert warm_up_mode in ('constant', 'linear'), warm_up_mode
+        assert phase_by in ('step', 'turning_point'), phase_by
+        self.base_lr = lr
+        self.lr_schedule = lr_schedule
+        self.lr_steps = sorted(lr_steps)
+        self.step_ratio = step_ratio
+        self.total = total
+        self.warm_up = warm_up
+        self.warm_up_lr = warm_up_lr
+        self.warm_up_mode = warm_up_mode
+        self.linear_range = linear_range
+        self.lr_floor = lr_floor
+
+        self.phases = dict((k, list(v)) for k, v in (phases or {}).items() if v is not None)
+        self.phase_by = phase_by
+        self.phase_steps = sorted(phase_steps or ())
+        if phase_by == 'step':
+            for name, values in self.phases.items():
+                assert len(values) == len(self.phase_steps) + 1, \
+                    '{} needs one value per phase ({})'.format(name, len(self.phase_steps) + 1)
+
+        self.phase = None
+
+    def lr(self, step):
+        if step < self.warm_up:
+            if self.warm_up_mode == 'linear':
+                return self.warm_up_lr + (self.scheduled_lr(self.warm_up) - self.warm_up_lr) * step / self.warm_up
+            return self.warm_up_lr
+        return self.scheduled_lr(step)
+
+    def scheduled_lr(self, step):
+        if self.lr_schedule == 'piecewise':
+            return self.base_lr * self.step_ratio ** bisect_right(self.lr_steps, step)
+
+        t = step / self.total
+        if self.lr_schedule == 'linear':
+            start, end = self.linear_range
+            if t < start:
+                return self.base_lr
+            if t < end:
+                return self.base_lr * (1 - (1 - self.lr_floor) * (t - start) / (end - start))
+            return self.base_lr * self.lr_floor
+
+        lr_min = self.base_lr * self.step_ratio ** 2
+        return lr_min + 0.5 * (self.base_lr - lr_min) * (1 + math.cos(t * math.pi))
+
+    def phase_index(self, step, turning_points=0):
+        if self.phase_by == 'step':
+            return bisect_right(self.phase_steps, step)
+        return turning_points
+
+    def values(self, step, turning_points=0):
+        phase = self.phase_index(step, turning_points)
+        return dict((name, values[min(phase, len(values) - 1)]) for name, values in self.phases.items())
+
+    def apply(self, step, args, optimizer, turning_points=0):
+        """Set the lr of every param group and the phase knobs on args.
+        Returns (lr, changed), where changed is True if the phase switched on this call."""
+        lr = self.lr(step)
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+
+        phase = self.phase_index(step, turning_points)
+        changed = phase != self.phase
+        self.phase = phase
+        for name, value in self.values(step, turning_points).items():
+            setattr(args, name, value)
+        return lr, changed
+
+    def state_dict(self):
+        return {'phase': self.phase}
+
+    def load_state_dict(self, state):
+        self.phase = state['phase']
@@ -2,9 +2,15 @@ import torch
 import os
 
 def moving_average(net1, net2, alpha=1):
-    for param1, param2 in zip(net1.parameters(), net2.parameters()):
-        param1.data *= (1.0 - alpha)
-        param1.data += param2.data * alpha
+    """net1 <- (1 - alpha) * net1 + alpha * net2, in place over all parameters at once"""
+    params1 = [p.data for p in net1.parameters()]
+    params2 = [p.data for p in net2.parameters()]
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(params1, 1.0 - alpha)
+        torch._foreach_add_(params1, params2, alpha=alpha)
+    else:
+        for param1, param2 in zip(params1, params2):
+            param1.mul_(1.0 - alpha).add_(param2, alpha=alpha)
 
 
 def _check_bn(module, flag):
@@ -34,11 +40,26 @@ def _set_momenta(module, momenta):
         module.momentum = momenta[module]
 
 
+def cache_bn_batches(loader, num_batches):
+    """
+        Pre-load the first num_batches input batches of loader onto the GPU,
+        as a small BN-recalibration set for bn_update.
+        :return: list of (input, None)
+    """
+    batches = []
+    for input, _ in loader:
+        if len(batches) == num_batches:
+            break
+        batches.append((input.cuda(non_blocking=True), None))
+    return batches
+
+
 def bn_update(loader, model, num_bits, num_grad_bits):
     """
         BatchNorm buffers update (if any).
         Performs 1 epochs to estimate buffers average using train dataset.
-        :param loader: train dataset loader for buffers average estimation.
+        :param loader: train dataset loader for buffers average estimation,
+                       or a list of cached batches from cache_bn_batches.
         :param model: model being update
         :return: None
     """
@@ -51,16 +72,16 @@ def bn_update(loader, model, num_bits, num_grad_bits):
     n = 0
 
     print("SWA Update BN...")
-    for input, _ in loader:
-        input = input.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        b = input_var.data.size(0)
+    with torch.no_grad():
+        for input, _ in loader:
+            input = input.cuda(non_blocking=True)
+            b = input.size(0)
 
-        momentum = b / (n + b)
-        for module in momenta.keys():
-            module.momentum = momentum
+            momentum = b / (n + b)
+            for module in momenta.keys():
+                module.momentum = momentum
 
-        model(input_var, num_bits, num_grad_bits)
-        n += b
+            model(input, num_bits, num_grad_bits)
+            n += b
 
-    model.apply(lambda module: _set_momenta(module, momenta))
\ No newline at end of file
+    model.apply(lambda module: _set_momenta(module, momenta))
@@ -0,0 +1,118 @@
+"""gate-decision telemetry: per-layer / per-class decision counts appended to a binary log
+"""
+
+import json
+import os
+import threading
+import queue
+
+import numpy as np
+import torch
+
+
+def record_dtype(num_layers, num_candidates, num_classes):
+    """One log record: the decisions of `samples` samples up to global step `step`.
+
+    counts[layer, k] is how many samples took candidate k at that layer, class_counts[layer, c, k]
+    the same restricted to samples of class c.
+    """
+    return np.dtype([
+        ('step', '<i8'),
+        ('samples', '<i8'),
+        ('counts', '<i4', (num_layers, num_candidates)),
+        ('class_counts', '<i4', (num_layers, num_classes, num_candidates)),
+    ])
+
+
+def load_decisions(path):
+    """Read a decision log written by DecisionTelemetry as a numpy structured array"""
+    with open(path + '.json') as f:
+        header = json.load(f)
+    dtype = record_dtype(header['num_layers'], header['num_candidates'], header['num_classes'])
+    return np.fromfile(path, dtype=dtype)
+
+
+class DecisionTelemetry(object):
+    """Accumulates gate decisions on the device and appends them to `path` every `interval` steps.
+
+    update() only adds the batch into two device tensors, so it does not sync the host. A flush
+    starts an asynchronous copy of the sums to pinned host memory and hands it to a background
+    thread, which waits for the copy and appends one fixed-size record (see record_dtype) to the
+    log. `path`.json describes the record layout; load_decisions() reads the log back.
+    """
+
+    def __init__(self, path, num_layers, num_candidates, num_classes, interval=100):
+        self.path = path
+        self.interval = interval
+        self.dtype = record_dtype(num_layers, num_candidates, num_classes)
+        self.shape = (num_layers, num_candidates)
+        self.num_classes = num_classes
+
+        if not os.path.exists(path + '.json'):
+            with open(path + '.json', 'w') as f:
+                json.dump({'num_layers': num_layers, 'num_candidates': num_candidates,
+                           'num_classes': num_classes, 'dtype': str(self.dtype)}, f)
+
+        self.counts = None
+        self.class_counts = None
+        self.samples = 0
+
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, name='decision-telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, step, masks, target):
+        """Add one batch: masks[layer][k] is the (batch,) hard decision of candidate k"""
+        decisions = torch.stack([torch.stack([m.detach().reshape(-1) for m in mask_list], dim=-1)
+                                 for mask_list in masks]).round_().long()
+        if self.counts is None:
+            self.counts = decisions.new_zeros(self.shape)
+            self.class_counts = decisions.new_zeros(self.shape[0], self.num_classes, self.shape[1])
+        self.counts += decisions.sum(1)
+        self.class_counts.index_add_(1, target.view(-1), decisions)
+        self.samples += target.numel()
+
+        if self.interval and step % self.interval == 0:
+            self.flush(step)
+
+    def flush(self, step):
+        if self.counts is None or not self.samples:
+            return
+        pin = self.counts.is_cuda
+        host = [torch.empty(t.shape, dtype=t.dtype, pin_memory=pin) for t in (self.counts, self.class_counts)]
+        for dst, src in zip(host, (self.counts, self.class_counts)):
+            dst.copy_(src, non_blocking=pin)
+        event = None
+        if pin:
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((step, self.samples, host, event))
+
+        # fresh accumulators: the old ones may still be read by the pending copy
+        self.counts = torch.zeros_like(self.counts)
+        self.class_counts = torch.zeros_like(self.class_counts)
+        self.samples = 0
+
+    def close(self, step=None):
+        if step is not None:
+            self.flush(step)
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        with open(self.path, 'ab') as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                step, samples, (counts, class_counts), event = item
+                if event is not None:
+                    event.synchronize()
+                record = np.zeros((), dtype=self.dtype)
+                record['step'] = step
+                record['samples'] = samples
+                record['counts'] = counts.numpy()
+                record['class_counts'] = class_counts.numpy()
+                f.write(record.tobytes())
+                f.flush()
@@ -8,13 +8,15 @@ import torchvision
 import torchvision.transforms as transforms
 import numpy as np
 
+from util_checkpoint import ResumableSampler, random_seed
+
 
 crop_size = 32
 padding = 4
 
 
 def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_size=128,
-                       shuffle=True, num_workers=4):
+                       shuffle=True, num_workers=4, distributed=False):
 
     if 'cifar' in dataset:
         transform_train = transforms.Compose([
@@ -29,7 +31,7 @@ def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_si
             root=datadir, train=True, download=True, transform=transform_train)
         train_loader = torch.utils.data.DataLoader(trainset,
                                                    batch_size=batch_size,
-                                                   shuffle=shuffle,
+                                                   sampler=ResumableSampler(trainset, shuffle=shuffle),
                                                    num_workers=num_workers)
     
     if 'imagenet' in dataset:
@@ -42,8 +44,17 @@ def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_si
                 transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
             ]))
+        # each process of a distributed run reads its own shard of the order rank 0 seeds
+        if distributed:
+            seed = torch.tensor([random_seed()], device='cuda')
+            torch.distributed.broadcast(seed, 0)
+            sampler = ResumableSampler(train_dataset, shuffle=shuffle, seed=int(seed.item()),
+                                       num_replicas=torch.distributed.get_world_size(),
+                                       rank=torch.distributed.get_rank())
+        else:
+            sampler = ResumableSampler(train_dataset, shuffle=shuffle)
         train_loader = torch.utils.data.DataLoader(
-              train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+              train_dataset, batch_size=batch_size, num_workers=num_workers, sampler=sampler)
 
     elif 'svhn' in dataset:
         transform_train =transforms.Compose([
@@ -75,13 +86,21 @@ def prepare_train_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_si
 
         train_loader = torch.utils.data.DataLoader(total_data,
                                                    batch_size=batch_size,
-                                                   shuffle=shuffle,
+                                                   sampler=ResumableSampler(total_data, shuffle=shuffle),
                                                    num_workers=num_workers)
     else:
         train_loader = None
     return train_loader
 
 
+def set_train_resolution(train_loader, resolution):
+    """Output size of the RandomResizedCrop of the training transform. The loader workers
+    copy the dataset when an iteration starts, so the new size applies from the next epoch."""
+    for t in train_loader.dataset.transform.transforms:
+        if isinstance(t, transforms.RandomResizedCrop):
+            t.size = (resolution, resolution)
+
+
 def prepare_test_data(dataset='cifar10', datadir='/home/yf22/dataset', batch_size=128,
                       shuffle=False, num_workers=4):
 
@@ -231,10 +231,9 @@ class RNNGate(nn.Module):
 
     def init_hidden(self, batch_size):
         # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()),
-                autograd.Variable(torch.zeros(1, batch_size,
-                                              self.hidden_dim).cuda()))
+        device = self.proj.weight.device
+        return (torch.zeros(1, batch_size, self.hidden_dim, device=device),
+                torch.zeros(1, batch_size, self.hidden_dim, device=device))
 
     def repackage_hidden(self):
         self.hidden_one = repackage_hidden(self.hidden_one)
@@ -263,17 +262,14 @@ class RNNGate(nn.Module):
         
         # x_two = prob_two.detach().cpu().numpy()
         
-        x_one = prob.detach().cpu().numpy()
-        
-        hard = (x_one == x_one.max(axis=1)[:,None]).astype(int)
-        hard = torch.from_numpy(hard)
-        hard = hard.cuda()
+        # hard decision on device, no host round-trip (keeps the step graph-capturable)
+        prob_detach = prob.detach()
+        hard = (prob_detach == prob_detach.max(dim=1, keepdim=True)[0]).float()
         
         # x_two = hard.float().detach() - \
               # prob_two.detach() + prob_two
             
-        x_one = hard.float().detach() - \
-                prob.detach() + prob
+        x_one = hard - prob_detach + prob
              
         # print(x_one)
 
@@ -301,15 +297,16 @@ class ResNet_RNN(nn.Module):
         self.bn1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.gate_layer1 = nn.Sequential(nn.AvgPool2d(56),
+        # adaptive pooling everywhere, so any input resolution works (progressive resizing)
+        self.gate_layer1 = nn.Sequential(nn.AdaptiveAvgPool2d(1),
                 nn.Conv2d(in_channels=64, out_channels=self.embed_dim, kernel_size=1, stride=1))
 
-        self.layer1 = self._make_group(block, 64, layers[0], group_id=1, pool_size=56)
-        self.layer2 = self._make_group(block, 128, layers[1], group_id=2, pool_size=28)
-        self.layer3 = self._make_group(block, 256, layers[2], group_id=3, pool_size=14)
-        self.layer4 = self._make_group(block, 512, layers[3], group_id=4, pool_size=7)
+        self.layer1 = self._make_group(block, 64, layers[0], group_id=1)
+        self.layer2 = self._make_group(block, 128, layers[1], group_id=2)
+        self.layer3 = self._make_group(block, 256, layers[2], group_id=3)
+        self.layer4 = self._make_group(block, 512, layers[3], group_id=4)
 
-        self.avgpool = nn.AvgPool2d(7)
+        self.avgpool = nn.AdaptiveAvgPool2d(1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
 
         for m in self.modules():
@@ -327,7 +324,7 @@ class ResNet_RNN(nn.Module):
                 m.weight.data.normal_(0, math.sqrt(2. / n))
 
 
-    def _make_group(self, block, planes, layers, group_id, pool_size):
+    def _make_group(self, block, planes, layers, group_id):
         """ Create the whole group"""
         for i in range(layers):
             if group_id > 1 and i == 0:
@@ -335,13 +332,13 @@ class ResNet_RNN(nn.Module):
             else:
                 stride = 1
 
-            layer, gate_layer = self._make_layer(block, planes, stride=stride, pool_size=pool_size)
+            layer, gate_layer = self._make_layer(block, planes, stride=stride)
 
             setattr(self, 'group{}_layer{}'.format(group_id, i), layer)
             setattr(self, 'group{}_gate{}'.format(group_id, i), gate_layer)
 
 
-    def _make_layer(self, block, planes, pool_size, stride=1):
+    def _make_layer(self, block, planes, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
@@ -354,7 +351,7 @@ class ResNet_RNN(nn.Module):
         self.inplanes = planes * block.expansion
 
         gate_layer = nn.Sequential(
-            nn.AvgPool2d(pool_size),
+            nn.AdaptiveAvgPool2d(1),
             nn.Conv2d(in_channels=planes * block.expansion,
                       out_channels=self.embed_dim,
                       kernel_size=1,
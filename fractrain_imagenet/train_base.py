@@ -13,6 +13,9 @@ import time
 import logging
 
 import models
+from util_optim import trainable_parameters, make_sgd
+from util_schedule import ScheduleEngine
+from modules.quantize import autocast, set_running_stats_update
 from data import *
 
 
@@ -62,6 +65,9 @@ def parse_args():
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=None, type=int, nargs='*',
+                        help='epochs at which the piecewise learning rate decays by step_ratio '
+                             '(default: every 30 epochs)')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
@@ -92,6 +98,11 @@ def parse_args():
                         help='precision of weight')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
     args = parser.parse_args()
     return args
 
@@ -138,6 +149,8 @@ def run_training(args):
     best_prec1 = 0
     best_full_prec = 0
 
+    schedule = make_schedule(args)
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
@@ -146,6 +159,8 @@ def run_training(args):
             args.start_epoch = checkpoint['epoch']
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
             logging.info('=> loaded checkpoint `{}` (epoch: {})'.format(
                 args.resume, checkpoint['epoch']
             ))
@@ -168,9 +183,10 @@ def run_training(args):
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params, args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
 
     # optimizer = torch.optim.Adam(model.parameters(), args.lr,
     #                             weight_decay=args.weight_decay)
@@ -184,8 +200,7 @@ def run_training(args):
     end = time.time()
 
     for _epoch in range(args.start_epoch, args.epoch):
-        lr = adjust_learning_rate(args, optimizer, _epoch)
-        adjust_precision(args, _epoch)
+        lr, _ = schedule.apply(_epoch, args, optimizer)
 
         print('Learning Rate:', lr)
         print('num bits:', args.num_bits, 'num grad bits:', args.num_grad_bits)
@@ -195,6 +210,7 @@ def run_training(args):
             data_time.update(time.time() - end)
 
             model.train()
+            set_running_stats_update(model, i % args.qparams_every == 0)
 
             fw_cost = args.num_bits*args.num_bits/32/32
             eb_cost = args.num_bits*args.num_grad_bits/32/32
@@ -206,7 +222,9 @@ def run_training(args):
             target_var = Variable(target).cuda()
 
             # compute output
-            output = model(input_var, args.num_bits, args.num_grad_bits)
+            with autocast(args.bf16):
+                output = model(input_var, args.num_bits, args.num_grad_bits)
+            output = output.float()
             loss = criterion(output, target_var)
 
             # measure accuracy and record loss
@@ -256,6 +274,7 @@ def run_training(args):
             'arch': args.arch,
             'state_dict': model.state_dict(),
             'best_prec1': best_prec1,
+            'schedule': schedule.state_dict(),
         },
             is_best, filename=checkpoint_path)
         shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
@@ -391,33 +410,12 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-schedule_cnt = 0
-def adjust_precision(args, _epoch):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.num_bits_schedule) == len(args.schedule) + 1
-        assert len(args.num_grad_bits_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.num_bits = args.num_bits_schedule[0] 
-            args.num_grad_bits = args.num_grad_bits_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _epoch == step:
-                args.num_bits = args.num_bits_schedule[schedule_cnt]
-                args.num_grad_bits = args.num_grad_bits_schedule[schedule_cnt] 
-                schedule_cnt += 1
-
-
-def adjust_learning_rate(args, optimizer, _epoch):
-    lr = args.lr * (0.1 ** (_epoch // 30))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-    return lr
+def make_schedule(args):
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps or range(30, args.epoch, 30), step_ratio=args.step_ratio,
+                          total=args.epoch,
+                          phases={'num_bits': args.num_bits_schedule,
+                                  'num_grad_bits': args.num_grad_bits_schedule} if args.schedule else None,
+                          phase_by='step', phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
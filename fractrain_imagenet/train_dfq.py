@@ -9,12 +9,16 @@ import numpy as np
 from functools import reduce
 
 import os
-import shutil
 import argparse
 import time
 import logging
 
 import models
+from util_optim import trainable_parameters, make_sgd, scale_lr, set_lr, accumulation_group, sync_gradients
+from util_schedule import ScheduleEngine
+from util_checkpoint import get_rng_state, set_rng_state, AsyncCheckpointWriter
+from util_telemetry import DecisionTelemetry
+from modules.quantize import autocast, set_running_stats_update
 from data import *
 
 
@@ -48,6 +52,15 @@ def parse_args():
                         help='manual iter number (useful on restarts)')
     parser.add_argument('--batch_size', default=256, type=int,
                         help='mini-batch size (default: 128)')
+    parser.add_argument('--accum_steps', default=1, type=int,
+                        help='split every --batch_size batch into this many micro-batches and accumulate '
+                             'their gradients, for batch sizes that do not fit in memory (default: 1)')
+    parser.add_argument('--lr_base_batch', default=0, type=int,
+                        help='scale --lr linearly by batch_size / lr_base_batch (default: 0, no scaling)')
+    parser.add_argument('--warmup_epochs', default=0, type=float,
+                        help='ramp the lr up linearly, every iteration, over this many epochs (default: 0)')
+    parser.add_argument('--warmup_lr', default=0, type=float,
+                        help='lr the warm-up starts from (default: 0)')
     parser.add_argument('--lr_schedule', default='piecewise', type=str,
                         help='learning rate schedule')
     parser.add_argument('--lr', default=0.1, type=float,
@@ -58,18 +71,30 @@ def parse_args():
                         help='weight decay (default: 1e-4)')
     parser.add_argument('--print_freq', default=10, type=int,
                         help='print frequency (default: 10)')
+    parser.add_argument('--checkpoint_every', default=0, type=int,
+                        help='also write checkpoint_latest every N iterations within an epoch (default: 0, off)')
+    parser.add_argument('--telemetry_every', default=0, type=int,
+                        help='append the per-layer and per-class gate decision counts to decisions_train.bin every '
+                             'N iterations, and those of each validation to decisions_val.bin (default: 0, off)')
     parser.add_argument('--resume', default='', type=str,
                         help='path to  latest checkpoint (default: None)')
     parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=None, type=int, nargs='*',
+                        help='epochs at which the piecewise learning rate decays by step_ratio '
+                             '(default: every 30 epochs)')
+    parser.add_argument('--phase_by', default='step', type=str, choices=['step', 'turning_point'],
+                        help='switch precision / target ratio phases at --schedule steps or at loss turning points')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
     parser.add_argument('--save_folder', default='save_checkpoints',
                         type=str,
                         help='folder to save the checkpoints')
+    parser.add_argument('--keep_last', default=3, type=int,
+                        help='number of per-epoch checkpoints to keep, 0 keeps all (default: 3)')
     parser.add_argument('--eval_every', default=390, type=int,
                         help='evaluate model every (default: 1000) iterations')
     parser.add_argument('--num_bits',default=0,type=int,
@@ -98,6 +123,11 @@ def parse_args():
                         help='schedule for target compression ratio')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
     parser.add_argument('--relax', default=0, type=float,
                         help='relax parameter for target ratio') 
     parser.add_argument('--beta', default=1e-3, type=float,
@@ -122,6 +152,8 @@ def main():
     models.MOMENTUM = args.momentum_act
 
     args.num_bits = args.num_bits if not (args.act_fw + args.act_bw + args.grad_act_error + args.grad_act_gc + args.weight_bits) else -1
+    if args.lr_base_batch:
+        args.lr = scale_lr(args.lr, args.batch_size, args.lr_base_batch)
 
     # config logging file
     args.logger_file = os.path.join(save_path, 'log_{}.txt'.format(args.cmd))
@@ -177,14 +209,23 @@ def run_training(args):
     best_epoch = 0
     best_full_prec = 0
 
+    checkpoint_writer = AsyncCheckpointWriter(args.save_path, keep_last=args.keep_last)
+    schedule = make_schedule(args)
+    resume_state = None
+    start_iter = 0
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
             logging.info('=> loading checkpoint `{}`'.format(args.resume))
             checkpoint = torch.load(args.resume)
             args.start_epoch = checkpoint['epoch']
+            start_iter = checkpoint.get('iter', 0)
+            resume_state = checkpoint
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
             logging.info('=> loaded checkpoint `{}` (epoch: {})'.format(
                 args.resume, checkpoint['epoch']
             ))
@@ -195,7 +236,7 @@ def run_training(args):
 
     train_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir+'/train',
-                                      batch_size=args.batch_size,
+                                      batch_size=args.batch_size // args.accum_steps,
                                       shuffle=True,
                                       num_workers=args.workers)
     test_loader = prepare_test_data(dataset=args.dataset,
@@ -207,9 +248,10 @@ def run_training(args):
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params, args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -230,26 +272,70 @@ def run_training(args):
             ratio = AverageMeter()
             layerwise_decision_statistics[k].append(ratio)
 
+    telemetry = None
+    if args.telemetry_every:
+        telemetry = DecisionTelemetry(os.path.join(args.save_path, 'decisions_train.bin'),
+                                      network_depth, len(bits), model.module.fc.out_features,
+                                      interval=args.telemetry_every)
+
     end = time.time()
 
+    def training_state(epoch, step):
+        # everything needed to resume at batch `step` of epoch `epoch`
+        return {
+            'epoch': epoch,
+            'iter': step,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_prec1': best_prec1,
+            'optimizer': optimizer.state_dict(),
+            'rng': get_rng_state(),
+            'data_seed': train_loader.sampler.seed,
+            'schedule': schedule.state_dict(),
+        }
+
+    if resume_state is not None:
+        # continue exactly where the interrupted run stopped
+        if resume_state.get('optimizer') is not None:
+            optimizer.load_state_dict(resume_state['optimizer'])
+        # the data order of the interrupted run (checkpoints without a seed used 0)
+        train_loader.sampler.seed = resume_state.get('data_seed', 0)
+        if resume_state.get('rng') is not None:
+            set_rng_state(resume_state['rng'])
+
     for _epoch in range(args.start_epoch, args.epoch):
-        lr = adjust_learning_rate(args, optimizer, _epoch)
-        adjust_target_ratio(args, _epoch)
+        lr, _ = schedule.apply(_epoch, args, optimizer, turning_point_count=0)
 
         print('Learning Rate:', lr)
         print('Target Ratio:', args.target_ratio)
 
-        for i, (input, target) in enumerate(train_loader):
+        # a resumed epoch skips the batches its checkpoint has already seen
+        epoch_start = start_iter if _epoch == args.start_epoch else 0
+        train_loader.sampler.set_epoch(_epoch, epoch_start * train_loader.batch_size)
+        step_cost = [0., 0., 0., 0.]
+        for i, (input, target) in enumerate(train_loader, epoch_start):
             # measuring data loading time            
             data_time.update(time.time() - end)
 
             model.train()
+            set_running_stats_update(model, i % args.qparams_every == 0)
+
+            # loader batches are micro-batches, every `accum` of them make one optimizer step
+            accum, step_end = accumulation_group(i, len(train_loader), args.accum_steps)
+            step_start = i % args.accum_steps == 0 or i == epoch_start
+            if step_start:
+                # fw, eb, gc and full computation of the micro-batches of this step
+                step_cost = [0., 0., 0., 0.]
+            if _epoch < args.warmup_epochs:
+                set_lr(optimizer, schedule.lr(_epoch + float(i) / len(train_loader)))
 
             target = target.squeeze().long().cuda()
             input_var = Variable(input).cuda()
             target_var = Variable(target).cuda()
 
-            output, masks = model(input_var, bits, grad_bits)
+            with autocast(args.bf16):
+                output, masks = model(input_var, bits, grad_bits)
+            output = output.float()
             
             computation_cost_fw = 0
             computation_cost_eb = 0
@@ -274,13 +360,22 @@ def run_training(args):
                     computation_cost_eb += masks[layer][k].sum() * cost_eb[k]
                     computation_cost_gc += masks[layer][k].sum() * cost_gc[k]
             
+            if telemetry is not None:
+                telemetry.update(_epoch * len(train_loader) + i, masks, target)
+
             computation_cost = computation_cost_fw + computation_cost_eb + computation_cost_gc
 
-            cp_ratio_fw = (float(computation_cost_fw) / float(computation_all)) * 100
-            cp_ratio_eb = (float(computation_cost_eb) / float(computation_all)) * 100
-            cp_ratio_gc = (float(computation_cost_gc) / float(computation_all)) * 100
+            # cp_ratio of the step so far, so the computation loss follows the whole batch
+            step_cost[0] += float(computation_cost_fw)
+            step_cost[1] += float(computation_cost_eb)
+            step_cost[2] += float(computation_cost_gc)
+            step_cost[3] += float(computation_all)
+
+            cp_ratio_fw = (step_cost[0] / step_cost[3]) * 100
+            cp_ratio_eb = (step_cost[1] / step_cost[3]) * 100
+            cp_ratio_gc = (step_cost[2] / step_cost[3]) * 100
 
-            cp_ratio = (float(computation_cost) / float(computation_all*3)) * 100
+            cp_ratio = ((step_cost[0] + step_cost[1] + step_cost[2]) / (step_cost[3] * 3)) * 100
                 
             computation_cost *= args.beta
 
@@ -296,7 +391,8 @@ def run_training(args):
             loss_cls = criterion(output, target_var)
 
             if args.computation_cost:
-                loss = loss_cls + computation_cost * reg
+                # computation_cost sums over the micro-batch: scale it to the full batch, like the mean loss_cls
+                loss = loss_cls + computation_cost * accum * reg
             else:
                 loss = loss_cls
 
@@ -305,20 +401,27 @@ def run_training(args):
             losses.update(loss.item(), input.size(0))
             top1.update(prec1.item(), input.size(0))
 
-            cp_record.update(cp_ratio,1)
-            cp_record_fw.update(cp_ratio_fw,1)
-            cp_record_eb.update(cp_ratio_eb,1)
-            cp_record_gc.update(cp_ratio_gc,1)
+            if step_end:
+                cp_record.update(cp_ratio,1)
+                cp_record_fw.update(cp_ratio_fw,1)
+                cp_record_eb.update(cp_ratio_eb,1)
+                cp_record_gc.update(cp_ratio_gc,1)
 
             # compute gradient and do SGD step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            if step_start:
+                optimizer.zero_grad()
+            with sync_gradients(model, step_end):
+                (loss / accum).backward()
+            if step_end:
+                optimizer.step()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
+            if args.checkpoint_every and (i + 1) % args.checkpoint_every == 0 and step_end:
+                checkpoint_writer.save(training_state(_epoch, i + 1))
+
             # print log
             if i % args.print_freq == 0:
                 logging.info("Iter: [{0}][{1}/{2}]\t"
@@ -357,17 +460,11 @@ def run_training(args):
         #print("Current Best Full Prec@1: ", best_full_prec)
         
         checkpoint_path = os.path.join(args.save_path, 'checkpoint_{:05d}_{:.2f}.pth.tar'.format(_epoch, prec1))
-        save_checkpoint({
-            'epoch': _epoch,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_prec1': best_prec1,
-        },
-            is_best, filename=checkpoint_path)
-        shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
-                                                      'checkpoint_latest'
-                                                      '.pth.tar'))
+        checkpoint_writer.save(training_state(_epoch + 1, 0), filename=checkpoint_path, is_best=is_best)
 
+    if telemetry is not None:
+        telemetry.close(args.epoch * len(train_loader))
+    checkpoint_writer.close()
 
 
 def validate(args, test_loader, model, criterion, _epoch):
@@ -415,6 +512,13 @@ def validate(args, test_loader, model, criterion, _epoch):
             ratio = AverageMeter()
             layerwise_decision_statistics[k].append(ratio)
 
+    # one record per validation, written when it ends
+    telemetry = None
+    if args.telemetry_every:
+        telemetry = DecisionTelemetry(os.path.join(args.save_path, 'decisions_val.bin'),
+                                      network_depth, len(bits), model.module.fc.out_features,
+                                      interval=0)
+
     model.eval()
     end = time.time()
     for i, (input, target) in enumerate(test_loader):
@@ -447,6 +551,9 @@ def validate(args, test_loader, model, criterion, _epoch):
                 computation_cost_eb += masks[layer][k].sum() * cost_eb[k]
                 computation_cost_gc += masks[layer][k].sum() * cost_gc[k]
         
+        if telemetry is not None:
+            telemetry.update(_epoch, masks, target)
+
         computation_cost = computation_cost_fw + computation_cost_eb + computation_cost_gc
 
         cp_ratio_fw = (float(computation_cost_fw) / float(computation_all)) * 100
@@ -493,6 +600,9 @@ def validate(args, test_loader, model, criterion, _epoch):
             )
 
     logging.info('Epoch {} * Prec@1 {top1.avg:.3f}'.format(_epoch, top1=top1))
+
+    if telemetry is not None:
+        telemetry.close(_epoch)
     
     for layer in range(network_depth):
         print('layer{}_decision'.format(layer + 1))
@@ -567,14 +677,6 @@ def test_model(args):
         # prec_full = validate_full_prec(args, test_loader, model, criterion, args.start_iter)
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        save_path = os.path.dirname(filename)
-        shutil.copyfile(filename, os.path.join(save_path,
-                                               'model_best.pth.tar'))
-
-
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -594,30 +696,11 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-schedule_cnt = 0
-def adjust_target_ratio(args, _epoch):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.target_ratio_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.target_ratio = args.target_ratio_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _epoch == step:
-                args.target_ratio = args.target_ratio_schedule[schedule_cnt]
-                schedule_cnt += 1
-
-
-def adjust_learning_rate(args, optimizer, _epoch):
-    lr = args.lr * (0.1 ** (_epoch // 30))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-    return lr
+def make_schedule(args):
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps or range(30, args.epoch, 30), step_ratio=args.step_ratio,
+                          total=args.epoch, warm_up=args.warmup_epochs, warm_up_lr=args.warmup_lr, warm_up_mode='linear', linear_range=(0.25, 0.75),
+                          phases={'target_ratio': args.target_ratio_schedule},
+                          phase_by=args.phase_by, phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
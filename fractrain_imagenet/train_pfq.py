@@ -7,12 +7,17 @@ from torch.autograd import Variable
 import numpy as np
 
 import os
-import shutil
 import argparse
 import time
 import logging
 
 import models
+from util_optim import trainable_parameters, make_sgd, scale_lr, set_lr, accumulation_group, sync_gradients
+from util_schedule import ScheduleEngine
+from util_checkpoint import get_rng_state, set_rng_state, AsyncCheckpointWriter
+from util_indicator import LossDiffIndicator
+import util_dist
+from modules.quantize import autocast, set_running_stats_update, calibrate, load_calibration
 from data import *
 
 
@@ -46,6 +51,15 @@ def parse_args():
                         help='manual iter number (useful on restarts)')
     parser.add_argument('--batch_size', default=256, type=int,
                         help='mini-batch size (default: 128)')
+    parser.add_argument('--accum_steps', default=1, type=int,
+                        help='split every --batch_size batch into this many micro-batches and accumulate '
+                             'their gradients, for batch sizes that do not fit in memory (default: 1)')
+    parser.add_argument('--lr_base_batch', default=0, type=int,
+                        help='scale --lr linearly by batch_size / lr_base_batch (default: 0, no scaling)')
+    parser.add_argument('--warmup_epochs', default=0, type=float,
+                        help='ramp the lr up linearly, every iteration, over this many epochs (default: 0)')
+    parser.add_argument('--warmup_lr', default=0, type=float,
+                        help='lr the warm-up starts from (default: 0)')
     parser.add_argument('--lr_schedule', default='piecewise', type=str,
                         help='learning rate schedule')
     parser.add_argument('--lr', default=0.1, type=float,
@@ -56,18 +70,27 @@ def parse_args():
                         help='weight decay (default: 1e-4)')
     parser.add_argument('--print_freq', default=10, type=int,
                         help='print frequency (default: 10)')
+    parser.add_argument('--checkpoint_every', default=0, type=int,
+                        help='also write checkpoint_latest every N iterations within an epoch (default: 0, off)')
     parser.add_argument('--resume', default='', type=str,
                         help='path to  latest checkpoint (default: None)')
     parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                         help='use pretrained model')
     parser.add_argument('--step_ratio', default=0.1, type=float,
                         help='ratio for learning rate deduction')
+    parser.add_argument('--lr_steps', default=None, type=int, nargs='*',
+                        help='epochs at which the piecewise learning rate decays by step_ratio '
+                             '(default: every 30 epochs)')
+    parser.add_argument('--phase_by', default='turning_point', type=str, choices=['step', 'turning_point'],
+                        help='switch precision / target ratio phases at --schedule steps or at loss turning points')
     parser.add_argument('--warm_up', action='store_true',
                         help='for n = 18, the model needs to warm up for 400 '
                              'iterations')
     parser.add_argument('--save_folder', default='save_checkpoints',
                         type=str,
                         help='folder to save the checkpoints')
+    parser.add_argument('--keep_last', default=3, type=int,
+                        help='number of per-epoch checkpoints to keep, 0 keeps all (default: 3)')
     parser.add_argument('--eval_every', default=390, type=int,
                         help='evaluate model every (default: 1000) iterations')
     parser.add_argument('--num_bits',default=0,type=int,
@@ -80,6 +103,9 @@ def parse_args():
                         help='schedule for weight/act precision')
     parser.add_argument('--num_grad_bits_schedule',default=None,type=int,nargs='*',
                         help='schedule for grad precision')
+    parser.add_argument('--resolution_schedule', default=None, type=int, nargs='*',
+                        help='training input resolution of each phase, e.g. 128 160 224; a switch '
+                             'takes effect at the next epoch (default: 224 throughout)')
     parser.add_argument('--act_fw', default=0, type=int,
                         help='precision of activation during forward, -1 means dynamic, 0 means no quantize')
     parser.add_argument('--act_bw', default=0, type=int,
@@ -92,70 +118,82 @@ def parse_args():
                         help='precision of weight')
     parser.add_argument('--momentum_act', default=0.9, type=float,
                         help='momentum for act min/max')
+    parser.add_argument('--bf16', default=False, action='store_true',
+                        help='run the full-precision regions and dequantized conv math under bf16 autocast')
+    parser.add_argument('--qparams_every', default=1, type=int,
+                        help='re-measure activation/weight quantization ranges every N steps, '
+                             'reusing the running statistics in between')
+    parser.add_argument('--calibrate', default=0, type=int,
+                        help='initialize the activation quantizers from a calibration pass over N training batches '
+                             '(default: 0, start from zero ranges)')
+    parser.add_argument('--calibration_file', default=None, type=str,
+                        help='calibration artifact to reuse if it exists, written after the calibration pass otherwise')
+    parser.add_argument('--distributed', default=False, action='store_true',
+                        help='one process per GPU with DistributedDataParallel (launch with torchrun)')
+    parser.add_argument('--quant_comm', default=False, action='store_true',
+                        help='all-reduce gradients quantized to the current num_grad_bits, with error feedback')
 
     parser.add_argument('--num_turning_point', type=int, default=3)
     parser.add_argument('--initial_threshold', type=float, default=0.05)
     parser.add_argument('--decay', type=float, default=0.3)
+    parser.add_argument('--indicator_every', type=int, default=0,
+                        help='feed the turning point indicator the mean training loss of every N steps '
+                             '(0: once per evaluation, from the epoch loss)')
+    parser.add_argument('--indicator_ema', type=float, default=0.,
+                        help='EMA smoothing of the indicator loss observations')
     args = parser.parse_args()
     return args
 
-# indicator
-class loss_diff_indicator():
-    def __init__(self, threshold, decay, epoch_keep=5):
-        self.threshold = threshold
-        self.decay = decay
-        self.epoch_keep = epoch_keep
-        self.loss = []
-        self.scale_loss = 1
-        self.loss_diff = [1 for i in range(1, self.epoch_keep)]
+def apply_indicator(args, loss, where):
+    """Feed one training loss observation to the turning point indicator"""
+    global turning_point_count
+    if turning_point_count >= args.num_turning_point:
+        return
+    # every rank feeds the same (rank-averaged) loss, so the precision switches stay in step
+    loss = util_dist.mean_across_ranks(loss)
+    flag = my_loss_diff_indicator.update(loss)
+    logging.info('indicator at {}: scale_loss {:.4f}, max loss diff {}'.format(
+        where, my_loss_diff_indicator.scale_loss, my_loss_diff_indicator.max_diff))
+    if flag:
+        turning_point_count += 1
+        logging.info('find {}-th turning point at {}'.format(turning_point_count, where))
+        my_loss_diff_indicator.adaptive_threshold(turning_point_count=turning_point_count)
+        my_loss_diff_indicator.reset()
+
+
+def init_quantizers(args, model, train_loader):
+    """Start the activation quantizers of a fresh run from calibrated ranges instead of zero"""
+    if args.calibration_file and os.path.isfile(args.calibration_file):
+        artifact = torch.load(args.calibration_file)
+    else:
+        # any nonzero precision routes the activations through the QuantMeasures
+        artifact = calibrate(model, train_loader, 8, 8, num_batches=args.calibrate)
+        # the pass advanced the sampler, training still starts with the first epoch's order
+        train_loader.sampler.set_epoch(0)
+        if args.calibration_file and args.rank == 0:
+            torch.save(artifact, args.calibration_file)
+    count = load_calibration(model, artifact)
+    logging.info('=> initialized {} activation quantizers from calibration'.format(count))
+
+
+def load_indicator_state(checkpoint):
+    global turning_point_count
+    if checkpoint.get('indicator') is not None:
+        my_loss_diff_indicator.load_state_dict(checkpoint['indicator'])
+        turning_point_count = checkpoint['turning_point_count']
 
-    def reset(self):
-        self.loss = []
-        self.loss_diff = [1 for i in range(1, self.epoch_keep)]
-
-    def adaptive_threshold(self, turning_point_count):
-        decay_1 = self.decay
-        decay_2 = self.decay
-        if turning_point_count == 1:
-            self.threshold *= decay_1
-        if turning_point_count == 2:
-            self.threshold *= decay_2
-        print('threshold decay to {}'.format(self.threshold))
-
-    def get_loss(self, current_epoch_loss):
-        if len(self.loss) < self.epoch_keep:
-            self.loss.append(current_epoch_loss)
-        else:
-            self.loss.pop(0)
-            self.loss.append(current_epoch_loss)
-
-    def cal_loss_diff(self):
-        if len(self.loss) == self.epoch_keep:
-            for i in range(len(self.loss)-1):
-                loss_now = self.loss[-1]
-                loss_pre = self.loss[i]
-                self.loss_diff[i] = np.abs(loss_pre - loss_now) / self.scale_loss
-            return True
-        else:
-            return False
-
-    def turning_point_emerge(self):
-        flag = self.cal_loss_diff()
-        if flag == True:
-            print(self.loss_diff)
-            for i in range(len(self.loss_diff)):
-                if self.loss_diff[i] > self.threshold:
-                    return False
-            return True
-        else:
-            return False
 
 def main():
     args = parse_args()
     global save_path
     save_path = args.save_path = os.path.join(args.save_folder, args.arch)
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
+
+    # join the process group first: only rank 0 owns the log, the record and the checkpoints
+    if args.distributed and args.cmd == 'train':
+        args.rank, args.world_size, args.local_rank = util_dist.init_distributed()
+    else:
+        args.rank, args.world_size, args.local_rank = 0, 1, 0
+    os.makedirs(save_path, exist_ok=True)
 
     models.ACT_FW = args.act_fw
     models.ACT_BW = args.act_bw
@@ -165,14 +203,19 @@ def main():
     models.MOMENTUM = args.momentum_act
 
     args.num_bits = args.num_bits if not (args.act_fw + args.act_bw + args.grad_act_error + args.grad_act_gc + args.weight_bits) else -1
+    if args.lr_base_batch:
+        args.lr = scale_lr(args.lr, args.batch_size, args.lr_base_batch)
 
     # config logging file
     args.logger_file = os.path.join(save_path, 'log_{}.txt'.format(args.cmd))
-    if os.path.exists(args.logger_file):
-        os.remove(args.logger_file)
-    handlers = [logging.FileHandler(args.logger_file, mode='w'),
-                logging.StreamHandler()]
-    logging.basicConfig(level=logging.INFO,
+    if args.rank == 0:
+        if os.path.exists(args.logger_file):
+            os.remove(args.logger_file)
+        handlers = [logging.FileHandler(args.logger_file, mode='w'),
+                    logging.StreamHandler()]
+    else:
+        handlers = [logging.StreamHandler()]
+    logging.basicConfig(level=logging.INFO if args.rank == 0 else logging.WARNING,
                         datefmt='%m-%d-%y %H:%M',
                         format='%(asctime)s:%(message)s',
                         handlers=handlers)
@@ -182,11 +225,10 @@ def main():
 
     # initialize indicator
     # initial_threshold=0.15
-    global scale_loss
-    scale_loss = 0
     global my_loss_diff_indicator
-    my_loss_diff_indicator = loss_diff_indicator(threshold=args.initial_threshold,
-                                                 decay=args.decay)
+    my_loss_diff_indicator = LossDiffIndicator(threshold=args.initial_threshold,
+                                               decay=args.decay,
+                                               ema=args.indicator_ema)
 
     global turning_point_count
     turning_point_count = 0
@@ -205,21 +247,38 @@ def run_training(args):
     # create model
     training_loss = 0
     training_acc = 0
+    indicator_loss = 0
 
     model = models.__dict__[args.arch](args.pretrained)
-    model = torch.nn.DataParallel(model).cuda()
+    comm_state = None
+    if args.distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model.cuda(), device_ids=[args.local_rank])
+        if args.quant_comm:
+            comm_state = util_dist.register_quantized_allreduce(model, args.num_grad_bits)
+    else:
+        model = torch.nn.DataParallel(model).cuda()
 
     best_prec1 = 0
     best_epoch = 0
 
+    checkpoint_writer = AsyncCheckpointWriter(args.save_path, keep_last=args.keep_last)
+    schedule = make_schedule(args)
+    resume_state = None
+    start_iter = 0
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
             logging.info('=> loading checkpoint `{}`'.format(args.resume))
             checkpoint = torch.load(args.resume)
             args.start_epoch = checkpoint['epoch']
+            start_iter = checkpoint.get('iter', 0)
+            resume_state = checkpoint
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
+            if checkpoint.get('schedule') is not None:
+                schedule.load_state_dict(checkpoint['schedule'])
+            load_indicator_state(checkpoint)
 
             logging.info('=> loaded checkpoint `{}` (epoch: {})'.format(
                 args.resume, checkpoint['epoch']
@@ -229,11 +288,13 @@ def run_training(args):
 
     cudnn.benchmark = False
 
+    # --batch_size stays the global batch size in distributed runs and with --accum_steps
     train_loader = prepare_train_data(dataset=args.dataset,
                                       datadir=args.datadir+'/train',
-                                      batch_size=args.batch_size,
+                                      batch_size=args.batch_size // (args.world_size * args.accum_steps),
                                       shuffle=True,
-                                      num_workers=args.workers)
+                                      num_workers=args.workers,
+                                      distributed=args.distributed)
     test_loader = prepare_test_data(dataset=args.dataset,
                                     datadir=args.datadir+'/val',
                                     batch_size=args.batch_size,
@@ -243,9 +304,10 @@ def run_training(args):
     # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda()
 
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    params = trainable_parameters(model)
+    optimizer = make_sgd(params, args.lr,
+                         momentum=args.momentum,
+                         weight_decay=args.weight_decay)
 
     # optimizer = torch.optim.Adam(model.parameters(), args.lr,
     #                             weight_decay=args.weight_decay)
@@ -258,24 +320,68 @@ def run_training(args):
 
     end = time.time()
 
-    global scale_loss
     global history_score
     global turning_point_count
     global my_loss_diff_indicator
 
+    def training_state(epoch, step):
+        # everything needed to resume at batch `step` of epoch `epoch`
+        return {
+            'epoch': epoch,
+            'iter': step,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_prec1': best_prec1,
+            'optimizer': optimizer.state_dict(),
+            'rng': get_rng_state(),
+            'data_seed': train_loader.sampler.seed,
+            'running': (training_loss, training_acc, indicator_loss),
+            'schedule': schedule.state_dict(),
+            'indicator': my_loss_diff_indicator.state_dict(),
+            'turning_point_count': turning_point_count,
+        }
+
+    if resume_state is not None:
+        # continue exactly where the interrupted run stopped
+        if resume_state.get('optimizer') is not None:
+            optimizer.load_state_dict(resume_state['optimizer'])
+        if resume_state.get('running') is not None:
+            training_loss, training_acc, indicator_loss = resume_state['running']
+        # the data order of the interrupted run (checkpoints without a seed used 0)
+        train_loader.sampler.seed = resume_state.get('data_seed', 0)
+        if resume_state.get('rng') is not None:
+            set_rng_state(resume_state['rng'])
+    elif args.calibrate:
+        init_quantizers(args, model, train_loader)
+
     for _epoch in range(args.start_epoch, args.epoch):
-        lr = adjust_learning_rate(args, optimizer, _epoch)
-        # adjust_precision(args, _epoch)
-        adaptive_adjust_precision(args, turning_point_count)
+        lr, _ = schedule.apply(_epoch, args, optimizer, turning_point_count)
+        if comm_state is not None:
+            # low-precision phases of the schedule also communicate fewer bits
+            comm_state.num_bits = args.num_grad_bits
 
         print('Learning Rate:', lr)
         print('num bits:', args.num_bits, 'num grad bits:', args.num_grad_bits)
 
-        for i, (input, target) in enumerate(train_loader):
+        if 'resolution' in schedule.phases:
+            set_train_resolution(train_loader, args.resolution)
+            print('Resolution:', args.resolution)
+
+        # a resumed epoch skips the batches its checkpoint has already seen
+        epoch_start = start_iter if _epoch == args.start_epoch else 0
+        train_loader.sampler.set_epoch(_epoch, epoch_start * train_loader.batch_size)
+        for i, (input, target) in enumerate(train_loader, epoch_start):
             # measuring data loading time
             data_time.update(time.time() - end)
 
             model.train()
+            set_running_stats_update(model, i % args.qparams_every == 0)
+
+            # loader batches are micro-batches, every `accum` of them make one optimizer step
+            accum, step_end = accumulation_group(i, len(train_loader), args.accum_steps)
+            step_start = i % args.accum_steps == 0 or i == epoch_start
+            if _epoch < args.warmup_epochs:
+                set_lr(optimizer, schedule.lr(_epoch + float(i) / len(train_loader)))
 
             fw_cost = args.num_bits*args.num_bits/32/32
             eb_cost = args.num_bits*args.num_grad_bits/32/32
@@ -287,7 +393,9 @@ def run_training(args):
             target_var = Variable(target).cuda()
 
             # compute output
-            output = model(input_var, args.num_bits, args.num_grad_bits)
+            with autocast(args.bf16):
+                output = model(input_var, args.num_bits, args.num_grad_bits)
+            output = output.float()
             loss = criterion(output, target_var)
             training_loss += loss.item()
 
@@ -297,15 +405,31 @@ def run_training(args):
             top1.update(prec1.item(), input.size(0))
             training_acc += prec1.item()
 
+            # step-granularity indicator: precision can switch within an epoch
+            if args.indicator_every:
+                indicator_loss += loss.item()
+                if (i + 1) % args.indicator_every == 0:
+                    apply_indicator(args, indicator_loss / args.indicator_every, 'epoch {} iter {}'.format(_epoch, i + 1))
+                    indicator_loss = 0
+                    schedule.apply(_epoch, args, optimizer, turning_point_count)
+                    if comm_state is not None:
+                        comm_state.num_bits = args.num_grad_bits
+
             # compute gradient and do SGD step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            if step_start:
+                optimizer.zero_grad()
+            with sync_gradients(model, step_end):
+                (loss / accum).backward()
+            if step_end:
+                optimizer.step()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
+            if args.checkpoint_every and (i + 1) % args.checkpoint_every == 0 and step_end and args.rank == 0:
+                checkpoint_writer.save(training_state(_epoch, i + 1))
+
             # print log
             if i % args.print_freq == 0:
                 logging.info("Iter: [{0}][{1}/{2}]\t"
@@ -324,37 +448,30 @@ def run_training(args):
 
         epoch = _epoch + 1
         epoch_loss = training_loss / len(train_loader)
-        with torch.no_grad():
-            prec1 = validate(args, test_loader, model, criterion, _epoch)
-            # prec_full = validate_full_prec(args, test_loader, model, criterion, i)
-        history_score[epoch-1][0] = epoch_loss
-        history_score[epoch-1][1] = np.round(training_acc / len(train_loader), 2)
-        history_score[epoch-1][2] = prec1
+        epoch_acc = np.round(training_acc / len(train_loader), 2)
         training_loss = 0
         training_acc = 0
 
-        np.savetxt(os.path.join(save_path, 'record.txt'), history_score, fmt = '%10.5f', delimiter=',')
-
         # apply indicator
-        # if epoch == 1:
-        #     logging.info('initial loss value: {}'.format(epoch_loss))
-        #     my_loss_diff_indicator.scale_loss = epoch_loss
-        if epoch <= 10:
-            scale_loss += epoch_loss
-            logging.info('scale_loss at epoch {}: {}'.format(epoch, scale_loss / epoch))
-            my_loss_diff_indicator.scale_loss = scale_loss / epoch
-        if turning_point_count < args.num_turning_point:
-            my_loss_diff_indicator.get_loss(epoch_loss)
-            flag = my_loss_diff_indicator.turning_point_emerge()
-            if flag == True:
-                turning_point_count += 1
-                logging.info('find {}-th turning point at {}-th epoch'.format(turning_point_count, epoch))
-                # print('find {}-th turning point at {}-th epoch'.format(turning_point_count, epoch))
-                my_loss_diff_indicator.adaptive_threshold(turning_point_count=turning_point_count)
-                my_loss_diff_indicator.reset()
+        if not args.indicator_every:
+            apply_indicator(args, epoch_loss, '{}-th epoch'.format(epoch))
 
         logging.info('Epoch [{}] num_bits = {} num_grad_bits = {}'.format(epoch, args.num_bits, args.num_grad_bits))
 
+        # only rank 0 validates and writes the record and the checkpoints; it runs the unwrapped
+        # model, the DDP forward would wait for the buffer broadcast of the other ranks
+        if args.rank != 0:
+            continue
+
+        with torch.no_grad():
+            prec1 = validate(args, test_loader, model.module if args.distributed else model, criterion, _epoch)
+            # prec_full = validate_full_prec(args, test_loader, model, criterion, i)
+        history_score[epoch-1][0] = epoch_loss
+        history_score[epoch-1][1] = epoch_acc
+        history_score[epoch-1][2] = prec1
+
+        np.savetxt(os.path.join(save_path, 'record.txt'), history_score, fmt = '%10.5f', delimiter=',')
+
 
         is_best = prec1 > best_prec1
         if is_best:
@@ -367,16 +484,9 @@ def run_training(args):
         #print("Current Best Full Prec@1: ", best_full_prec)
 
         checkpoint_path = os.path.join(args.save_path, 'checkpoint_{:05d}_{:.2f}.pth.tar'.format(_epoch, prec1))
-        save_checkpoint({
-            'epoch': _epoch,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_prec1': best_prec1,
-        },
-            is_best, filename=checkpoint_path)
-        shutil.copyfile(checkpoint_path, os.path.join(args.save_path,
-                                                      'checkpoint_latest'
-                                                      '.pth.tar'))
+        checkpoint_writer.save(training_state(_epoch + 1, 0), filename=checkpoint_path, is_best=is_best)
+
+    checkpoint_writer.close()
 
 
 def validate(args, test_loader, model, criterion, _epoch):
@@ -479,14 +589,6 @@ def test_model(args):
         # prec_full = validate_full_prec(args, test_loader, model, criterion, args.start_iter)
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    torch.save(state, filename)
-    if is_best:
-        save_path = os.path.dirname(filename)
-        shutil.copyfile(filename, os.path.join(save_path,
-                                               'model_best.pth.tar'))
-
-
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -506,36 +608,13 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-schedule_cnt = 0
-def adjust_precision(args, _epoch):
-    if args.schedule:
-        global schedule_cnt
-
-        assert len(args.num_bits_schedule) == len(args.schedule) + 1
-        assert len(args.num_grad_bits_schedule) == len(args.schedule) + 1
-
-        if schedule_cnt == 0:
-            args.num_bits = args.num_bits_schedule[0]
-            args.num_grad_bits = args.num_grad_bits_schedule[0]
-            schedule_cnt += 1
-
-        for step in args.schedule:
-            if _epoch == step:
-                args.num_bits = args.num_bits_schedule[schedule_cnt]
-                args.num_grad_bits = args.num_grad_bits_schedule[schedule_cnt]
-                schedule_cnt += 1
-
-def adaptive_adjust_precision(args, turning_point_count):
-    args.num_bits = args.num_bits_schedule[turning_point_count]
-    args.num_grad_bits = args.num_grad_bits_schedule[turning_point_count]
-
-def adjust_learning_rate(args, optimizer, _epoch):
-    lr = args.lr * (0.1 ** (_epoch // 30))
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-    return lr
+def make_schedule(args):
+    return ScheduleEngine(args.lr, args.lr_schedule, lr_steps=args.lr_steps or range(30, args.epoch, 30), step_ratio=args.step_ratio,
+                          total=args.epoch, warm_up=args.warmup_epochs, warm_up_lr=args.warmup_lr, warm_up_mode='linear', linear_range=(0.5, 0.9),
+                          phases={'num_bits': args.num_bits_schedule,
+                                  'num_grad_bits': args.num_grad_bits_schedule,
+                                  'resolution': args.resolution_schedule},
+                          phase_by=args.phase_by, phase_steps=args.schedule)
 
 
 def accuracy(output, target, topk=(1,)):
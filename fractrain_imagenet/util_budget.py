@@ -0,0 +1,71 @@
+"""closed-loop control of the computation loss: drive the running cp_ratio to the compute budget
+"""
+
+import torch
+
+
+class BudgetController(object):
+    """PI controller for the sign / weight `reg` of the computation loss.
+
+    The bang-bang rule (-1 below the target, +1 above it) reacts to every batch and keeps
+    cp_ratio oscillating around the target. Here the error is taken on a running average of
+    cp_ratio, in percentage points,
+
+        e = ema(cp_ratio) - budget
+        I = clamp(I + ki * e, -limit, limit)
+        reg = clamp(kp * e + I, -limit, limit)
+
+    so reg shrinks as the run approaches its budget, and the integral term removes the
+    steady-state offset left by a proportional controller alone. Clamping the integral
+    (anti-windup) bounds the overshoot after a long stretch on one side of the budget.
+    With limit = 1, reg stays in the range of the bang-bang rule, so beta keeps its meaning.
+
+    step() works on device tensors without syncing the host. Call reset() when the budget
+    changes (a new phase), so the pressure built up for the old budget is dropped.
+    """
+
+    def __init__(self, kp=0.1, ki=0.01, ema=0.9, limit=1.0):
+        self.kp = kp
+        self.ki = ki
+        self.ema = ema
+        self.limit = limit
+        self.running = None
+        self.integral = None
+
+    def step(self, cp_ratio, budget):
+        cp_ratio = torch.as_tensor(cp_ratio, dtype=torch.float32)
+        if self.running is None:
+            self.running = cp_ratio.detach().clone()
+            self.integral = torch.zeros_like(self.running)
+        else:
+            self.running.mul_(self.ema).add_(cp_ratio.detach() * (1 - self.ema))
+
+        error = self.running - budget
+        self.integral.add_(error * self.ki).clamp_(-self.limit, self.limit)
+        return (error * self.kp + self.integral).clamp(-self.limit, self.limit)
+
+    def peek(self, cp_ratio, budget):
+        """What step() would return, without updating the state (e.g. for the micro-batches
+        of a gradient accumulation group before the one that steps the controller)"""
+        cp_ratio = torch.as_tensor(cp_ratio, dtype=torch.float32).detach()
+        if self.running is None:
+            return (cp_ratio - budget).mul(self.kp + self.ki).clamp(-self.limit, self.limit)
+        running = self.running * self.ema + cp_ratio.to(self.running.device) * (1 - self.ema)
+        error = running - budget
+        integral = (self.integral + error * self.ki).clamp(-self.limit, self.limit)
+        return (error * self.kp + integral).clamp(-self.limit, self.limit)
+
+    def reset(self):
+        if self.integral is not None:
+            self.integral.zero_()
+
+    def state_dict(self):
+        if self.running is None:
+            return None
+        return {'running': float(self.running), 'integral': float(self.integral)}
+
+    def load_state_dict(self, state, device=None):
+        if state is None:
+            return
+        self.running = torch.tensor(state['running'], device=device)
+        self.integral = torch.tensor(state['integral'], device=device)
@@ -0,0 +1,101 @@
+"""distributed training helpers: process group setup and a quantized gradient all-reduce
+"""
+
+import math
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed():
+    """Join the process group described by the launcher environment (RANK, WORLD_SIZE,
+    LOCAL_RANK) and bind this process to its GPU. Returns (rank, world_size, local_rank)."""
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl', init_method='env://')
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def mean_across_ranks(value):
+    """Mean of a python number over all ranks; the value itself outside a process group"""
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    total = torch.tensor([float(value)], device='cuda')
+    dist.all_reduce(total)
+    return total.item() / dist.get_world_size()
+
+
+class QuantizedAllReduceState(object):
+    """State of the quantized all-reduce hook.
+
+    num_bits is the gradient precision used on the wire. The trainer updates it from the
+    precision schedule, and 0 (or 1, whose signed grid has no nonzero code) means a plain
+    full-precision all-reduce. With error_feedback, each bucket keeps its quantization residual
+    and adds it to the next step's gradient.
+    """
+
+    def __init__(self, process_group=None, num_bits=8, error_feedback=True):
+        self.process_group = process_group
+        self.num_bits = num_bits
+        self.error_feedback = error_feedback
+        self.residuals = {}
+
+
+def _bucket_tensor(bucket):
+    # GradBucket.get_tensor() was renamed to buffer() in torch 1.9
+    return bucket.buffer() if hasattr(bucket, 'buffer') else bucket.get_tensor()
+
+
+def _transport_dtype(num_bits, world_size):
+    # the sum of world_size values in [-qmax, qmax] needs num_bits + log2(world_size) bits;
+    # fp16 holds integers exactly up to 2^11 (nccl has no int16)
+    acc_bits = num_bits + int(math.ceil(math.log(world_size, 2)))
+    if acc_bits <= 8:
+        return torch.int8
+    if acc_bits <= 11:
+        return torch.float16
+    return torch.int32
+
+
+def quantized_allreduce_hook(state, bucket):
+    """DDP communication hook: stochastic-rounding quantization of the gradient bucket to
+    state.num_bits with a scale shared by all workers, summed as integers and averaged."""
+    group = state.process_group if state.process_group is not None else dist.group.WORLD
+    world_size = dist.get_world_size(group)
+    tensor = _bucket_tensor(bucket)
+
+    if state.num_bits < 2:
+        fut = dist.all_reduce(tensor.div_(world_size), group=group, async_op=True).get_future()
+        return fut.then(lambda fut: fut.value()[0])
+
+    # buckets are rebuilt after the first iteration, so only reuse a residual of the same size
+    index = bucket.index()
+    residual = state.residuals.get(index)
+    if state.error_feedback and residual is not None and residual.shape == tensor.shape:
+        tensor.add_(residual)
+
+    # a shared scale keeps the integer codes of all workers summable; both all-reduces run as
+    # chained futures, so the hook returns right away and DDP keeps overlapping the backward
+    qmax = 2. ** (state.num_bits - 1) - 1
+    dtype = _transport_dtype(state.num_bits, world_size)
+    scale = tensor.abs().max().view(1)
+    fut = dist.all_reduce(scale, op=dist.ReduceOp.MAX, group=group, async_op=True).get_future()
+
+    def encode_and_reduce(fut):
+        scale = fut.value()[0].clamp(min=1e-12) / qmax
+        codes = tensor / scale
+        codes.add_(torch.empty_like(codes).uniform_(-0.5, 0.5)).round_().clamp_(-qmax, qmax)
+        if state.error_feedback:
+            state.residuals[index] = tensor - codes * scale
+        summed = dist.all_reduce(codes.to(dtype), group=group, async_op=True).get_future().wait()[0]
+        return summed.to(tensor.dtype).mul_(scale / world_size)
+
+    return fut.then(encode_and_reduce)
+
+
+def register_quantized_allreduce(model, num_bits, error_feedback=True):
+    """Install quantized_allreduce_hook on a DistributedDataParallel model and return its state"""
+    state = QuantizedAllReduceState(num_bits=num_bits, error_feedback=error_feedback)
+    model.register_comm_hook(state, quantized_allreduce_hook)
+    return state
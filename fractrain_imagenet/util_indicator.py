@@ -0,0 +1,104 @@
+"""loss-difference turning point indicator for the precision / target ratio schedules
+"""
+
+from collections import deque
+
+
+class LossDiffIndicator(object):
+    """Detects a plateau of the training loss.
+
+    Every call to update() feeds one loss observation: an eval_every / epoch average, or
+    the mean over the last indicator_every steps. Observations are optionally smoothed
+    with an EMA and kept in a ring buffer of the last `window` values. A turning point
+    emerges once the window is full and every value in it lies within threshold * scale_loss
+    of the newest one. scale_loss is the mean of the first `scale_window` observations.
+
+    The window max/min are tracked with monotonic deques, so an update costs O(1) amortized.
+    """
+
+    def __init__(self, threshold, decay, window=5, ema=0., scale_window=10):
+        self.threshold = threshold
+        self.decay = decay
+        self.window = window
+        self.ema = ema
+        self.scale_window = scale_window
+
+        self.num_updates = 0
+        self.scale_sum = 0.
+        self.scale_loss = 1
+        self.max_diff = None
+        self.reset()
+
+    def reset(self):
+        """Forget the window (after a turning point), keeping scale_loss"""
+        self.buffer = [0.] * self.window
+        self.count = 0
+        self.smoothed = None
+        self.max_deque = deque()
+        self.min_deque = deque()
+
+    def adaptive_threshold(self, turning_point_count):
+        if turning_point_count in (1, 2):
+            self.threshold *= self.decay
+        print('threshold decay to {}'.format(self.threshold))
+
+    def _push(self, value):
+        index = self.count
+        self.buffer[index % self.window] = value
+        self.count += 1
+
+        while self.max_deque and self.max_deque[-1][1] <= value:
+            self.max_deque.pop()
+        self.max_deque.append((index, value))
+        while self.min_deque and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((index, value))
+
+        # drop entries that left the window
+        while self.max_deque[0][0] <= index - self.window:
+            self.max_deque.popleft()
+        while self.min_deque[0][0] <= index - self.window:
+            self.min_deque.popleft()
+
+    def update(self, loss):
+        """Feed one loss observation, return True if a turning point emerges"""
+        loss = float(loss)
+        self.num_updates += 1
+        if self.num_updates <= self.scale_window:
+            self.scale_sum += loss
+            self.scale_loss = self.scale_sum / self.num_updates
+
+        if self.smoothed is None or not self.ema:
+            self.smoothed = loss
+        else:
+            self.smoothed = self.ema * self.smoothed + (1 - self.ema) * loss
+        self._push(self.smoothed)
+
+        if self.count < self.window:
+            return False
+
+        # largest |loss_i - loss_now| over the window
+        self.max_diff = max(self.max_deque[0][1] - self.smoothed,
+                            self.smoothed - self.min_deque[0][1]) / self.scale_loss
+        return self.max_diff <= self.threshold
+
+    def state_dict(self):
+        return {
+            'threshold': self.threshold,
+            'num_updates': self.num_updates,
+            'scale_sum': self.scale_sum,
+            'scale_loss': self.scale_loss,
+            'smoothed': self.smoothed,
+            # window in insertion order, oldest first
+            'values': [self.buffer[k % self.window] for k in range(max(0, self.count - self.window), self.count)],
+        }
+
+    def load_state_dict(self, state):
+        self.threshold = state['threshold']
+        self.num_updates = state['num_updates']
+        self.scale_sum = state['scale_sum']
+        self.scale_loss = state['scale_loss']
+        self.reset()
+        for value in state['values'][-self.window:]:
+            self._push(value)
+        self.smoothed = state['smoothed']